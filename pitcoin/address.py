@@ -1,20 +1,245 @@
-from datetime import datetime, timedelta
 import threading
+import asyncio
+import calendar
+import hashlib
 import random
 import socket
+import struct
+import math
 import time
+import os
 
-from net.clients import BitcoinClient
-from net.exceptions import NodeDisconnected
-from datatypes import messages
+from config import DATA_DIR, logger
+from net.peers import AsyncBitcoinClient
+from datatypes import messages, values
 
 class Node(object):
-    def __init__(self, ip_address, port, time):
+    """A peer address, with the history of our connections to it.
+
+    `latency` is the smoothed time it took to connect, in seconds, and `bandwidth` the smoothed rate at which the
+    peer delivered the blocks we requested, in bytes per second. Both are None until measured.
+    """
+    __slots__ = ('ip_address', 'port', 'time', 'services', 'latency', 'bandwidth', 'last_attempt', 'last_success',
+        'successes', 'failures', 'attempts', 'ban_score', 'table', 'bucket', 'position')
+
+    # The weight of a new measurement in the smoothed latency and bandwidth
+    SMOOTHING = 0.3
+
+    # Assumed for the peers we haven't measured yet
+    DEFAULT_LATENCY = 0.5
+    DEFAULT_BANDWIDTH = 1024 * 100
+
+    # The size of a typical block, to weigh the latency against the bandwidth
+    BLOCK_SIZE = 1024 * 500
+
+    # Seconds before an address is tried again
+    RETRY_DELAY = 60
+
+    def __init__(self, ip_address, port, time, services=values.SERVICES["NODE_NETWORK"], latency=None, bandwidth=None,
+                 last_attempt=0, last_success=0, successes=0, failures=0, attempts=0):
         self.ip_address = ip_address
         self.port = port
+        # The unix time at which the peer was last seen on the network
         self.time = time
+        self.services = services
+
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.last_attempt = last_attempt
+        self.last_success = last_success
+        self.successes = successes
+        self.failures = failures
+        # Failed connection attempts since the last successful one
+        self.attempts = attempts
+        # Points for misbehaving, see AddressBook.misbehaved
+        self.ban_score = 0
+
+        # The AddressTable holding the node, its bucket there, and its position in the table's list of nodes
+        self.table = None
+        self.bucket = None
+        self.position = None
+
+    def __repr__(self):
+        return "<%s %s:%d>" % (self.__class__.__name__, self.ip_address, self.port)
+
+    @property
+    def key(self):
+        return (self.ip_address, self.port)
+
+    def connected(self, latency):
+        """Record a successful connection, which took `latency` seconds"""
+        self.last_success = time.time()
+        self.successes += 1
+        self.attempts = 0
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += (latency - self.latency) * self.SMOOTHING
+
+    def failed(self):
+        """Record a failed connection attempt"""
+        self.failures += 1
+        self.attempts += 1
+
+    def delivered(self, size, seconds):
+        """Record a block of `size` bytes, which the peer took `seconds` to deliver"""
+        bandwidth = size / max(seconds, 0.001)
+        if self.bandwidth is None:
+            self.bandwidth = bandwidth
+        else:
+            self.bandwidth += (bandwidth - self.bandwidth) * self.SMOOTHING
+
+    def stalled(self):
+        """Record a request the peer didn't answer in time, as a delivery rate of zero"""
+        bandwidth = self.bandwidth if self.bandwidth is not None else self.DEFAULT_BANDWIDTH
+        self.bandwidth = bandwidth * (1 - self.SMOOTHING)
+
+    def get_score(self, now):
+        """How good a peer we expect the node to be: the number of typical blocks it would deliver per second,
+        discounted for each recent failed attempt. Returns 0 if it was tried too recently."""
+        if now - self.last_attempt < self.RETRY_DELAY:
+            return 0
+        latency = self.latency if self.latency is not None else self.DEFAULT_LATENCY
+        bandwidth = self.bandwidth if self.bandwidth is not None else self.DEFAULT_BANDWIDTH
+        return 0.66 ** min(self.attempts, 8) / (latency + self.BLOCK_SIZE / bandwidth)
+
+class AddressTable(object):
+    """Nodes in a fixed number of buckets, each holding at most `BUCKET_SIZE` nodes.
+
+    The bucket of a node is picked with a keyed hash of its network group (the /16 of its IP address) and its
+    address, such that each group only spreads over `group_buckets` buckets. A few networks can't fill the table,
+    however many addresses they advertise. The nodes are also kept in a flat list, so adding, removing and picking a
+    random node take constant time.
+    """
+
+    BUCKET_SIZE = 64
+
+    def __init__(self, bucket_count, group_buckets, key):
+        self.bucket_count = bucket_count
+        self.group_buckets = group_buckets
+        self.key = key
+        self.buckets = [[] for i in range(bucket_count)]
+        self.nodes = []
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def _hash(self, data):
+        return int.from_bytes(hashlib.blake2b(data.encode(), digest_size=8, key=self.key).digest(), 'little')
+
+    def get_bucket(self, node):
+        group = node.ip_address.rsplit('.', 2)[0]
+        slot = self._hash("%s %s:%d" % (group, node.ip_address, node.port)) % self.group_buckets
+        return self._hash("%s %d" % (group, slot)) % self.bucket_count
+
+    def is_full(self, bucket):
+        return len(self.buckets[bucket]) >= self.BUCKET_SIZE
+
+    def add(self, node, bucket):
+        node.table = self
+        node.bucket = bucket
+        node.position = len(self.nodes)
+        self.nodes.append(node)
+        self.buckets[bucket].append(node)
+
+    def remove(self, node):
+        # Move the last node into the removed one's place
+        last = self.nodes.pop()
+        if last is not node:
+            self.nodes[node.position] = last
+            last.position = node.position
+        self.buckets[node.bucket].remove(node)
+        node.table = node.bucket = node.position = None
+
+    def random(self):
+        return random.choice(self.nodes)
+
+class AddressStore(object):
+    """The file the AddressBook is saved in: a log of fixed-size records, appended to as the addresses change.
+
+    The file starts with the key of the AddressBook's bucket hashes, so the addresses go back in the same buckets
+    when they're loaded, without hashing them again. Each record is either the state of an address, in the new or
+    tried table, the removal of an address, or the ban of an IP address. The last record of each address wins. A
+    record left half-written by a crash is cut off. The file is rewritten with only the live records once most of
+    its records are outdated.
+    """
 
-class AddressClient(BitcoinClient):
+    MAGIC = b"pitaddr1"
+    HEADER = struct.Struct("<8s16s")
+
+    # Kind, IPv4 address, port, services, time, last attempt, last success, successes, failures, attempts, bucket,
+    # latency and bandwidth. The times are unix times; a ban is a record with port 0 and the time it ends. A latency
+    # or bandwidth we haven't measured is saved as NaN.
+    RECORD = struct.Struct("<B4sHQIIIIIHHff")
+    NEW, TRIED, REMOVED, BANNED = range(4)
+
+    def __init__(self, path):
+        self.path = path
+        # The number of records in the file
+        self.count = 0
+
+    def load(self):
+        """Return the bucket key and the records of the file, or None if there's no valid file"""
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        if len(data) < self.HEADER.size:
+            return None
+        magic, key = self.HEADER.unpack_from(data)
+        if magic != self.MAGIC:
+            return None
+        self.count, partial = divmod(len(data) - self.HEADER.size, self.RECORD.size)
+        end = len(data) - partial
+        if partial > 0:
+            with open(self.path, 'r+b') as f:
+                f.truncate(end)
+        return key, self.RECORD.iter_unpack(memoryview(data)[self.HEADER.size:end])
+
+    def append(self, records):
+        with open(self.path, 'ab') as f:
+            f.write(b"".join(self.RECORD.pack(*record) for record in records))
+        self.count += len(records)
+
+    def rewrite(self, key, records):
+        """Replace the file with one holding only the given records"""
+        path = self.path + ".new"
+        with open(path, 'wb') as f:
+            f.write(self.HEADER.pack(self.MAGIC, key))
+            f.write(b"".join(self.RECORD.pack(*record) for record in records))
+        os.replace(path, self.path)
+        self.count = len(records)
+
+    @staticmethod
+    def to_record(node, kind):
+        return (
+            kind, socket.inet_aton(node.ip_address), node.port, node.services, int(node.time), int(node.last_attempt),
+            int(node.last_success), node.successes, node.failures, min(node.attempts, 0xffff), node.bucket,
+            node.latency if node.latency is not None else math.nan,
+            node.bandwidth if node.bandwidth is not None else math.nan,
+        )
+
+    @staticmethod
+    def to_ban_record(ip_address, until):
+        return (AddressStore.BANNED, socket.inet_aton(ip_address), 0, 0, int(until), 0, 0, 0, 0, 0, 0, math.nan,
+            math.nan)
+
+    @staticmethod
+    def to_removal_record(key):
+        return (AddressStore.REMOVED, socket.inet_aton(key[0]), key[1], 0, 0, 0, 0, 0, 0, 0, 0, math.nan, math.nan)
+
+    @staticmethod
+    def from_record(record):
+        """Return the Node of an address record, and its bucket"""
+        kind, ip_address, port, services, timestamp, last_attempt, last_success, successes, failures, attempts, \
+            bucket, latency, bandwidth = record
+        # Positional arguments, as this is most of the time taken to load the file
+        return Node(socket.inet_ntoa(ip_address), port, timestamp, services,
+            latency if not math.isnan(latency) else None, bandwidth if not math.isnan(bandwidth) else None,
+            last_attempt, last_success, successes, failures, attempts), bucket
+
+class AddressClient(AsyncBitcoinClient):
     def __init__(self, *args, **kwargs):
         from testnet import testnet
         if not testnet:
@@ -26,17 +251,29 @@ class AddressClient(BitcoinClient):
         self.send_message(messages.GetAddr())
 
     def handle_addr(self, header, message):
-        for message_address in message.addresses:
-            AddressBook.addresses.append(Node(
-                ip_address=message_address.address.ip_address,
-                port=message_address.address.port,
-                time=message_address.timestamp,
-            ))
+        AddressBook.add_addresses(message.addresses)
+        # We've got what we came for
+        self.disconnect()
 
 class AddressBook(threading.Thread):
+    """The addresses of the peers we know of, and how they did when we connected to them.
+
+    Like the address manager of the reference client, the addresses are split between two AddressTables: the `new`
+    table for addresses we've heard of, and the `tried` table for the peers we've successfully connected to. When a
+    bucket is full, the address least worth keeping makes room; one from the tried table goes back to the new table.
+    `select` picks a peer to connect to in constant time, preferring the fast and reliable ones. Peers which misbehave
+    are banned by IP address for `BAN_TIME` seconds.
+
+    The book is shared by the event loop connecting to peers and the thread started by `keep_updated`, so it's
+    only changed with `lock` held.
+
+    Once `open` is called, the book is loaded from an AddressStore file, and `save` appends the addresses which
+    changed since, so a restart can connect to the peers which worked before without asking the seed nodes.
+    """
     from testnet import testnet
 
-    addresses = []
+    # (ip_address, port) -> Node
+    addresses = {}
     if not testnet:
         seed_addresses = [
             "seed.bitcoin.sipa.be",
@@ -51,26 +288,102 @@ class AddressBook(threading.Thread):
             "testnet-seed.bluematt.me",
         ]
 
+    ADDRESS_FILE = os.path.join(DATA_DIR, "peers.dat" if not testnet else "peers_testnet3.dat")
+
+    # Seconds to wait for each seed node to send addresses
+    BOOTSTRAP_TIMEOUT = 40
+
+    # The seed nodes are queried again when we know fewer addresses, at most every `SEED_INTERVAL` seconds
+    MIN_ADDRESSES = 1000
+    SEED_INTERVAL = 60 * 10
+    last_seeded = 0
+
+    # The tables hold up to 64K and 16K addresses. Each network group spreads over 64 and 8 buckets of them.
+    NEW_BUCKET_COUNT = 1024
+    NEW_GROUP_BUCKETS = 64
+    TRIED_BUCKET_COUNT = 256
+    TRIED_GROUP_BUCKETS = 8
+
+    # The chance of picking a peer from the tried table, when both have some
+    TRIED_RATIO = 0.5
+
+    # Random nodes compared by `select`, the best of which is picked
+    SAMPLE_SIZE = 4
+    SELECT_TRIES = 50
+
+    # Addresses which failed this many times in a row, and haven't worked for `MAX_SILENCE` seconds, are forgotten
+    MAX_FAILURES = 10
+    MAX_SILENCE = 60 * 60 * 24 * 7
+
+    # Misbehaving peers are banned once their score reaches `BAN_SCORE`
+    BAN_SCORE = 100
+    BAN_TIME = 60 * 60 * 24
+
+    # IP address -> unix time until which it's banned
+    banned = {}
+
+    key = os.urandom(16)
+    new = AddressTable(NEW_BUCKET_COUNT, NEW_GROUP_BUCKETS, key)
+    tried = AddressTable(TRIED_BUCKET_COUNT, TRIED_GROUP_BUCKETS, key)
+
+    lock = threading.RLock()
+
+    # The AddressStore, once opened
+    store = None
+
+    # (ip_address, port) -> Node of the addresses changed since the last save, or None if removed
+    dirty = {}
+
+    # IP addresses banned since the last save
+    dirty_bans = []
+
+    # The address file is rewritten once it holds more than twice the live records, plus this many
+    MAX_OUTDATED_RECORDS = 1024 * 16
+
+    # Changes to the time an address was last seen are only saved when it's later by this many seconds
+    TIME_PRECISION = 60 * 60
+
     @staticmethod
     def bootstrap():
         """
-        Try to get addresses from a random seed node. This thread blocks on the loop, so run a separate one
-        which will check if addresses are received or disconnect if timeout is reached.
+        Get addresses from the seed nodes. All seeds are queried concurrently on one event loop, each with its own
+        timeout, and we retry until at least one of them has given us some addresses.
         """
-        bootstrapper = BootstrapperThread()
-        bootstrapper.daemon = True
-        bootstrapper.start()
+        AddressBook.open()
         while len(AddressBook.addresses) == 0:
-            try:
-                current_seed = random.choice(AddressBook.seed_addresses)
-                client = AddressClient(current_seed)
-                bootstrapper.seed_client = client
-                client.handshake()
-                client.loop()
-            except (NodeDisconnected, socket.error) as e:
-                print("Connection to seed node '%s' failed: %s - retrying in 10 seconds." % (current_seed, e))
+            asyncio.run(AddressBook.query_seeds())
+            if len(AddressBook.addresses) == 0:
+                logger.warning("Didn't get any addresses from the seed nodes - retrying in 10 seconds.")
                 time.sleep(10)
 
+    @staticmethod
+    def needs_seeds():
+        """Whether we should ask the seed nodes for more addresses"""
+        if len(AddressBook.addresses) == 0:
+            return True
+        return len(AddressBook.addresses) < AddressBook.MIN_ADDRESSES and \
+            time.time() - AddressBook.last_seeded >= AddressBook.SEED_INTERVAL
+
+    @staticmethod
+    async def query_seeds():
+        AddressBook.last_seeded = time.time()
+        await asyncio.gather(*[AddressBook.query_seed(seed) for seed in AddressBook.seed_addresses])
+
+    @staticmethod
+    async def query_seed(seed):
+        try:
+            client = await AddressClient.connect(seed)
+        except (OSError, asyncio.TimeoutError) as e:
+            logger.info("Connection to seed node '%s' failed: %s" % (seed, e))
+            return
+
+        client.handshake()
+        try:
+            await asyncio.wait_for(client.wait_closed(), AddressBook.BOOTSTRAP_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.info("Seed node '%s' didn't send any addresses in time" % seed)
+            client.disconnect()
+
     @staticmethod
     def keep_updated():
         AddressBook.updater = AddressBook()
@@ -78,44 +391,351 @@ class AddressBook(threading.Thread):
         AddressBook.updater.start()
 
     @staticmethod
-    def get_node():
-        viable_address = max(AddressBook.addresses, key=lambda a: a.time)
-        AddressBook.addresses.remove(viable_address)
-        return viable_address
+    def add_addresses(addresses):
+        """Add the addresses of an addr message"""
+        now = time.time()
+        for message_address in addresses:
+            AddressBook.add(
+                ip_address=message_address.address.ip_address,
+                port=message_address.address.port,
+                # Peers may claim any time; don't believe it's in the future
+                timestamp=min(calendar.timegm(message_address.timestamp.utctimetuple()), now),
+                services=message_address.address.services,
+            )
 
-    def run(self):
-        pass
+    @staticmethod
+    def add(ip_address, port, timestamp, services=values.SERVICES["NODE_NETWORK"]):
+        """Add an address to the new table, or update the one we have. Returns its Node, or None if it isn't
+        added: we only connect to full nodes which aren't banned."""
+        if port == 0 or not services & values.SERVICES["NODE_NETWORK"]:
+            return None
+        with AddressBook.lock:
+            if AddressBook.is_banned(ip_address):
+                return None
+            node = AddressBook.addresses.get((ip_address, port))
+            if node is not None:
+                if timestamp >= node.time + AddressBook.TIME_PRECISION or services != node.services:
+                    AddressBook.changed(node)
+                node.time = max(node.time, timestamp)
+                node.services = services
+                return node
+            node = Node(ip_address, port, timestamp, services)
+            AddressBook.addresses[node.key] = node
+            AddressBook.insert(AddressBook.new, node)
+            AddressBook.changed(node)
+            return node
 
-class BootstrapperThread(threading.Thread):
-    """
-    Runs a loop and disconnects from the current seed node whenever we either received the addresses
-    we want or the timeout is reached
-    """
-    def __init__(self, *args, **kwargs):
-        super(BootstrapperThread, self).__init__(*args, **kwargs)
-        self.seed_client = None
+    @staticmethod
+    def insert(table, node):
+        """Put the node in its bucket of the table, making room if it's full"""
+        bucket = table.get_bucket(node)
+        if table.is_full(bucket):
+            if table is AddressBook.new:
+                # The address which failed the most, or was seen the longest ago
+                victim = min(table.buckets[bucket], key=lambda n: (-n.attempts, n.time))
+                table.remove(victim)
+                del AddressBook.addresses[victim.key]
+                if AddressBook.store is not None:
+                    AddressBook.dirty[victim.key] = None
+            else:
+                # The peer which worked the longest ago
+                victim = min(table.buckets[bucket], key=lambda n: n.last_success)
+                table.remove(victim)
+                AddressBook.insert(AddressBook.new, victim)
+                AddressBook.changed(victim)
+        table.add(node, bucket)
+
+    @staticmethod
+    def remove(node):
+        with AddressBook.lock:
+            if node.table is not None:
+                node.table.remove(node)
+            AddressBook.addresses.pop(node.key, None)
+            if AddressBook.store is not None:
+                AddressBook.dirty[node.key] = None
+
+    @staticmethod
+    def select(exclude=()):
+        """Pick a node to connect to, or return None if there's none we can try now. A few random nodes of either
+        table are compared, and the one with the best score is picked, so the time taken doesn't depend on the
+        number of addresses.
+
+        :param exclude: Nodes not to pick, e.g. those we're connected to
+        """
+        now = time.time()
+        with AddressBook.lock:
+            for i in range(AddressBook.SELECT_TRIES):
+                if len(AddressBook.tried) > 0 and \
+                        (len(AddressBook.new) == 0 or random.random() < AddressBook.TRIED_RATIO):
+                    table = AddressBook.tried
+                elif len(AddressBook.new) > 0:
+                    table = AddressBook.new
+                else:
+                    return None
+                best = None
+                best_score = 0
+                for j in range(AddressBook.SAMPLE_SIZE):
+                    node = table.random()
+                    if node in exclude or AddressBook.is_banned(node.ip_address, now):
+                        continue
+                    score = node.get_score(now)
+                    if score > best_score:
+                        best = node
+                        best_score = score
+                if best is not None:
+                    return best
+        return None
+
+    @staticmethod
+    def attempt(node):
+        with AddressBook.lock:
+            node.last_attempt = time.time()
+
+    @staticmethod
+    def connected(node, latency):
+        """Record a successful connection, which moves the node to the tried table"""
+        with AddressBook.lock:
+            node.connected(latency)
+            if node.table is AddressBook.new:
+                AddressBook.new.remove(node)
+                AddressBook.insert(AddressBook.tried, node)
+            AddressBook.changed(node)
+
+    @staticmethod
+    def failed(node):
+        """Record a failed connection attempt. Addresses which haven't worked in a long time are forgotten."""
+        with AddressBook.lock:
+            node.failed()
+            if node.attempts >= AddressBook.MAX_FAILURES and \
+                    time.time() - node.last_success >= AddressBook.MAX_SILENCE:
+                AddressBook.remove(node)
+            else:
+                AddressBook.changed(node)
+
+    @staticmethod
+    def delivered(node, size, seconds):
+        """Record a block of `size` bytes, which the peer took `seconds` to deliver"""
+        with AddressBook.lock:
+            node.delivered(size, seconds)
+
+    @staticmethod
+    def stalled(node):
+        """Record a request the peer didn't answer in time"""
+        with AddressBook.lock:
+            node.stalled()
+
+    @staticmethod
+    def misbehaved(node, score):
+        """Add to the ban score of the node, and ban its IP address once it reaches `BAN_SCORE`. Returns whether it
+        was banned."""
+        with AddressBook.lock:
+            node.ban_score += score
+            if node.ban_score < AddressBook.BAN_SCORE:
+                return False
+            logger.warning("Banning node '%s' for misbehaving" % node.ip_address)
+            node.ban_score = 0
+            AddressBook.banned[node.ip_address] = time.time() + AddressBook.BAN_TIME
+            if AddressBook.store is not None:
+                AddressBook.dirty_bans.append(node.ip_address)
+        return True
+
+    @staticmethod
+    def is_banned(ip_address, now=None):
+        until = AddressBook.banned.get(ip_address)
+        if until is None:
+            return False
+        if (now if now is not None else time.time()) < until:
+            return True
+        del AddressBook.banned[ip_address]
+        return False
+
+    @staticmethod
+    def changed(node):
+        """Mark the node to be saved by the next `save`"""
+        with AddressBook.lock:
+            if AddressBook.store is not None and node.table is not None:
+                AddressBook.dirty[node.key] = node
+
+    @staticmethod
+    def open(path=None):
+        """Load the addresses saved by earlier runs, and save them to the same file from now on. Does nothing if
+        the book is already open.
+
+        :param path: The address file, by default `ADDRESS_FILE`
+        """
+        with AddressBook.lock:
+            if AddressBook.store is not None:
+                return
+            path = path if path is not None else AddressBook.ADDRESS_FILE
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            store = AddressStore(path)
+            loaded = store.load()
+            rehash = False
+            if loaded is not None:
+                key, records = loaded
+                # Addresses added before, if any, are already in buckets picked with our key
+                rehash = len(AddressBook.addresses) > 0
+                if not rehash:
+                    AddressBook.key = AddressBook.new.key = AddressBook.tried.key = key
+                AddressBook.restore(records, rehash)
+            AddressBook.store = store
+            if loaded is None or rehash or AddressBook.is_outdated():
+                AddressBook.store.rewrite(AddressBook.key, AddressBook.get_records())
+
+    @staticmethod
+    def restore(records, rehash):
+        """Add the addresses and bans of the records of an AddressStore"""
+        # The last record of each address or ban, keyed by IP address and port
+        latest = {(record[1], record[2]): record for record in records}
+        addresses = AddressBook.addresses
+        now = time.time()
+        for record in latest.values():
+            kind = record[0]
+            if kind == AddressStore.BANNED:
+                if record[4] > now:
+                    AddressBook.banned[socket.inet_ntoa(record[1])] = record[4]
+                continue
+            if kind == AddressStore.REMOVED:
+                continue
+            node, bucket = AddressStore.from_record(record)
+            key = (node.ip_address, node.port)
+            if key in addresses:
+                continue
+            table = AddressBook.tried if kind == AddressStore.TRIED else AddressBook.new
+            addresses[key] = node
+            if rehash or bucket >= table.bucket_count or table.is_full(bucket):
+                AddressBook.insert(table, node)
+            else:
+                table.add(node, bucket)
+
+    @staticmethod
+    def get_records():
+        """The AddressStore records of the whole book"""
+        records = [AddressStore.to_record(node, AddressStore.NEW) for node in AddressBook.new.nodes]
+        records.extend(AddressStore.to_record(node, AddressStore.TRIED) for node in AddressBook.tried.nodes)
+        records.extend(AddressStore.to_ban_record(ip_address, until)
+            for ip_address, until in AddressBook.banned.items())
+        return records
+
+    @staticmethod
+    def is_outdated():
+        """Whether most of the records of the address file are outdated"""
+        live = len(AddressBook.addresses) + len(AddressBook.banned)
+        return AddressBook.store.count > 2 * live + AddressBook.MAX_OUTDATED_RECORDS
+
+    @staticmethod
+    def save():
+        """Append the addresses which changed since the last save to the address file, or rewrite it if it's
+        mostly outdated"""
+        with AddressBook.lock:
+            if AddressBook.store is None or len(AddressBook.dirty) + len(AddressBook.dirty_bans) == 0:
+                return
+            records = []
+            for key, node in AddressBook.dirty.items():
+                if node is None:
+                    records.append(AddressStore.to_removal_record(key))
+                elif node.table is not None:
+                    kind = AddressStore.TRIED if node.table is AddressBook.tried else AddressStore.NEW
+                    records.append(AddressStore.to_record(node, kind))
+            for ip_address in AddressBook.dirty_bans:
+                until = AddressBook.banned.get(ip_address)
+                if until is not None:
+                    records.append(AddressStore.to_ban_record(ip_address, until))
+            AddressBook.dirty.clear()
+            del AddressBook.dirty_bans[:]
+
+            AddressBook.store.append(records)
+            if AddressBook.is_outdated():
+                AddressBook.store.rewrite(AddressBook.key, AddressBook.get_records())
 
     def run(self):
-        timeout = datetime.now() + timedelta(seconds=40)
+        """Ask the seed nodes for more addresses whenever we run low"""
         while True:
-            time.sleep(1)
-
-            if len(AddressBook.addresses) > 0:
-                # Ah, we've got some addresses, disconnect from the seed node and stop
-                try:
-                    if self.seed_client is not None:
-                        self.seed_client.disconnect()
-                except socket.error:
-                    # The client may have already disconnected for some reason, or other error
-                    pass
+            if AddressBook.needs_seeds():
+                asyncio.run(AddressBook.query_seeds())
+                AddressBook.save()
+            time.sleep(AddressBook.SEED_INTERVAL)
+
+class ConnectionManager(object):
+    """Keeps `target` outbound connections open, to the best peers of the AddressBook.
+
+    The connection attempts are recorded in the address book, along with the time it took to connect, which
+    decides the peers we'll prefer next time. Every `EVICT_INTERVAL` seconds, when all the connections are open,
+    the peer delivering blocks the slowest is disconnected if it's far behind the others, to make room for a
+    better one.
+
+    :param connect: A coroutine function called with a Node, which returns the connected client. It raises OSError
+                    or asyncio.TimeoutError if the connection fails.
+    """
+
+    TARGET = 8
+
+    EVICT_INTERVAL = 60 * 2
+
+    # A peer delivering blocks at less than this fraction of the median rate of the connected peers is evicted
+    SLOW_RATIO = 0.25
+
+    def __init__(self, connect, target=TARGET):
+        self.connect = connect
+        self.target = target
+        # The nodes being connected to
+        self.connecting = set()
+        # Node -> client of the open connections
+        self.clients = {}
+        self.last_eviction = time.time()
+
+    def __len__(self):
+        return len(self.clients)
+
+    async def maintain(self):
+        """Start connecting to new peers until `target` connections are open or being opened. The tasks live for as
+        long as their connection."""
+        missing = self.target - len(self.connecting) - len(self.clients)
+        if missing <= 0:
+            return
+        if AddressBook.needs_seeds():
+            await AddressBook.query_seeds()
+        exclude = self.connecting.union(self.clients)
+        for i in range(missing):
+            node = AddressBook.select(exclude)
+            if node is None:
                 return
+            exclude.add(node)
+            self.connecting.add(node)
+            asyncio.ensure_future(self.run_connection(node))
+
+    async def run_connection(self, node):
+        AddressBook.attempt(node)
+        started = time.time()
+        try:
+            client = await self.connect(node)
+        except (OSError, asyncio.TimeoutError) as e:
+            logger.info("Connection to node '%s' failed: %s" % (node.ip_address, e))
+            AddressBook.failed(node)
+            return
+        finally:
+            self.connecting.discard(node)
+        AddressBook.connected(node, time.time() - started)
+        self.clients[node] = client
+        try:
+            await client.wait_closed()
+        finally:
+            del self.clients[node]
+            # Save the rate at which it delivered blocks
+            AddressBook.changed(node)
 
-            if datetime.now() > timeout:
-                # Give up on the current seed node client and try the next one
-                try:
-                    if self.seed_client is not None:
-                        self.seed_client.disconnect()
-                except socket.error:
-                    # The client may have already disconnected for some reason, or other error
-                    pass
-                timeout = datetime.now() + timedelta(seconds=10)
+    def evict_slowest(self):
+        """Disconnect the slowest peer if it's far behind the others. Returns whether one was evicted."""
+        now = time.time()
+        if len(self.clients) < self.target or now - self.last_eviction < self.EVICT_INTERVAL:
+            return False
+        measured = sorted((node for node in self.clients if node.bandwidth is not None), key=lambda n: n.bandwidth)
+        if len(measured) < self.target // 2:
+            return False
+        slowest = measured[0]
+        if slowest.bandwidth >= measured[len(measured) // 2].bandwidth * self.SLOW_RATIO:
+            return False
+        logger.info("Disconnecting from slow node '%s' (%d bytes/s)" % (slowest.ip_address, slowest.bandwidth))
+        self.last_eviction = now
+        self.clients[slowest].disconnect()
+        return True
@@ -0,0 +1,494 @@
+"""Benchmarks for the hot paths of the client. Run from this directory with:
+
+    python benchmark.py [name [arguments]]
+
+Without a name, all benchmarks are run with their default arguments."""
+from datetime import datetime
+from io import BytesIO
+import random
+import sys
+import time
+import os
+
+import django
+
+# Configure Django settings and load the models before importing local code
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "db.settings")
+django.setup()
+
+from datatypes import messages, structures, values
+
+BENCHMARKS = {}
+
+def benchmark(func):
+    """Register a benchmark function by name"""
+    BENCHMARKS[func.__name__] = func
+    return func
+
+def report(name, count, unit, seconds):
+    print("%-30s %10d %s in %7.3fs (%12.1f %s/s)" % (name, count, unit, seconds, count / seconds, unit))
+
+def random_hash():
+    return random.getrandbits(256).to_bytes(32, 'little')
+
+def random_transaction(input_count=2, output_count=2):
+    return messages.Transaction(
+        version=1,
+        inputs=[structures.Input(
+            previous_output=structures.OutPoint(out_hash=random_hash(), index=random.randint(0, 3)),
+            signature_script=bytes(random.getrandbits(8) for _ in range(107)),
+            sequence=0xFFFFFFFF,
+        ) for _ in range(input_count)],
+        outputs=[structures.Output(
+            value=random.randint(0, 50 * 100000000),
+            pubkey_script=b'\x76\xa9\x14' + bytes(random.getrandbits(8) for _ in range(20)) + b'\x88\xac',
+        ) for _ in range(output_count)],
+        lock_time=0,
+    )
+
+def to_wire(message, coin="bitcoin"):
+    """Serialize a message with its header, as it would be sent over the wire"""
+    payload = BytesIO()
+    message.serialize(payload)
+    payload = payload.getvalue()
+    header = structures.MessageHeader(
+        command=message.command,
+        length=len(payload),
+        checksum=structures.MessageHeader.calc_checksum(payload),
+    )
+    header.set_coin(coin)
+    stream = BytesIO()
+    header.serialize(stream)
+    stream.write(payload)
+    return stream.getvalue()
+
+class RecordedSocket(object):
+    """Replays recorded wire data through recv_into, in chunks of the given size"""
+    def __init__(self, data, chunk_size=1024*8):
+        self._data = memoryview(data)
+        self._position = 0
+        self._chunk_size = chunk_size
+
+    def recv_into(self, buffer):
+        size = min(len(buffer), self._chunk_size, len(self._data) - self._position)
+        buffer[:size] = self._data[self._position:self._position + size]
+        self._position += size
+        return size
+
+@benchmark
+def framing(path=None, megabytes=8):
+    """Feed a recorded stream of raw wire data through the receive buffer and deserialize each message. If no
+    recording is given, a stream of small inv and tx messages (the worst case for framing) is generated."""
+    from net.buffer import MessageBuffer, PayloadStream
+    from net import messaging
+
+    if path is not None:
+        with open(path, 'rb') as f:
+            data = f.read()
+    else:
+        inv = to_wire(messages.InventoryVector(inventory=[
+            structures.Inventory(inv_type=values.INVENTORY_TYPE["MSG_TX"], inv_hash=random_hash())
+        ]))
+        txs = [to_wire(random_transaction()) for _ in range(100)]
+        chunks = []
+        size = 0
+        while size < int(megabytes) * 1024 * 1024:
+            for tx in txs:
+                chunks.append(inv)
+                chunks.append(tx)
+                size += len(inv) + len(tx)
+        data = b''.join(chunks)
+
+    sock = RecordedSocket(data)
+    buffer = MessageBuffer()
+    count = 0
+    start = time.time()
+    while buffer.recv_from(sock) > 0:
+        while True:
+            frame = buffer.next_frame()
+            if frame is None:
+                break
+            header, payload = frame
+            structures.MessageHeader.calc_checksum(payload)
+            messaging.deserialize(header.command, PayloadStream(payload))
+            payload.release()
+            count += 1
+    seconds = time.time() - start
+    report("framing", count, "messages", seconds)
+    report("framing", len(data) // 1024, "KiB", seconds)
+
+def read_block_file(path):
+    """Read raw blocks from a blk*.dat file as written by the reference client: records of 4 magic bytes, the
+    length as a 32-bit little-endian integer and the serialized block"""
+    blocks = []
+    with open(path, 'rb') as f:
+        while True:
+            record_header = f.read(8)
+            if len(record_header) < 8 or record_header[:4] == b'\x00' * 4:
+                return blocks
+            length = int.from_bytes(record_header[4:], 'little')
+            blocks.append(f.read(length))
+
+def make_block(transactions, **kwargs):
+    """Return a Block with the given transactions. The Django model only takes its own fields as arguments, and
+    leaves the timestamp None rather than using the serializer's default, so both are set here."""
+    from db.models import Block
+    kwargs.setdefault('timestamp', datetime.utcnow().replace(microsecond=0))
+    block = Block(**kwargs)
+    block.transactions = transactions
+    return block
+
+def random_block(transaction_count=500):
+    from util.merkle import merkle_root
+    transactions = [random_transaction() for _ in range(transaction_count)]
+    block = make_block(
+        transactions,
+        version=2,
+        prev_hash=random_hash(),
+        merkle_root=merkle_root([t.txid for t in transactions]),
+        bits=values.HIGHEST_TARGET_BITS,
+        nonce=random.getrandbits(32),
+    )
+    stream = BytesIO()
+    block.serialize(stream)
+    return stream.getvalue()
+
+def load_blocks(path=None, count=20):
+    """Load raw blocks from a blk*.dat file, or generate them"""
+    if path is not None:
+        return read_block_file(path)[:int(count)]
+    return [random_block() for _ in range(int(count))]
+
+@benchmark
+def parsing(path=None, count=20):
+    """Deserialize blocks, including all their transactions. Pass the path of a blk*.dat file from the reference
+    client to parse real blocks; otherwise blocks of 500 random transactions are generated."""
+    from db.models import Block
+
+    raw_blocks = load_blocks(path, count)
+
+    # Only the header is needed to validate and link a block
+    start = time.time()
+    for raw_block in raw_blocks:
+        Block(stream=BytesIO(raw_block)).calculate_hash()
+    report("parsing (header only)", len(raw_blocks), "blocks", time.time() - start)
+
+    transaction_count = 0
+    start = time.time()
+    for raw_block in raw_blocks:
+        block = Block(stream=BytesIO(raw_block))
+        for transaction in block.transactions:
+            transaction_count += 1
+    seconds = time.time() - start
+    report("parsing", len(raw_blocks), "blocks", seconds)
+    report("parsing", transaction_count, "transactions", seconds)
+
+@benchmark
+def merkle(path=None, count=20):
+    """Check the merkle roots of blocks, as on every block of the initial sync, then build and verify a merkle branch
+    of each transaction. Arguments as for the parsing benchmark."""
+    from db.models import Block
+    from util.merkle import merkle_branch, verify_branch
+    import validator
+
+    blocks = [Block(stream=BytesIO(raw_block)) for raw_block in load_blocks(path, count)]
+    # The transactions are parsed before the merkle root is checked during sync, when their scripts are verified
+    transaction_count = sum(len(list(block.transactions)) for block in blocks)
+
+    start = time.time()
+    for block in blocks:
+        assert validator.validate_transactions(block)
+    report("merkle (root)", transaction_count, "transactions", time.time() - start)
+
+    branches = []
+    start = time.time()
+    for block in blocks:
+        transaction_hashes = validator.get_transaction_hashes(block)
+        for index, transaction_hash in enumerate(transaction_hashes[:50]):
+            branches.append((transaction_hash, merkle_branch(transaction_hashes, index), index, block.merkle_root))
+    report("merkle (branch)", len(branches), "branches", time.time() - start)
+
+    start = time.time()
+    for transaction_hash, branch, index, root in branches:
+        assert verify_branch(transaction_hash, branch, index, root)
+    report("merkle (verify)", len(branches), "branches", time.time() - start)
+
+@benchmark
+def compact(mempool_size=20000, count=2000):
+    """Rebuild a block of `count` transactions from a compact block and a mempool holding most of them, as when a
+    new block arrives at the tip"""
+    from mempool import TransactionPool
+    import compactblocks
+
+    block = Block(stream=BytesIO(random_block(int(count))))
+    full = BytesIO()
+    block.serialize(full)
+    pool = TransactionPool(None)
+    # All but the last 5% of the transactions were relayed to us
+    for transaction in block.transactions[1:int(count) * 95 // 100]:
+        pool.add(transaction, 1000)
+    while len(pool) < int(mempool_size):
+        pool.add(messages.Transaction.from_stream(BytesIO(random_transaction().raw)), 1000)
+
+    message = compactblocks.create_compact_block(block)
+    compact = BytesIO()
+    message.serialize(compact)
+    print("%-30s %10d bytes instead of %d" % ("compact (size)", len(compact.getvalue()), len(full.getvalue())))
+
+    start = time.time()
+    partial = compactblocks.PartialBlock(message, pool)
+    report("compact (match mempool)", len(pool), "transactions", time.time() - start)
+
+    start = time.time()
+    partial.fill([block.transactions[i] for i in partial.missing])
+    assert partial.get_block().calculate_hash() == block.calculate_hash()
+    report("compact (rebuild)", len(block.transactions), "transactions", time.time() - start)
+
+@benchmark
+def memory(path=None, count=20):
+    """Measure the memory held by parsed transactions, as when they're kept in a mempool or a batch of blocks.
+    Arguments as for the parsing benchmark."""
+    import tracemalloc
+    from db.models import Block
+
+    raw_blocks = load_blocks(path, count)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    transactions = []
+    for raw_block in raw_blocks:
+        transactions.extend(Block(stream=BytesIO(raw_block)).transactions)
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    print("%-30s %10d transactions in %10d KiB (%12.1f bytes/transaction)" % (
+        "memory", len(transactions), size // 1024, size / len(transactions)))
+
+class AcceptingChecker(object):
+    """A signature checker which accepts all signatures, to benchmark the interpreter without the elliptic curve
+    math"""
+    def check_signature(self, signature, pubkey, script_code):
+        return True
+
+def standard_scripts():
+    """Return (name, signature script, pubkey script, redeem script) of standard script types, with random keys and
+    signatures"""
+    from script_opcodes import OP_0, OP_2, OP_3, OP_PUSHDATA1, OP_DUP, OP_HASH160, OP_EQUAL, OP_EQUALVERIFY, \
+        OP_CHECKSIG, OP_CHECKMULTISIG
+    from util.hashing import hash160
+
+    def push(data):
+        if len(data) < OP_PUSHDATA1:
+            return bytes([len(data)]) + data
+        return bytes([OP_PUSHDATA1, len(data)]) + data
+    def random_bytes(length):
+        return bytes(random.getrandbits(8) for _ in range(length))
+    signatures = [random_bytes(72) for _ in range(2)]
+    pubkeys = [b'\x02' + random_bytes(32) for _ in range(3)]
+
+    p2pkh = bytes([OP_DUP, OP_HASH160]) + push(hash160(pubkeys[0])) + bytes([OP_EQUALVERIFY, OP_CHECKSIG])
+    multisig = bytes([OP_2]) + b''.join(push(pubkey) for pubkey in pubkeys) + bytes([OP_3, OP_CHECKMULTISIG])
+    multisig_signatures = bytes([OP_0]) + b''.join(push(signature) for signature in signatures)
+    p2sh = bytes([OP_HASH160]) + push(hash160(multisig)) + bytes([OP_EQUAL])
+    return [
+        ("p2pkh", push(signatures[0]) + push(pubkeys[0]), p2pkh, None),
+        ("multisig", multisig_signatures, multisig, None),
+        ("p2sh", multisig_signatures + push(multisig), p2sh, multisig),
+    ]
+
+@benchmark
+def scripts(count=20000):
+    """Verify spends of standard P2PKH, bare multisig and P2SH multisig outputs. Signatures aren't checked."""
+    from script import verify_script
+
+    checker = AcceptingChecker()
+    for name, signature_script, pubkey_script, redeem_script in standard_scripts():
+        start = time.time()
+        for _ in range(int(count)):
+            assert verify_script(signature_script, pubkey_script, checker)
+        report("scripts (%s)" % name, int(count), "scripts", time.time() - start)
+
+def signed_transactions(count):
+    """Return a P2PKH pubkey script, and transactions with a single input validly spending it"""
+    import ecdsa
+    import signatures
+    from script_opcodes import OP_DUP, OP_HASH160, OP_EQUALVERIFY, OP_CHECKSIG
+    from util.hashing import hash160
+
+    key = ecdsa.SigningKey.generate(curve=ecdsa.SECP256k1)
+    pubkey = key.get_verifying_key().to_string("compressed")
+    pubkey_script = bytes([OP_DUP, OP_HASH160]) + signatures.push_data(hash160(pubkey)) + \
+        bytes([OP_EQUALVERIFY, OP_CHECKSIG])
+    transactions = []
+    for _ in range(int(count)):
+        transaction = random_transaction(1, 2)
+        digest = signatures.signature_hash(transaction, 0, pubkey_script, signatures.SIGHASH_ALL)
+        signature = key.sign_digest(digest, sigencode=ecdsa.util.sigencode_der_canonize)
+        transaction.inputs[0].signature_script = signatures.push_data(signature + bytes([signatures.SIGHASH_ALL])) + \
+            signatures.push_data(pubkey)
+        transactions.append(transaction)
+    return pubkey_script, transactions
+
+@benchmark
+def signatures(count=200):
+    """Verify P2PKH spends with each available signature backend, first uncached and then from the signature cache,
+    as when a block includes transactions which were verified in the mempool"""
+    import signatures
+
+    pubkey_script, transactions = signed_transactions(count)
+    for backend_class in signatures.BACKENDS:
+        try:
+            backend = backend_class()
+        except ImportError:
+            print("%-30s not installed" % ("signatures (%s)" % backend_class.name))
+            continue
+        cache = signatures.SignatureCache()
+        for run in ("uncached", "cached"):
+            start = time.time()
+            for transaction in transactions:
+                assert signatures.verify_input(transaction, 0, pubkey_script, backend, cache)
+            report("signatures (%s, %s)" % (backend.name, run), len(transactions), "inputs", time.time() - start)
+
+@benchmark
+def validation(workers=None, count=2000):
+    """Verify the scripts of blocks of signed transactions with the ScriptValidator, with 1 to `workers` processes"""
+    from validator import ScriptValidator
+    import signatures
+
+    pubkey_script, transactions = signed_transactions(count)
+    blocks = []
+    for i in range(0, len(transactions), 250):
+        blocks.append(make_block([random_transaction(0, 1)] + transactions[i:i + 250]))
+
+    max_workers = int(workers) if workers is not None else os.cpu_count()
+    worker_counts = sorted(set([1, max_workers] + [n for n in (2, 4, 8, 16, 32) if n < max_workers]))
+    for worker_count in worker_counts:
+        # Forked workers would inherit the signatures cached by the previous run
+        signatures.cache.clear()
+        validator = ScriptValidator(worker_count)
+        start = time.time()
+        assert all(validator.validate(blocks, lambda out_hash, index: pubkey_script))
+        report("validation (%d workers)" % worker_count, len(transactions), "inputs", time.time() - start)
+        validator.close()
+
+@benchmark
+def inventory(count=50000):
+    """Parse and serialize inv messages of block and transaction hashes, then look the hashes up, as when relaying"""
+    inventory = [structures.Inventory(inv_type=values.INVENTORY_TYPE["MSG_TX"], inv_hash=random_hash())
+        for _ in range(int(count))]
+    stream = BytesIO()
+    messages.InventoryVector(inventory=inventory).serialize(stream)
+    raw = stream.getvalue()
+
+    start = time.time()
+    message = messages.InventoryVector.from_stream(BytesIO(raw))
+    report("inventory (parse)", len(inventory), "entries", time.time() - start)
+
+    start = time.time()
+    messages.GetData(inventory=message.inventory).serialize(BytesIO())
+    report("inventory (serialize)", len(inventory), "entries", time.time() - start)
+
+    known = set(i.inv_hash for i in inventory[::2])
+    start = time.time()
+    missing = [i for i in message.inventory if i.inv_hash not in known]
+    report("inventory (lookup)", len(inventory), "entries", time.time() - start)
+    assert len(missing) == len(inventory) // 2
+
+    # The hashes announced by a peer, as remembered for relaying
+    from net.inventory import InventoryTracker, RollingBloomFilter
+    known = RollingBloomFilter(InventoryTracker.PEER_CAPACITY, InventoryTracker.PEER_FALSE_POSITIVE_RATE)
+    start = time.time()
+    for i in message.inventory:
+        known.add(i.inv_hash)
+    report("inventory (filter add)", len(inventory), "entries", time.time() - start)
+
+    start = time.time()
+    found = sum(1 for i in message.inventory[-InventoryTracker.PEER_CAPACITY:] if i.inv_hash in known)
+    report("inventory (filter lookup)", found, "entries", time.time() - start)
+
+@benchmark
+def mempool(count=50000):
+    """Add transactions with random fees to a full mempool, which evicts the lowest fee rates, then select the
+    transactions of a block and remove them, as when it's connected"""
+    from db.models import Block
+    from mempool import TransactionPool
+
+    # As received from peers
+    transactions = [messages.Transaction.from_stream(BytesIO(random_transaction().raw)) for _ in range(int(count))]
+    fees = [random.randint(1000, 100000) for _ in transactions]
+    # Holds about half of the transactions
+    pool = TransactionPool(None, max_size=sum(len(t.raw) for t in transactions) // 2)
+
+    start = time.time()
+    for transaction, fee in zip(transactions, fees):
+        pool.add(transaction, fee)
+        pool.trim()
+    report("mempool (add)", len(transactions), "transactions", time.time() - start)
+
+    start = time.time()
+    selected = pool.get_block_transactions()
+    report("mempool (select)", len(selected), "transactions", time.time() - start)
+
+    block = make_block([random_transaction(0, 1)] + selected)
+    start = time.time()
+    pool.remove_block(block)
+    report("mempool (remove)", len(selected), "transactions", time.time() - start)
+
+@benchmark
+def addresses(count=100000):
+    """Extract the addresses of a mix of standard pubkey scripts, as when indexing the outputs of the chain"""
+    from script import extract_addresses
+    from script_opcodes import OP_RETURN
+
+    pubkey_scripts = [pubkey_script for name, signature_script, pubkey_script, redeem_script in standard_scripts()]
+    pubkey_scripts.append(bytes([OP_RETURN, 4]) + b'data')
+    # Mostly unique P2PKH scripts, like in real blocks
+    outputs = [random_transaction(0, 1).outputs[0].pubkey_script for _ in range(int(count) * 8 // 10)]
+    outputs += [random.choice(pubkey_scripts) for _ in range(int(count) - len(outputs))]
+
+    start = time.time()
+    for pubkey_script in outputs:
+        extract_addresses(pubkey_script)
+    report("addresses", len(outputs), "outputs", time.time() - start)
+
+@benchmark
+def address_book(count=100000):
+    """Fill the address book with random peer addresses, then pick peers to connect to"""
+    from address import AddressBook
+
+    ip_addresses = ["%d.%d.%d.%d" % tuple(random.randrange(1, 255) for _ in range(4)) for _ in range(int(count))]
+    now = time.time()
+
+    start = time.time()
+    for ip_address in ip_addresses:
+        AddressBook.add(ip_address, 8333, now)
+    report("address book (add)", len(ip_addresses), "addresses", time.time() - start)
+
+    start = time.time()
+    for i in range(10000):
+        AddressBook.select()
+    report("address book (select)", 10000, "peers", time.time() - start)
+
+    import tempfile
+    from address import AddressTable
+    path = os.path.join(tempfile.mkdtemp(), "peers.dat")
+    start = time.time()
+    AddressBook.open(path)
+    report("address book (save)", len(AddressBook.addresses), "addresses", time.time() - start)
+
+    # Start over with an empty book, as after a restart
+    count = len(AddressBook.addresses)
+    AddressBook.addresses.clear()
+    AddressBook.new = AddressTable(AddressBook.NEW_BUCKET_COUNT, AddressBook.NEW_GROUP_BUCKETS, AddressBook.key)
+    AddressBook.tried = AddressTable(AddressBook.TRIED_BUCKET_COUNT, AddressBook.TRIED_GROUP_BUCKETS, AddressBook.key)
+    AddressBook.store = None
+    start = time.time()
+    AddressBook.open(path)
+    report("address book (load)", len(AddressBook.addresses), "addresses", time.time() - start)
+    assert len(AddressBook.addresses) == count
+    os.remove(path)
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        BENCHMARKS[sys.argv[1]](*sys.argv[2:])
+    else:
+        for name in sorted(BENCHMARKS):
+            BENCHMARKS[name]()
@@ -0,0 +1,198 @@
+from array import array
+import calendar
+
+from db.models import Block, InvalidBlock
+from util import compact
+from util.hashing import hex_to_hash
+
+#: Blocks deeper than this below the tip are final; forks from below it are ignored, and undo data isn't kept
+MAX_REORG_DEPTH = 1000
+
+class ChainIndex(object):
+    """An in-memory index of our best chain: the hash, bits, timestamp and cumulative work of every block, addressed
+    by height.
+
+    It's loaded once at startup and extended as blocks (or headers, when syncing headers first) are validated, so
+    locators and targets can be calculated without querying the database, and without waiting for buffered blocks
+    to be flushed.
+    """
+    def __init__(self):
+        self.hashes = []
+        self.bits = array('L')
+        self.timestamps = array('L') # Unix timestamps
+        self.chainwork = []
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def contains(self, header):
+        """Whether the header is on the indexed chain"""
+        return header.height < len(self.hashes) and self.hashes[header.height] == header.calculate_hash()
+
+    @property
+    def height(self):
+        """The height of the chain tip"""
+        return len(self.hashes) - 1
+
+    def load(self):
+        """Load the index of all saved blocks"""
+        self.__init__()
+        for block_hash, bits, timestamp in Block.objects.order_by('height').values_list(
+                'hash', 'bits', 'timestamp').iterator():
+            self.hashes.append(hex_to_hash(block_hash))
+            self.bits.append(bits)
+            self.timestamps.append(calendar.timegm(timestamp.utctimetuple()))
+        self.chainwork = compact.get_chainwork(self.bits)
+
+    def append(self, block):
+        """Add the block following the current tip"""
+        if block.height != len(self.hashes):
+            raise ValueError("Block #%s doesn't follow the chain tip #%s" % (block.height, self.height))
+        self.hashes.append(block.calculate_hash())
+        self.bits.append(block.bits)
+        self.timestamps.append(calendar.timegm(block.timestamp.utctimetuple()))
+        work = compact.bits_to_work(block.bits)
+        self.chainwork.append(self.chainwork[-1] + work if len(self.chainwork) > 0 else work)
+
+    def truncate(self, height):
+        """Remove the blocks above the given height, when switching to another branch"""
+        del self.hashes[height + 1:]
+        del self.bits[height + 1:]
+        del self.timestamps[height + 1:]
+        del self.chainwork[height + 1:]
+
+    def locator(self, height):
+        """Build a block locator from the given height, see https://en.bitcoin.it/wiki/Protocol_specification#getblocks.
+        The 10 last hashes are included, and then exponentially fewer, so this costs O(log n)."""
+        i = height
+        step = 1
+        hashes = []
+        while i >= 0:
+            hashes.append(self.hashes[i])
+            if i <= height - 10:
+                step *= 2
+            i -= step
+        return hashes
+
+class BlockTree(object):
+    """The headers of the last MAX_REORG_DEPTH blocks of our chain, and of all the branches forking from them.
+
+    Each header is kept with the cumulative work of its branch, counted from the oldest header in the tree, so the
+    tips of competing branches can be compared. Headers of other branches have their `height` and `prev_block` set,
+    but aren't saved. Blocks found invalid, and all their descendants, are never picked as the best tip.
+    """
+    def __init__(self, max_depth=MAX_REORG_DEPTH):
+        self.max_depth = max_depth
+        # Hash -> header
+        self.headers = {}
+        # Hash -> cumulative work
+        self.work = {}
+        # Hashes of the headers without children
+        self.tips = set()
+        # Hashes of the blocks found invalid, and of their descendants
+        self.invalid = set()
+
+    def __len__(self):
+        return len(self.headers)
+
+    def __contains__(self, block_hash):
+        return block_hash in self.headers
+
+    def get(self, block_hash):
+        return self.headers.get(block_hash)
+
+    def load(self):
+        """Load the headers of the last blocks of our saved chain, and the hashes of the blocks found invalid"""
+        self.__init__(self.max_depth)
+        self.invalid.update(hex_to_hash(h) for h in InvalidBlock.objects.values_list('hash', flat=True))
+        headers = list(Block.objects.defer('undo').order_by('-height')[:self.max_depth])
+        for header in reversed(headers):
+            self.add(header)
+
+    def add(self, header):
+        """Add a header, whose previous block must be in the tree unless the tree is empty"""
+        block_hash = header.calculate_hash()
+        self.headers[block_hash] = header
+        self.work[block_hash] = self.work.get(header.prev_hash, 0) + compact.bits_to_work(header.bits)
+        self.tips.discard(header.prev_hash)
+        self.tips.add(block_hash)
+        if header.prev_hash in self.invalid:
+            self.invalid.add(block_hash)
+
+    def invalidate(self, block_hash):
+        """Mark the block and its descendants in the tree invalid, and return the hashes which weren't already"""
+        invalid = {block_hash}
+        for tip_hash in self.tips:
+            branch = []
+            while tip_hash in self.headers and tip_hash not in invalid:
+                branch.append(tip_hash)
+                tip_hash = self.headers[tip_hash].prev_hash
+            if tip_hash in invalid:
+                invalid.update(branch)
+        invalid -= self.invalid
+        self.invalid.update(invalid)
+        return invalid
+
+    def get_best(self, current):
+        """Return the valid header with the most work, or the given current tip if no other has more work. The
+        candidates are the tips, and for tips which are invalid, their last valid ancestor."""
+        best_hash = current.calculate_hash()
+        for block_hash in self.tips:
+            while block_hash in self.invalid and block_hash in self.headers:
+                block_hash = self.headers[block_hash].prev_hash
+            if block_hash in self.headers and self.work[block_hash] > self.work[best_hash]:
+                best_hash = block_hash
+        return self.headers[best_hash]
+
+    def find_fork(self, a, b):
+        """Return the last common header of the branches of the two given headers"""
+        while a.calculate_hash() != b.calculate_hash():
+            if a.height >= b.height:
+                a = self.headers[a.prev_hash]
+            else:
+                b = self.headers[b.prev_hash]
+        return a
+
+    def get_branch(self, fork, tip):
+        """Return the headers following the fork up to the tip, in chain order"""
+        headers = []
+        fork_hash = fork.calculate_hash()
+        while tip.calculate_hash() != fork_hash:
+            headers.append(tip)
+            tip = self.headers[tip.prev_hash]
+        headers.reverse()
+        return headers
+
+    def prune(self, tip):
+        """Forget the headers which are too deep below the given tip to be reorganized"""
+        min_height = tip.height - self.max_depth
+        if min_height <= 0 or len(self.headers) <= self.max_depth:
+            return
+        for block_hash in [h for h, header in self.headers.items() if header.height < min_height]:
+            del self.headers[block_hash]
+            del self.work[block_hash]
+            self.tips.discard(block_hash)
+        # Branches forking from below the tree can't be completed anymore
+        for block_hash in list(self.tips):
+            header = self.headers[block_hash]
+            while header is not None and header.height > min_height:
+                header = self.headers.get(header.prev_hash)
+            if header is None:
+                self.remove_branch(block_hash)
+
+    def remove_branch(self, tip_hash):
+        """Remove the headers of the given tip which aren't shared with other branches"""
+        self.tips.discard(tip_hash)
+        shared = set()
+        for block_hash in self.tips:
+            while block_hash in self.headers and block_hash not in shared:
+                shared.add(block_hash)
+                block_hash = self.headers[block_hash].prev_hash
+        block_hash = tip_hash
+        while block_hash in self.headers and block_hash not in shared:
+            header = self.headers.pop(block_hash)
+            del self.work[block_hash]
+            block_hash = header.prev_hash
+
+#: The index of the chain we're working on. Load it before using it.
+index = ChainIndex()
@@ -1,8 +1,11 @@
 import time
 import os
 
-# Configure Django settings before importing local code
+import django
+
+# Configure Django settings and load the models before importing local code
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "db.settings")
+django.setup()
 
 from net.clients import BitcoinClient
 from datatypes import messages
@@ -0,0 +1,127 @@
+from io import BytesIO
+import hashlib
+
+from datatypes import messages, structures
+from datatypes.fields import varint
+from db.models import Block
+from util.merkle import merkle_root
+from util.siphash import siphash_hashes
+
+# Compact block relay, see https://github.com/bitcoin/bips/blob/master/bip-0152.mediawiki
+#
+# A compact block carries the header, a 6-byte short id of each transaction and a few prefilled transactions,
+# usually just the coinbase. The short ids are keyed with the header and a nonce, so they're different for each
+# block and peer, and collisions can't be planned. The receiver finds the transactions in its mempool, and only
+# requests the missing ones with getblocktxn.
+
+SHORT_ID_MASK = (1 << 48) - 1
+
+# A block can't hold more transactions than this; the smallest transactions are 60 bytes
+MAX_TRANSACTIONS = 1000000 // 60
+
+def get_short_id_keys(header, nonce):
+    """Return the SipHash keys of the short ids of a compact block, as two integers"""
+    stream = BytesIO()
+    header.serialize(stream)
+    stream.write(nonce.to_bytes(8, 'little'))
+    digest = hashlib.sha256(stream.getvalue()).digest()
+    return int.from_bytes(digest[0:8], 'little'), int.from_bytes(digest[8:16], 'little')
+
+def get_short_ids(keys, txids):
+    """Return the short ids of the given txids"""
+    return [value & SHORT_ID_MASK for value in siphash_hashes(keys[0], keys[1], txids)]
+
+def create_compact_block(block, nonce=None, prefilled=(0,)):
+    """Return the CmpctBlock message of the block, sending the transactions at the given indexes (by default the
+    coinbase) in full"""
+    header = structures.BlockHeader.from_stream(BytesIO(block.serialize_header()))
+    message = messages.CmpctBlock(header=header)
+    if nonce is not None:
+        message.nonce = nonce
+    keys = get_short_id_keys(header, message.nonce)
+    prefilled = set(prefilled)
+    previous = -1
+    txids = []
+    for index, transaction in enumerate(block.transactions):
+        if index in prefilled:
+            message.prefilled_transactions.append(
+                messages.PrefilledTransaction(index=index - previous - 1, transaction=transaction))
+            previous = index
+        else:
+            txids.append(transaction.txid)
+    message.short_ids = get_short_ids(keys, txids)
+    return message
+
+class PartialBlock(object):
+    """A block being reconstructed from a compact block and the transactions of our mempool.
+
+    The transactions which aren't in the mempool are listed in `missing`; request them with getblocktxn and pass
+    them to `fill`. Raises ValueError if the message is invalid or has colliding short ids, in which case the full
+    block should be requested instead.
+
+    :param mempool: The mempool, see mempool.TransactionPool
+    """
+    def __init__(self, message, mempool):
+        self.header = message.header
+        count = len(message.short_ids) + len(message.prefilled_transactions)
+        if count == 0 or count > MAX_TRANSACTIONS:
+            raise ValueError("Invalid compact block with %d transactions" % count)
+
+        self.transactions = [None] * count
+        index = -1
+        for prefilled in message.prefilled_transactions:
+            index += prefilled.index + 1
+            if index >= count:
+                raise ValueError("Invalid prefilled transaction index %d" % index)
+            self.transactions[index] = prefilled.transaction
+
+        # Short id -> index, for the transactions which aren't prefilled
+        positions = {}
+        short_ids = iter(message.short_ids)
+        for index, transaction in enumerate(self.transactions):
+            if transaction is None:
+                positions[next(short_ids)] = index
+        if len(positions) < len(message.short_ids):
+            raise ValueError("The compact block has colliding short ids")
+
+        # Match the mempool. If several transactions have the same short id, it's left missing.
+        keys = get_short_id_keys(message.header, message.nonce)
+        txids = list(mempool.entries)
+        collided = set()
+        for txid, short_id in zip(txids, get_short_ids(keys, txids)):
+            index = positions.get(short_id)
+            if index is None or index in collided:
+                continue
+            if self.transactions[index] is not None:
+                self.transactions[index] = None
+                collided.add(index)
+                continue
+            self.transactions[index] = mempool.get(txid)
+
+        self.missing = [index for index, transaction in enumerate(self.transactions) if transaction is None]
+
+    def fill(self, transactions):
+        """Add the missing transactions, from a blocktxn message"""
+        if len(transactions) != len(self.missing):
+            raise ValueError("Expected %d transactions, got %d" % (len(self.missing), len(transactions)))
+        for index, transaction in zip(self.missing, transactions):
+            self.transactions[index] = transaction
+        self.missing = []
+
+    def get_block(self):
+        """Return the reconstructed block, or None if its transactions don't match the merkle root. That happens if
+        a mempool transaction had the short id of a block transaction, and the full block should be requested."""
+        if len(self.missing) > 0:
+            raise ValueError("%d transactions are missing" % len(self.missing))
+        if merkle_root([transaction.txid for transaction in self.transactions]) != self.header.merkle_root:
+            return None
+
+        # Parse the block from its serialization, like blocks received in full, so its transactions are kept in
+        # the block's data
+        stream = BytesIO()
+        self.header.serialize(stream)
+        varint.serialize(stream, len(self.transactions))
+        for transaction in self.transactions:
+            stream.write(transaction.raw)
+        stream.seek(0)
+        return Block(stream=stream)
@@ -1,5 +1,9 @@
 from logging.config import dictConfig
 import logging
+import os
+
+#: Where files other than the database are kept, like the address book. Set PITCOIN_DATA_DIR to override.
+DATA_DIR = os.environ.get("PITCOIN_DATA_DIR", os.path.join(os.path.expanduser("~"), ".pitcoin"))
 
 LOGGING = {
     'version': 1,
@@ -1,18 +1,30 @@
 import struct
 import socket
 import calendar
+from array import array
+from collections.abc import Sequence
 from datetime import datetime
+from io import BytesIO
 
 from .meta import BitcoinSerializable
 from . import values
 
 class PrimaryField(object):
+    """A fixed-width integer field. The struct format is exposed as `struct_format`, so adjacent fields can be
+    merged into a single struct by the compiled serializer (see meta.CompiledSerializer).
+
+    Variable-width fields instead implement `skip(data, offset)`, which returns the offset following the serialized
+    value starting at `offset` in the buffer, without deserializing it.
+    """
+    def __init__(self):
+        self.struct = struct.Struct(self.datatype)
+        self.struct_format = self.datatype
+
     def deserialize(self, stream):
-        data = stream.read(struct.calcsize(self.datatype))
-        return struct.unpack(self.datatype, data)[0]
+        return self.struct.unpack(stream.read(self.struct.size))[0]
 
     def serialize(self, stream, value):
-        stream.write(struct.pack(self.datatype, value))
+        stream.write(self.struct.pack(value))
 
 class Int32LEField(PrimaryField):
     """32-bit little-endian integer field."""
@@ -42,28 +54,43 @@ class UInt16BEField(PrimaryField):
     """16-bit big-endian unsigned integer field."""
     datatype = ">H"
 
+class BooleanField(PrimaryField):
+    """A boolean, serialized as a single byte."""
+    datatype = "<?"
+
 class DatetimeField(object):
     """A UTC unix timestamp, represented with an integer of varying datatype"""
     def __init__(self, int_serializer):
         self.int_serializer = int_serializer
+        self.struct_format = int_serializer.struct_format
 
-    def deserialize(self, stream):
-        int_value = self.int_serializer.deserialize(stream)
+    def from_struct(self, int_value):
         return datetime.utcfromtimestamp(int_value)
 
+    def to_struct(self, value):
+        return calendar.timegm(value.utctimetuple())
+
+    def deserialize(self, stream):
+        return self.from_struct(self.int_serializer.deserialize(stream))
+
     def serialize(self, stream, value):
-        int_value = calendar.timegm(value.utctimetuple())
-        self.int_serializer.serialize(stream, int_value)
+        self.int_serializer.serialize(stream, self.to_struct(value))
 
 class FixedStringField(object):
     """A fixed length encoded string field."""
     def __init__(self, length):
         self.length = length
+        self.struct_format = "<%ds" % length
+
+    def from_struct(self, data):
+        return data.split(b"\x00", 1)[0].decode(values.STRING_ENCODING)
+
+    def to_struct(self, value):
+        # struct pads and truncates to the fixed length
+        return value.encode(values.STRING_ENCODING)
 
     def deserialize(self, stream):
-        data = stream.read(self.length)
-        value = data.split(b"\x00", 1)[0]
-        return value[:self.length].decode(values.STRING_ENCODING)
+        return self.from_struct(stream.read(self.length))
 
     def serialize(self, stream, value):
         value = value.encode(values.STRING_ENCODING)
@@ -73,19 +100,20 @@ class ListField(object):
     """A field used to serialize/deserialize a list of fields. """
     def __init__(self, serialization_class, *args, **kwargs):
         self.serialization_class = serialization_class
+        self._item_size = None
+        self._item_skip = None
         super(ListField, self).__init__(*args, **kwargs)
 
     def deserialize(self, stream):
-        length = VariableIntegerField().deserialize(stream)
-        items = []
-        for i in range(length):
-            item = self.serialization_class()
-            item.deserialize(stream)
-            items.append(item)
-        return items
+        length = varint.deserialize(stream)
+        if issubclass(self.serialization_class, BitcoinSerializable):
+            reader = self.serialization_class.get_reader()
+            return [reader(stream) for i in range(length)]
+        serializer = self.serialization_class()
+        return [serializer.deserialize(stream) for i in range(length)]
 
     def serialize(self, stream, values):
-        VariableIntegerField().serialize(stream, len(values))
+        varint.serialize(stream, len(values))
         for value in values:
             if isinstance(value, BitcoinSerializable):
                 # This is a serializable, let the value itself handle serialization
@@ -95,31 +123,160 @@ class ListField(object):
                 serializer = self.serialization_class()
                 serializer.serialize(stream, value)
 
+    def skip(self, data, offset):
+        length, offset = varint.unpack_from(data, offset)
+        if self._item_size is None and self._item_skip is None:
+            self._find_item_skip()
+        if self._item_size is not None:
+            return offset + length * self._item_size
+        skip = self._item_skip
+        for i in range(length):
+            offset = skip(data, offset)
+        return offset
+
+    def _find_item_skip(self):
+        # Look up how to skip an item once, the first time it's needed
+        if issubclass(self.serialization_class, BitcoinSerializable):
+            serializer = self.serialization_class.get_serializer()
+            self._item_size = serializer.size
+        else:
+            serializer = self.serialization_class()
+            if hasattr(serializer, 'struct_format'):
+                self._item_size = struct.calcsize(serializer.struct_format)
+        self._item_skip = getattr(serializer, 'skip', None)
+
+class SharedBytesIO(BytesIO):
+    """A BytesIO over a bytes object, which also exposes a memoryview of it as `view`. Items read from it can keep a
+    slice of their serialized data without copying it, see messages.Transaction."""
+    def __init__(self, raw):
+        super().__init__(raw)
+        self.view = memoryview(raw)
+
+class LazyList(Sequence):
+    """A read-only list of serialized items, which are deserialized on first access. See LazyListField.
+
+    :param reader: Deserializes an item from a stream, see BitcoinSerializable.get_reader
+    :param raw: The serialized items
+    :param offsets: The offset of each item in `raw`, followed by the length of `raw`
+    """
+    def __init__(self, reader, raw, offsets):
+        self.raw = raw
+        self._reader = reader
+        self._offsets = offsets
+        self._items = [None] * (len(offsets) - 1)
+        self._stream = None
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        item = self._items[index]
+        if item is None:
+            if index < 0:
+                index += len(self)
+            if self._stream is None:
+                # BytesIO shares the bytes object instead of copying it
+                self._stream = SharedBytesIO(self.raw)
+            self._stream.seek(self._offsets[index])
+            item = self._reader(self._stream)
+            self._items[index] = item
+        return item
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def get_raw(self, index):
+        """Return the serialized data of the item at the given index"""
+        return self.raw[self._offsets[index]:self._offsets[index + 1]]
+
+    def __repr__(self):
+        return "<%s Count=[%d]>" % (self.__class__.__name__, len(self))
+
+class LazyListField(ListField):
+    """A list of BitcoinSerializables which aren't deserialized up front. The item boundaries are found in a single
+    pass over the serialized data, which is copied once and kept in a LazyList. This makes deserialization nearly
+    free when only some (or none) of the items are needed, like the transactions of a block when syncing headers
+    first.
+
+    The stream must support getbuffer(), tell() and seek(), like BytesIO and net.buffer.PayloadStream; otherwise
+    all items are deserialized as by ListField.
+    """
+    def deserialize(self, stream):
+        if not hasattr(stream, 'getbuffer'):
+            return super().deserialize(stream)
+        length = varint.deserialize(stream)
+        start = stream.tell()
+        data = stream.getbuffer()
+        skip = self.serialization_class.get_serializer().skip
+        offsets = array('L', [0])
+        offset = start
+        for i in range(length):
+            offset = skip(data, offset)
+            offsets.append(offset - start)
+        if offset > len(data):
+            raise ValueError("The list of %d items is truncated" % length)
+        raw = bytes(data[start:offset])
+        stream.seek(offset)
+        return LazyList(self.serialization_class.get_reader(), raw, offsets)
+
+    def serialize(self, stream, values):
+        if isinstance(values, LazyList):
+            varint.serialize(stream, len(values))
+            stream.write(values.raw)
+        else:
+            super().serialize(stream, values)
+
+class StructureField(object):
+    """A field holding a nested structure, i.e. another BitcoinSerializable."""
+    def __init__(self, structure_class):
+        self.structure_class = structure_class
+
+    def deserialize(self, stream):
+        return self.structure_class.get_reader()(stream)
+
+    def serialize(self, stream, value):
+        value.serialize(stream)
+
+    @property
+    def size(self):
+        """The serialized size, if the structure has a fixed size"""
+        return self.structure_class.get_serializer().size
+
+    def skip(self, data, offset):
+        return self.structure_class.get_serializer().skip(data, offset)
+
 class IPv4AddressField(object):
     """An IPv4 address field without timestamp and reserved IPv6 space."""
     reserved = b"\x00"*10 + b"\xff"*2
+    struct_format = "<16s"
+
+    def from_struct(self, data):
+        return socket.inet_ntoa(data[12:])
+
+    def to_struct(self, value):
+        return self.reserved + socket.inet_aton(value)
 
     def deserialize(self, stream):
-        unused_reserved = stream.read(12)
-        addr = stream.read(4)
-        return socket.inet_ntoa(addr)
+        return self.from_struct(stream.read(16))
 
     def serialize(self, stream, value):
-        stream.write(self.reserved)
-        stream.write(socket.inet_aton(value))
+        stream.write(self.to_struct(value))
 
 class VariableIntegerField(object):
     """A variable size integer field."""
     def deserialize(self, stream):
-        int_id_raw = stream.read(struct.calcsize("<B"))
-        int_id = struct.unpack("<B", int_id_raw)[0]
-        if int_id == 0xFD:
-            int_id = struct.unpack("<H", stream.read(2))[0]
+        int_id = stream.read(1)[0]
+        if int_id < 0xFD:
+            return int_id
+        elif int_id == 0xFD:
+            return int.from_bytes(stream.read(2), 'little')
         elif int_id == 0xFE:
-            int_id = struct.unpack("<I", stream.read(4))[0]
-        elif int_id == 0xFF:
-            int_id = struct.unpack("<Q", stream.read(8))[0]
-        return int(int_id)
+            return int.from_bytes(stream.read(4), 'little')
+        else:
+            return int.from_bytes(stream.read(8), 'little')
 
     def serialize(self, stream, value):
         if value < 0xFD:
@@ -132,41 +289,113 @@ class VariableIntegerField(object):
             data = struct.pack("<B", 0xFF) + struct.pack("<Q", value)
         stream.write(data)
 
+    def unpack_from(self, data, offset):
+        """Return the integer at the given offset in the buffer, and the offset following it"""
+        int_id = data[offset]
+        if int_id < 0xFD:
+            return int_id, offset + 1
+        elif int_id == 0xFD:
+            return int.from_bytes(data[offset + 1:offset + 3], 'little'), offset + 3
+        elif int_id == 0xFE:
+            return int.from_bytes(data[offset + 1:offset + 5], 'little'), offset + 5
+        else:
+            return int.from_bytes(data[offset + 1:offset + 9], 'little'), offset + 9
+
+    def skip(self, data, offset):
+        return self.unpack_from(data, offset)[1]
+
+# Stateless, so a single instance is shared
+varint = VariableIntegerField()
+
 class VariableByteStringField(object):
     """A variable length bytestring field."""
     def deserialize(self, stream):
-        length = VariableIntegerField().deserialize(stream)
+        length = varint.deserialize(stream)
         return stream.read(length)
 
     def serialize(self, stream, value):
-        VariableIntegerField().serialize(stream, len(value))
+        varint.serialize(stream, len(value))
         stream.write(value)
 
+    def skip(self, data, offset):
+        length = data[offset]
+        if length < 0xFD:
+            return offset + 1 + length
+        length, offset = varint.unpack_from(data, offset)
+        return offset + length
+
 class VariableStringField(object):
     """A variable length encoded string field."""
     def deserialize(self, stream):
-        length = VariableIntegerField().deserialize(stream)
+        length = varint.deserialize(stream)
         return stream.read(length).decode(values.STRING_ENCODING)
 
     def serialize(self, stream, value):
-        VariableIntegerField().serialize(stream, len(value))
+        varint.serialize(stream, len(value))
         stream.write(value.encode(values.STRING_ENCODING))
 
+    def skip(self, data, offset):
+        length = data[offset]
+        if length < 0xFD:
+            return offset + 1 + length
+        length, offset = varint.unpack_from(data, offset)
+        return offset + length
+
+class ShortIdListField(object):
+    """A list of the 6-byte short transaction ids of compact blocks (BIP 152), as integers. They're read in one
+    go, since a block has thousands."""
+    SIZE = 6
+
+    def deserialize(self, stream):
+        length = varint.deserialize(stream)
+        data = stream.read(length * self.SIZE)
+        if len(data) < length * self.SIZE:
+            raise ValueError("The list of %d short ids is truncated" % length)
+        return [int.from_bytes(data[i:i + self.SIZE], 'little') for i in range(0, len(data), self.SIZE)]
+
+    def serialize(self, stream, values):
+        varint.serialize(stream, len(values))
+        stream.write(b"".join(value.to_bytes(self.SIZE, 'little') for value in values))
+
+    def skip(self, data, offset):
+        length, offset = varint.unpack_from(data, offset)
+        return offset + length * self.SIZE
+
+class DifferentialIndexListField(object):
+    """An ascending list of indexes, each encoded as a varint of its difference to the previous index, minus one
+    (BIP 152)"""
+    def deserialize(self, stream):
+        length = varint.deserialize(stream)
+        indexes = []
+        index = -1
+        for i in range(length):
+            index += varint.deserialize(stream) + 1
+            indexes.append(index)
+        return indexes
+
+    def serialize(self, stream, values):
+        varint.serialize(stream, len(values))
+        previous = -1
+        for index in values:
+            if index <= previous:
+                raise ValueError("The indexes must be ascending")
+            varint.serialize(stream, index - previous - 1)
+            previous = index
+
+    def skip(self, data, offset):
+        length, offset = varint.unpack_from(data, offset)
+        for i in range(length):
+            offset = varint.skip(data, offset)
+        return offset
+
 class Hash(object):
-    """A hash type field."""
-    datatype = "<I"
+    """A hash type field; a 256-bit little-endian integer, kept as its raw 32 bytes. The bytes are compared and
+    hashed at C speed, so they're used as dict keys as they are, and parsing them costs nothing beyond the read.
+    See util.hashing.hash_to_hex and hex_to_hash for the hex representation."""
+    struct_format = "<32s"
 
     def deserialize(self, stream):
-        data_size = struct.calcsize(self.datatype)
-        intvalue = 0
-        for i in range(8):
-            data = stream.read(data_size)
-            val = struct.unpack(self.datatype, data)[0]
-            intvalue += val << (i * 32)
-        return "{:064x}".format(intvalue)
+        return stream.read(32)
 
     def serialize(self, stream, value):
-        value = int(value, 16)
-        for i in range(8):
-            stream.write(struct.pack(self.datatype, value & 0xFFFFFFFF))
-            value >>= 32
+        stream.write(value)
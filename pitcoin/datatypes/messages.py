@@ -1,23 +1,24 @@
 import time
 import random
 from datetime import datetime
+from io import BytesIO
+
+from util.hashing import sha256d, hash_to_hex, NULL_HASH
 
 from .meta import Field, BitcoinSerializable
 from . import structures, values, fields
 
 class Version(BitcoinSerializable):
     command = "version"
-    def __init__(self, *args, **kwargs):
-        self._fields = [
-            Field('version', fields.Int32LEField(), default=values.PROTOCOL_VERSION),
-            Field('services', fields.UInt64LEField(), default=values.SERVICES["NODE_NETWORK"]),
-            Field('timestamp', fields.DatetimeField(fields.Int64LEField()), default=lambda: datetime.utcnow()),
-            Field('addr_recv', structures.IPv4Address()),
-            Field('addr_from', structures.IPv4Address()),
-            Field('nonce', fields.UInt64LEField(), default=lambda: random.randint(0, 2**32-1)),
-            Field('user_agent', fields.VariableStringField(), default="/Perone:0.0.1/"),
-        ]
-        super().__init__(*args, **kwargs)
+    _fields = [
+        Field('version', fields.Int32LEField(), default=values.PROTOCOL_VERSION),
+        Field('services', fields.UInt64LEField(), default=values.SERVICES["NODE_NETWORK"]),
+        Field('timestamp', fields.DatetimeField(fields.Int64LEField()), default=lambda: datetime.utcnow()),
+        Field('addr_recv', fields.StructureField(structures.IPv4Address), default=structures.IPv4Address),
+        Field('addr_from', fields.StructureField(structures.IPv4Address), default=structures.IPv4Address),
+        Field('nonce', fields.UInt64LEField(), default=lambda: random.randint(0, 2**32-1)),
+        Field('user_agent', fields.VariableStringField(), default="/Perone:0.0.1/"),
+    ]
 
     def _services_to_text(self):
         """Converts the services field into a textual
@@ -39,39 +40,30 @@ class Version(BitcoinSerializable):
 class VerAck(BitcoinSerializable):
     """The version acknowledge (verack) command."""
     command = "verack"
-    def __init__(self, *args, **kwargs):
-        self._fields = []
-        super().__init__(*args, **kwargs)
 
 class Ping(BitcoinSerializable):
     command = "ping"
-    def __init__(self, *args, **kwargs):
-        self._fields = [
-            Field('nonce', fields.UInt64LEField(), default=lambda: random.randint(0, 2**32-1)),
-        ]
-        super().__init__(*args, **kwargs)
+    _fields = [
+        Field('nonce', fields.UInt64LEField(), default=lambda: random.randint(0, 2**32-1)),
+    ]
 
     def __repr__(self):
         return "<%s Nonce=[%d]>" % (self.__class__.__name__, self.nonce)
 
 class Pong(BitcoinSerializable):
     command = "pong"
-    def __init__(self, *args, **kwargs):
-        self._fields = [
-            Field('nonce', fields.UInt64LEField(), default=lambda: random.randint(0, 2**32-1)),
-        ]
-        super().__init__(*args, **kwargs)
+    _fields = [
+        Field('nonce', fields.UInt64LEField(), default=lambda: random.randint(0, 2**32-1)),
+    ]
 
     def __repr__(self):
         return "<%s Nonce=[%d]>" % (self.__class__.__name__, self.nonce)
 
 class InventoryVector(BitcoinSerializable):
     command = "inv"
-    def __init__(self, *args, **kwargs):
-        self._fields = [
-            Field('inventory', fields.ListField(structures.Inventory), default=[]),
-        ]
-        super().__init__(*args, **kwargs)
+    _fields = [
+        Field('inventory', fields.ListField(structures.Inventory), default=list),
+    ]
 
     def __repr__(self):
         return "<%s Count=[%d]>" % (self.__class__.__name__, len(self))
@@ -84,11 +76,9 @@ class InventoryVector(BitcoinSerializable):
 
 class AddressVector(BitcoinSerializable):
     command = "addr"
-    def __init__(self, *args, **kwargs):
-        self._fields = [
-            Field('addresses', fields.ListField(structures.IPv4AddressTimestamp), default=[]),
-        ]
-        super().__init__(*args, **kwargs)
+    _fields = [
+        Field('addresses', fields.ListField(structures.IPv4AddressTimestamp), default=list),
+    ]
 
     def __repr__(self):
         return "<%s Count=[%d]>" % (self.__class__.__name__, len(self))
@@ -101,35 +91,88 @@ class AddressVector(BitcoinSerializable):
 
 class GetData(BitcoinSerializable):
     command = "getdata"
-    def __init__(self, *args, **kwargs):
-        self._fields = [
-            Field('inventory', fields.ListField(structures.Inventory), default=[]),
-        ]
-        super().__init__(*args, **kwargs)
+    _fields = [
+        Field('inventory', fields.ListField(structures.Inventory), default=list),
+    ]
 
 class NotFound(BitcoinSerializable):
     command = "notfound"
-    def __init__(self, *args, **kwargs):
-        self._fields = [
-            Field('inventory', fields.ListField(structures.Inventory), default=[]),
-        ]
-        super().__init__(*args, **kwargs)
+    _fields = [
+        Field('inventory', fields.ListField(structures.Inventory), default=list),
+    ]
 
     def __repr__(self):
         return "<%s Inv Count[%d]>" % (self.__class__.__name__, len(self.inventory))
 
 class Transaction(BitcoinSerializable):
-    """The main transaction representation, this object will contain all the inputs and outputs of the transaction."""
+    """The main transaction representation, this object will contain all the inputs and outputs of the transaction.
+
+    A parsed transaction keeps the bytes it was read from, which are written out as they are when it's serialized
+    again, and caches its txid. The transactions of a block keep a memoryview into the block's data instead of a
+    copy. Parsed transactions must not be modified.
+    """
     command = "tx"
+    _fields = [
+        Field('version', fields.UInt32LEField(), default=0),
+        Field('inputs', fields.ListField(structures.Input), default=list),
+        Field('outputs', fields.ListField(structures.Output), default=list),
+        Field('lock_time', fields.UInt32LEField(), default=0),
+    ]
+    __slots__ = tuple(field.name for field in _fields) + ('_raw', '_txid')
+
     def __init__(self, *args, **kwargs):
-        self._fields = [
-            Field('version', fields.UInt32LEField(), default=0),
-            Field('inputs', fields.ListField(structures.Input), default=[]),
-            Field('outputs', fields.ListField(structures.Output), default=[]),
-            Field('lock_time', fields.UInt32LEField(), default=0),
-        ]
+        self._raw = None
+        self._txid = None
         super().__init__(*args, **kwargs)
 
+    def deserialize(self, stream):
+        """Deserialize the transaction, keeping its serialized bytes if the stream is seekable"""
+        tell = getattr(stream, 'tell', None)
+        start = tell() if tell is not None else None
+        self.get_serializer().deserialize(self, stream)
+        self._raw = None
+        self._txid = None
+        if start is not None:
+            end = tell()
+            view = getattr(stream, 'view', None)
+            if view is not None:
+                self._raw = view[start:end]
+            else:
+                # Read the bytes again instead of slicing the stream's buffer: BytesIO.getbuffer() copies the whole
+                # buffer when it's shared, and message payloads are views into the receive buffer, which is reused
+                stream.seek(start)
+                self._raw = stream.read(end - start)
+        return self
+
+    def serialize(self, stream, value=None):
+        if self._raw is not None:
+            stream.write(self._raw)
+        else:
+            self.get_serializer().serialize(self, stream)
+
+    @property
+    def raw(self):
+        """The serialized transaction, as bytes or a memoryview"""
+        if self._raw is not None:
+            return self._raw
+        stream = BytesIO()
+        self.get_serializer().serialize(self, stream)
+        return stream.getvalue()
+
+    @property
+    def txid(self):
+        """The transaction hash, which outputs are referenced by. Cached for parsed transactions."""
+        if self._txid is not None:
+            return self._txid
+        txid = sha256d(self.raw)
+        if self._raw is not None:
+            self._txid = txid
+        return txid
+
+    def calculate_hash(self):
+        """Return the transaction hash (txid), see `txid`"""
+        return self.txid
+
     def _locktime_to_text(self):
         """Converts the lock-time to textual representation."""
         text = "Unknown"
@@ -145,47 +188,94 @@ class Transaction(BitcoinSerializable):
         return "<%s Version=[%d] Lock Time=[%s] Inputs=[%d] Outputs=[%d]>" \
             % (self.__class__.__name__, self.version, self._locktime_to_text(), len(self.inputs), len(self.outputs))
 
-class HeaderVector(BitcoinSerializable):
-    """The header only vector."""
-    command = "headers"
-    def __init__(self, *args, **kwargs):
-        from db.models import Block
-        self._fields = [
-            Field('headers', fields.ListField(Block), default=[]),
-        ]
-        super().__init__(*args, **kwargs)
-
-    def __repr__(self):
-        return "<%s Count=[%d]>" % (self.__class__.__name__, len(self))
-
-    def __len__(self):
-        return len(self.headers)
-
-    def __iter__(self):
-        return iter(self.headers)
-
 class MemPool(BitcoinSerializable):
     command = "mempool"
-    def __init__(self, *args, **kwargs):
-        self._fields = []
-        super().__init__(*args, **kwargs)
 
 class GetAddr(BitcoinSerializable):
     command = "getaddr"
-    def __init__(self, *args, **kwargs):
-        self._fields = []
-        super().__init__(*args, **kwargs)
 
 class GetBlocks(BitcoinSerializable):
     command = "getblocks"
-    def __init__(self, *args, **kwargs):
-        self._fields = [
-            Field('version', fields.UInt32LEField(), values.PROTOCOL_VERSION),
-            Field('block_locator_hashes', fields.ListField(fields.Hash), default=[]),
-            Field('hash_stop', fields.Hash(), default="{:064x}".format(0)),
-        ]
-        super().__init__(*args, **kwargs)
+    _fields = [
+        Field('version', fields.UInt32LEField(), values.PROTOCOL_VERSION),
+        Field('block_locator_hashes', fields.ListField(fields.Hash), default=list),
+        Field('hash_stop', fields.Hash(), default=NULL_HASH),
+    ]
 
     def __repr__(self):
         return "<%s Version=[%d] HashCount=[%d]>" % \
             (self.__class__.__name__, self.version, len(self.block_locator_hashes))
+
+class GetHeaders(BitcoinSerializable):
+    command = "getheaders"
+    _fields = [
+        Field('version', fields.UInt32LEField(), values.PROTOCOL_VERSION),
+        Field('block_locator_hashes', fields.ListField(fields.Hash), default=list),
+        Field('hash_stop', fields.Hash(), default=NULL_HASH),
+    ]
+
+    def __repr__(self):
+        return "<%s Version=[%d] HashCount=[%d]>" % \
+            (self.__class__.__name__, self.version, len(self.block_locator_hashes))
+
+class SendHeaders(BitcoinSerializable):
+    """Asks the peer to announce new blocks with headers instead of inv (BIP 130)"""
+    command = "sendheaders"
+
+class FeeFilter(BitcoinSerializable):
+    """Asks the peer not to announce transactions below the given fee rate (BIP 133)"""
+    command = "feefilter"
+    _fields = [
+        Field('fee_rate', fields.UInt64LEField(), default=0),
+    ]
+
+#
+# Compact block relay, see https://github.com/bitcoin/bips/blob/master/bip-0152.mediawiki and compactblocks.py
+#
+
+class SendCmpct(BitcoinSerializable):
+    """Tells the peer we support compact blocks of the given version. With `announce`, new blocks are announced
+    with cmpctblock messages right away (high bandwidth mode), otherwise they're requested with getdata."""
+    command = "sendcmpct"
+    _fields = [
+        Field('announce', fields.BooleanField(), default=False),
+        Field('version', fields.UInt64LEField(), default=1),
+    ]
+
+class PrefilledTransaction(BitcoinSerializable):
+    """A transaction sent in full with a compact block. The index is differentially encoded: it's the difference to
+    the index of the previous prefilled transaction, minus one."""
+    _fields = [
+        Field('index', fields.VariableIntegerField(), default=0),
+        Field('transaction', fields.StructureField(Transaction), default=Transaction),
+    ]
+
+class CmpctBlock(BitcoinSerializable):
+    """A block with its transactions replaced by short ids, except the prefilled ones. See compactblocks.py."""
+    command = "cmpctblock"
+    _fields = [
+        Field('header', fields.StructureField(structures.BlockHeader), default=structures.BlockHeader),
+        Field('nonce', fields.UInt64LEField(), default=lambda: random.getrandbits(64)),
+        Field('short_ids', fields.ShortIdListField(), default=list),
+        Field('prefilled_transactions', fields.ListField(PrefilledTransaction), default=list),
+    ]
+
+    def __repr__(self):
+        return "<%s Hash=[%s] Short Ids=[%d] Prefilled=[%d]>" % (self.__class__.__name__,
+            hash_to_hex(self.header.calculate_hash()), len(self.short_ids), len(self.prefilled_transactions))
+
+class GetBlockTxn(BitcoinSerializable):
+    """Requests the transactions of a compact block at the given indexes"""
+    command = "getblocktxn"
+    _fields = [
+        Field('block_hash', fields.Hash(), default=NULL_HASH),
+        Field('indexes', fields.DifferentialIndexListField(), default=list),
+    ]
+
+class BlockTxn(BitcoinSerializable):
+    """The transactions requested by getblocktxn, in the order of their indexes"""
+    command = "blocktxn"
+    _fields = [
+        Field('block_hash', fields.Hash(), default=NULL_HASH),
+        Field('transactions', fields.ListField(Transaction), default=list),
+    ]
@@ -1,3 +1,5 @@
+import struct
+
 from django.db import models
 
 class Field(object):
@@ -8,7 +10,140 @@ class Field(object):
         self.serializer = serializer
         self.default = default
 
+class StructStep(object):
+    """A run of adjacent fixed-width fields, read and written with a single precompiled struct.
+
+    Fixed-width serializers define `struct_format`, the byte order followed by the struct format of the field, and
+    optionally `from_struct` and `to_struct` to convert the unpacked value.
+    """
+    def __init__(self, fields):
+        fmt = fields[0].serializer.struct_format[0] + "".join(f.serializer.struct_format[1:] for f in fields)
+        self.struct = struct.Struct(fmt)
+        self.size = self.struct.size
+        self.names = [f.name for f in fields]
+        self.from_struct = [getattr(f.serializer, 'from_struct', None) for f in fields]
+        self.to_struct = [getattr(f.serializer, 'to_struct', None) for f in fields]
+
+    def unpack(self, obj, data):
+        """Set the fields of obj from the raw data"""
+        values = self.struct.unpack(data)
+        for name, from_struct, value in zip(self.names, self.from_struct, values):
+            setattr(obj, name, value if from_struct is None else from_struct(value))
+
+    def pack(self, obj):
+        """Return the raw data of the fields of obj"""
+        values = []
+        for name, to_struct in zip(self.names, self.to_struct):
+            value = getattr(obj, name)
+            values.append(value if to_struct is None else to_struct(value))
+        return self.struct.pack(*values)
+
+    def deserialize(self, obj, stream):
+        self.unpack(obj, stream.read(self.size))
+
+    def serialize(self, obj, stream):
+        stream.write(self.pack(obj))
+
+class FieldStep(object):
+    """A single variable-width field, handled by its own serializer"""
+    def __init__(self, field):
+        self.name = field.name
+        self.serializer = field.serializer
+
+    def deserialize(self, obj, stream):
+        setattr(obj, self.name, self.serializer.deserialize(stream))
+
+    def serialize(self, obj, stream):
+        self.serializer.serialize(stream, getattr(obj, self.name))
+
+class CompiledSerializer(object):
+    """The serializer of a BitcoinSerializable class, generated once per class from its fields.
+
+    Adjacent fixed-width fields with the same byte order are merged into one StructStep, so e.g. a block header is
+    read with a single read() and struct.unpack call. The steps are then compiled into straight-line `deserialize`
+    and `serialize` functions, avoiding the per-field loops and lookups when processing millions of objects.
+
+    `skip(data, offset)` returns the offset following the object serialized at the given offset in a buffer, without
+    deserializing it. If all fields are fixed-width, or nested structures of fixed size, `size` is the serialized
+    size, otherwise None.
+    """
+    def __init__(self, fields):
+        self.steps = []
+        run = []
+        for field in fields:
+            fmt = getattr(field.serializer, 'struct_format', None)
+            if fmt is not None and (len(run) == 0 or run[0].serializer.struct_format[0] == fmt[0]):
+                run.append(field)
+                continue
+            if len(run) > 0:
+                self.steps.append(StructStep(run))
+            if fmt is not None:
+                run = [field]
+            else:
+                run = []
+                self.steps.append(FieldStep(field))
+        if len(run) > 0:
+            self.steps.append(StructStep(run))
+        # Nested structures of fixed size, like the outpoint of an input, count as fixed-width too
+        sizes = [step.size if isinstance(step, StructStep) else getattr(step.serializer, 'size', None)
+            for step in self.steps]
+        self.size = sum(sizes) if None not in sizes else None
+        self.deserialize, self.serialize, self.skip = self._compile()
+
+    def _compile(self):
+        namespace = {}
+        read_lines = ["def deserialize(obj, stream):", "    read = stream.read"]
+        write_lines = ["def serialize(obj, stream):", "    write = stream.write"]
+        skip_lines = ["def skip(data, offset):"]
+        # Sizes of fixed-width fields are summed up and added at once
+        fixed_size = 0
+        for i, step in enumerate(self.steps):
+            if isinstance(step, StructStep):
+                namespace['struct%d' % i] = step.struct
+                names = ['value%d_%d' % (i, j) for j in range(len(step.names))]
+                read_lines.append("    %s, = struct%d.unpack(read(%d))" % (", ".join(names), i, step.size))
+                arguments = []
+                for j, name in enumerate(step.names):
+                    if step.from_struct[j] is None:
+                        read_lines.append("    obj.%s = %s" % (name, names[j]))
+                        arguments.append("obj.%s" % name)
+                    else:
+                        namespace['from_struct%d_%d' % (i, j)] = step.from_struct[j]
+                        namespace['to_struct%d_%d' % (i, j)] = step.to_struct[j]
+                        read_lines.append("    obj.%s = from_struct%d_%d(%s)" % (name, i, j, names[j]))
+                        arguments.append("to_struct%d_%d(obj.%s)" % (i, j, name))
+                write_lines.append("    write(struct%d.pack(%s))" % (i, ", ".join(arguments)))
+                fixed_size += step.size
+            else:
+                namespace['deserialize%d' % i] = step.serializer.deserialize
+                namespace['serialize%d' % i] = step.serializer.serialize
+                read_lines.append("    obj.%s = deserialize%d(stream)" % (step.name, i))
+                write_lines.append("    serialize%d(stream, obj.%s)" % (i, step.name))
+                if getattr(step.serializer, 'size', None) is not None:
+                    # A nested structure of fixed size
+                    fixed_size += step.serializer.size
+                else:
+                    namespace['skip%d' % i] = step.serializer.skip
+                    skip_lines.append("    offset = skip%d(data, offset + %d)" % (i, fixed_size))
+                    fixed_size = 0
+        skip_lines.append("    return offset + %d" % fixed_size)
+        exec("\n".join(read_lines), namespace)
+        exec("\n".join(write_lines), namespace)
+        exec("\n".join(skip_lines), namespace)
+        return namespace['deserialize'], namespace['serialize'], namespace['skip']
+
+
 class BitcoinSerializable(object):
+    """Base class of messages and structures. Subclasses define their `_fields` as a class attribute; the
+    serializer is compiled from them the first time the class is (de)serialized.
+
+    Structures which are held in large numbers, like transactions and their inputs and outputs, define
+    `__slots__ = tuple(field.name for field in _fields)`, so instances don't carry a __dict__.
+    """
+
+    __slots__ = ()
+    _fields = []
+
     def __init__(self, *args, **kwargs):
         """Deserialize the model from the given stream, or instantiate with the given arguments"""
 
@@ -39,15 +174,52 @@ class BitcoinSerializable(object):
                     else:
                         setattr(self, field.name, field.default())
 
+    @classmethod
+    def get_serializer(cls):
+        """Return the compiled serializer of this class"""
+        # Look in the class' own dict; a subclass must not use the serializer of its parent
+        serializer = cls.__dict__.get('_serializer')
+        if serializer is None:
+            serializer = CompiledSerializer(cls._fields)
+            cls._serializer = serializer
+        return serializer
+
+    @classmethod
+    def get_reader(cls):
+        """Return a function which deserializes a new instance from the given stream. Unlike `cls(stream=stream)`,
+        the default values aren't set first, and plain structures skip __init__ altogether. Look the reader up once
+        when reading many objects."""
+        reader = cls.__dict__.get('_reader')
+        if reader is None:
+            if issubclass(cls, models.Model):
+                def reader(stream):
+                    return cls(stream=stream)
+            elif cls.deserialize is not BitcoinSerializable.deserialize:
+                def reader(stream):
+                    obj = cls.__new__(cls)
+                    obj.deserialize(stream)
+                    return obj
+            else:
+                deserialize = cls.get_serializer().deserialize
+                def reader(stream):
+                    obj = cls.__new__(cls)
+                    deserialize(obj, stream)
+                    return obj
+            cls._reader = reader
+        return reader
+
+    @classmethod
+    def from_stream(cls, stream):
+        """Deserialize a new instance from the given stream, see get_reader"""
+        return cls.get_reader()(stream)
+
     def deserialize(self, stream):
         """Deserialize this model from the given stream"""
-        for field in self._fields:
-            setattr(self, field.name, field.serializer.deserialize(stream))
+        self.get_serializer().deserialize(self, stream)
         return self
 
     def serialize(self, stream, value=None):
         """Serialize the current data in this model to the given stream. Note that we're
         ignoring the value paramenter which is used by nested fields, but not needed since
         this is a model structure and not a field."""
-        for field in self._fields:
-            field.serializer.serialize(stream, getattr(self, field.name))
+        self.get_serializer().serialize(self, stream)
@@ -1,20 +1,19 @@
-import hashlib
 import struct
 from datetime import datetime
+from io import BytesIO
 
 from .meta import Field, BitcoinSerializable
 from . import fields, values
+from util.hashing import sha256d, hash_to_hex, NULL_HASH
 
 class MessageHeader(BitcoinSerializable):
     """The header of all bitcoin messages."""
-    def __init__(self, *args, **kwargs):
-        self._fields = [
-            Field('magic', fields.UInt32LEField(), default=values.MAGIC_VALUES['bitcoin']),
-            Field('command', fields.FixedStringField(length=12)),
-            Field('length', fields.UInt32LEField(), default=0),
-            Field('checksum', fields.UInt32LEField(), default=0),
-        ]
-        super().__init__(*args, **kwargs)
+    _fields = [
+        Field('magic', fields.UInt32LEField(), default=values.MAGIC_VALUES['bitcoin']),
+        Field('command', fields.FixedStringField(length=12)),
+        Field('length', fields.UInt32LEField(), default=0),
+        Field('checksum', fields.UInt32LEField(), default=0),
+    ]
 
     def set_coin(self, coin):
         self.magic = values.MAGIC_VALUES[coin]
@@ -40,20 +39,36 @@ class MessageHeader(BitcoinSerializable):
 
         :param payload: The binary data payload.
         """
-        sha256hash = hashlib.sha256(payload)
-        sha256hash = hashlib.sha256(sha256hash.digest())
-        checksum = sha256hash.digest()[:4]
+        checksum = sha256d(payload)[:4]
         return struct.unpack("<I", checksum)[0]
 
+class BlockHeader(BitcoinSerializable):
+    """A block header on its own, as in compact blocks. Headers are otherwise db.models.Block instances."""
+    _fields = [
+        Field('version', fields.UInt32LEField(), default=0),
+        Field('prev_hash', fields.Hash(), default=NULL_HASH),
+        Field('merkle_root', fields.Hash(), default=NULL_HASH),
+        Field('timestamp', fields.DatetimeField(fields.UInt32LEField()), default=lambda: datetime.utcnow()),
+        Field('bits', fields.UInt32LEField(), default=0),
+        Field('nonce', fields.UInt32LEField(), default=0),
+    ]
+
+    def calculate_hash(self):
+        stream = BytesIO()
+        self.serialize(stream)
+        return sha256d(stream.getvalue())
+
+    def __repr__(self):
+        return "<%s Version=[%d] Timestamp=[%s] Hash=[%s]>" % \
+            (self.__class__.__name__, self.version, self.timestamp, hash_to_hex(self.calculate_hash()))
+
 class IPv4Address(BitcoinSerializable):
     """The IPv4 Address (without timestamp)."""
-    def __init__(self, *args, **kwargs):
-        self._fields = [
-            Field('services', fields.UInt64LEField(), default=values.SERVICES["NODE_NETWORK"]),
-            Field('ip_address', fields.IPv4AddressField(), default="0.0.0.0"),
-            Field('port', fields.UInt16BEField(), default=8333),
-        ]
-        super().__init__(*args, **kwargs)
+    _fields = [
+        Field('services', fields.UInt64LEField(), default=values.SERVICES["NODE_NETWORK"]),
+        Field('ip_address', fields.IPv4AddressField(), default="0.0.0.0"),
+        Field('port', fields.UInt16BEField(), default=8333),
+    ]
 
     def _services_to_text(self):
         """Convert the services field into a textual representation"""
@@ -67,24 +82,21 @@ class IPv4Address(BitcoinSerializable):
 
 class IPv4AddressTimestamp(BitcoinSerializable):
     """The IPv4 Address with timestamp."""
-    def __init__(self, *args, **kwargs):
-        self._fields = [
-            Field('timestamp', fields.DatetimeField(fields.UInt32LEField()), default=lambda: datetime.utcnow()),
-            Field('address', IPv4Address()),
-        ]
-        super().__init__(*args, **kwargs)
+    _fields = [
+        Field('timestamp', fields.DatetimeField(fields.UInt32LEField()), default=lambda: datetime.utcnow()),
+        Field('address', fields.StructureField(IPv4Address), default=IPv4Address),
+    ]
 
     def __repr__(self):
         return "<%s Timestamp=[%s] Address=[%r]>" % (self.__class__.__name__, self.timestamp, self.address)
 
 class Inventory(BitcoinSerializable):
     """The Inventory representation."""
-    def __init__(self, *args, **kwargs):
-        self._fields = [
-            Field('inv_type', fields.UInt32LEField(), default=values.INVENTORY_TYPE["MSG_TX"]),
-            Field('inv_hash', fields.Hash(), default="{:064x}".format(0)),
-        ]
-        super().__init__(*args, **kwargs)
+    _fields = [
+        Field('inv_type', fields.UInt32LEField(), default=values.INVENTORY_TYPE["MSG_TX"]),
+        Field('inv_hash', fields.Hash(), default=NULL_HASH),
+    ]
+    __slots__ = tuple(field.name for field in _fields)
 
     def type_to_text(self):
         """Converts the inventory type to text representation."""
@@ -94,44 +106,41 @@ class Inventory(BitcoinSerializable):
         return "Unknown Type"
 
     def __repr__(self):
-        return "<%s Type=[%s] Hash=[%s]>" % (self.__class__.__name__, self.type_to_text(), self.inv_hash)
+        return "<%s Type=[%s] Hash=[%s]>" % (self.__class__.__name__, self.type_to_text(), hash_to_hex(self.inv_hash))
+
+class OutPoint(BitcoinSerializable):
+    """The reference to a transaction output, referenced by an input"""
+    _fields = [
+        Field('out_hash', fields.Hash(), default=NULL_HASH),
+        Field('index', fields.UInt32LEField(), default=0),
+    ]
+    __slots__ = tuple(field.name for field in _fields)
+
+    def __repr__(self):
+        return "<%s Index=[%d] Hash=[%s]>" % (self.__class__.__name__, self.index, hash_to_hex(self.out_hash))
 
 class Input(BitcoinSerializable):
     """The input of a transaction; a coinbase (generated) input or reference to an output"""
-    def __init__(self, *args, **kwargs):
-        self._fields = [
-            Field('previous_output', OutPoint()),
-            Field('signature_script', fields.VariableByteStringField(), default=b""),
-            Field('sequence', fields.UInt32LEField(), default=0),
-        ]
-        super().__init__(*args, **kwargs)
+    _fields = [
+        Field('previous_output', fields.StructureField(OutPoint), default=OutPoint),
+        Field('signature_script', fields.VariableByteStringField(), default=b""),
+        Field('sequence', fields.UInt32LEField(), default=0),
+    ]
+    __slots__ = tuple(field.name for field in _fields)
 
     def __repr__(self):
         return "<%s Sequence=[%d]>" % (self.__class__.__name__, self.sequence)
 
 class Output(BitcoinSerializable):
     """The output of a transaction; the instructions for claiming the included bitcoins"""
-    def __init__(self, *args, **kwargs):
-        self._fields = [
-            Field('value', fields.Int64LEField(), default=0),
-            Field('pubkey_script', fields.VariableByteStringField(), default=b""),
-        ]
-        super().__init__(*args, **kwargs)
+    _fields = [
+        Field('value', fields.Int64LEField(), default=0),
+        Field('pubkey_script', fields.VariableByteStringField(), default=b""),
+    ]
+    __slots__ = tuple(field.name for field in _fields)
 
     def get_btc_value(self):
         return self.value//100000000 + self.value%100000000/100000000.0
 
     def __repr__(self):
         return "<%s Value=[%.8f]>" % (self.__class__.__name__, self.get_btc_value())
-
-class OutPoint(BitcoinSerializable):
-    """The reference to a transaction output, referenced by an input"""
-    def __init__(self, *args, **kwargs):
-        self._fields = [
-            Field('out_hash', fields.Hash(), default="{:064x}".format(0)),
-            Field('index', fields.UInt32LEField(), default=0),
-        ]
-        super().__init__(*args, **kwargs)
-
-    def __repr__(self):
-        return "<%s Index=[%d] Hash=[%s]>" % (self.__class__.__name__, self.index, self.out_hash)
@@ -1,5 +1,8 @@
 #: The protocol version
-PROTOCOL_VERSION = 60002
+PROTOCOL_VERSION = 70014
+
+#: The lowest protocol version supporting compact blocks, see BIP 152
+SHORT_IDS_BLOCKS_VERSION = 70014
 
 #: The network magic values
 MAGIC_VALUES = {
@@ -11,6 +14,12 @@ MAGIC_VALUES = {
     "litecoin_testnet": 0xDCB7C1FC
 }
 
+#: The version bytes of base58 encoded addresses, by coin and script template
+ADDRESS_VERSIONS = {
+    "bitcoin":          {"pubkeyhash": 0x00, "scripthash": 0x05},
+    "bitcoin_testnet3": {"pubkeyhash": 0x6F, "scripthash": 0xC4},
+}
+
 #: The available services
 SERVICES = {
     "NODE_NETWORK": 0x1,
@@ -21,6 +30,8 @@ INVENTORY_TYPE = {
     "ERROR": 0,
     "MSG_TX": 1,
     "MSG_BLOCK": 2,
+    "MSG_FILTERED_BLOCK": 3,
+    "MSG_CMPCT_BLOCK": 4,
 }
 
 # Highest block hash target, difficulty 1. See https://en.bitcoin.it/wiki/Difficulty
@@ -1,20 +1,75 @@
-# -*- coding: utf-8 -*-
-from south.utils import datetime_utils as datetime
-from south.db import db
-from south.v2 import SchemaMigration
-from django.db import models
+from datetime import datetime
 
+from django.db import migrations, models
+import db.models
 
-class Migration(SchemaMigration):
+def add_genesis_block(apps, schema_editor):
+    Block = apps.get_model('db', 'Block')
+    Block.objects.create(
+        version=1,
+        prev_hash='0000000000000000000000000000000000000000000000000000000000000000',
+        merkle_root='4a5e1e4baab89f3a32518a88c31bc87f618f76673e2cc77ab2127b7afdeda33b',
+        timestamp=datetime.utcfromtimestamp(1296688602),
+        bits=486604799,
+        nonce=414098458,
+        height=0,
+        prev_block=None,
+        # The historical model doesn't have the methods to calculate it
+        hash='000000000933ea01ad0ee984209779baaec3ced90fa3f408719526f8d77f4943',
+    )
 
-    def forwards(self, orm):
-        pass
+def remove_genesis_block(apps, schema_editor):
+    apps.get_model('db', 'Block').objects.all().delete()
 
-    def backwards(self, orm):
-        pass
+class Migration(migrations.Migration):
+    """The schema of the South migrations this replaces. Databases migrated with them already have it; apply this
+    with `migrate --fake-initial`, see README.md."""
 
-    models = {
-        
-    }
+    initial = True
 
-    complete_apps = ['db']
\ No newline at end of file
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Block',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.IntegerField()),
+                ('prev_hash', db.models.HashField(db_index=True, max_length=64)),
+                ('merkle_root', db.models.HashField(max_length=64)),
+                ('timestamp', models.DateTimeField()),
+                ('bits', models.BigIntegerField()),
+                ('nonce', models.BigIntegerField()),
+                ('height', models.IntegerField(db_index=True)),
+                ('header_only', models.BooleanField(default=False)),
+                ('hash', db.models.HashField(db_index=True, max_length=64)),
+                ('undo', models.BinaryField(null=True)),
+                ('prev_block', models.ForeignKey(null=True, on_delete=models.CASCADE, to='db.Block')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='InvalidBlock',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hash', db.models.HashField(max_length=64, unique=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='UnspentOutput',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('out_hash', db.models.HashField(db_index=True, max_length=64)),
+                ('index', models.IntegerField()),
+                ('value', models.BigIntegerField()),
+                ('pubkey_script', models.BinaryField()),
+                ('height', models.IntegerField()),
+                ('coinbase', models.BooleanField(default=False)),
+                ('address', models.CharField(db_index=True, max_length=35, null=True)),
+            ],
+            options={
+                'unique_together': {('out_hash', 'index')},
+            },
+        ),
+        migrations.RunPython(add_genesis_block, remove_genesis_block),
+    ]
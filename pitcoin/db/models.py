@@ -1,14 +1,41 @@
 from datetime import datetime
-from io import BytesIO
-import hashlib
-import binascii
 
-from django.db import models
+from django.db import models, connection, transaction
 
 from datatypes.messages import Transaction
 from datatypes.meta import Field, BitcoinSerializable
 from datatypes import fields
 from util import compact
+from util.hashing import sha256d, hash_to_hex, hex_to_hash
+
+class HashField(models.CharField):
+    """A hash, saved as its hex string. Loaded values are hex strings, which models convert as they're set."""
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('max_length', 64)
+        super().__init__(*args, **kwargs)
+
+    def get_prep_value(self, value):
+        if isinstance(value, bytes):
+            return hash_to_hex(value)
+        return super().get_prep_value(value)
+
+class BlockManager(models.Manager):
+    def bulk_insert(self, blocks):
+        """Insert the given blocks with a single query in one transaction. The blocks must be in chain order, and
+        their `prev_block` must either be saved or be one of the other given blocks. Unlike bulk_create, the primary
+        keys are set on the given blocks, so they can be referenced afterwards."""
+        if len(blocks) == 0:
+            return
+        with transaction.atomic():
+            # Reserve primary keys up front so the blocks can reference each other
+            cursor = connection.cursor()
+            cursor.execute("SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)",
+                [self.model._meta.db_table, len(blocks)])
+            for block, (pk,) in zip(blocks, cursor.fetchall()):
+                block.pk = pk
+                block.prev_block_id = block.prev_block.pk
+                block.hash = block.calculate_hash()
+            self.bulk_create(blocks)
 
 class Block(BitcoinSerializable, models.Model):
     #
@@ -16,8 +43,8 @@ class Block(BitcoinSerializable, models.Model):
     # https://en.bitcoin.it/wiki/Protocol_specification#block
     #
     version = models.IntegerField()
-    prev_hash = models.CharField(max_length=64)
-    merkle_root = models.CharField(max_length=64)
+    prev_hash = HashField(db_index=True)
+    merkle_root = HashField()
     timestamp = models.DateTimeField()
     bits = models.BigIntegerField()
     nonce = models.BigIntegerField()
@@ -27,10 +54,23 @@ class Block(BitcoinSerializable, models.Model):
     #
 
     # Height is this blocks' current count in the blockchain
-    height = models.IntegerField()
+    height = models.IntegerField(db_index=True)
+
+    # A direct reference to the previous block. ONLY the genesis block can have NULL!
+    prev_block = models.ForeignKey('db.Block', null=True, on_delete=models.CASCADE)
+
+    # True if only the header is validated and saved, while the full block is yet to be downloaded and validated
+    header_only = models.BooleanField(default=False)
 
-    # A direct reference to the previous block
-    prev_block = models.ForeignKey('db.Block', null=True) # ONLY the genesis block can have NULL!
+    # The block hash, as calculated from the header fields above. It's saved to look blocks up by hash, and loaded
+    # to avoid calculating it again.
+    hash = HashField(db_index=True)
+
+    # The serialized changes to the UTXO set made by this block, needed to disconnect it in a reorg (see
+    # utxo.BlockUndo). Only kept for recent blocks.
+    undo = models.BinaryField(null=True)
+
+    objects = BlockManager()
 
     #
     # Serialization-data
@@ -38,30 +78,66 @@ class Block(BitcoinSerializable, models.Model):
 
     command = "block"
 
-    def __init__(self, *args, **kwargs):
-        self._fields = [
-            Field('version', fields.UInt32LEField(), default=0),
-            Field('prev_hash', fields.Hash()),
-            Field('merkle_root', fields.Hash()),
-            Field('timestamp', fields.DatetimeField(fields.UInt32LEField()), default=lambda: datetime.utcnow()),
-            Field('bits', fields.UInt32LEField(), default=0),
-            Field('nonce', fields.UInt32LEField(), default=0),
-            Field('transactions', fields.ListField(Transaction), default=[]),
-        ]
-        super().__init__(*args, **kwargs)
+    HEADER_FIELDS = ('version', 'prev_hash', 'merkle_root', 'timestamp', 'bits', 'nonce')
+    HASH_FIELDS = ('prev_hash', 'merkle_root', 'hash')
+    HEADER_SIZE = 80
+
+    _fields = [
+        Field('version', fields.UInt32LEField(), default=0),
+        Field('prev_hash', fields.Hash()),
+        Field('merkle_root', fields.Hash()),
+        Field('timestamp', fields.DatetimeField(fields.UInt32LEField()), default=lambda: datetime.utcnow()),
+        Field('bits', fields.UInt32LEField(), default=0),
+        Field('nonce', fields.UInt32LEField(), default=0),
+        Field('transactions', fields.LazyListField(Transaction), default=list),
+    ]
+
+    def __setattr__(self, name, value):
+        # Hashes loaded from the db are hex strings
+        if name in Block.HASH_FIELDS and isinstance(value, str) and value:
+            value = hex_to_hash(value)
+        # The raw header and hash are cached until a header field changes. A hash loaded from the db seeds the cache.
+        if name in Block.HEADER_FIELDS:
+            self.__dict__['_raw_header'] = None
+            self.__dict__['_hash'] = None
+        elif name == 'hash' and value:
+            self.__dict__['_hash'] = value
+        super().__setattr__(name, value)
+
+    def deserialize(self, stream):
+        """Deserialize the block, keeping the raw header so the hash can be calculated without serializing it"""
+        header_step, transactions_step = self.get_serializer().steps
+        raw_header = stream.read(Block.HEADER_SIZE)
+        header_step.unpack(self, raw_header)
+        transactions_step.deserialize(self, stream)
+        self.__dict__['_raw_header'] = raw_header
+        return self
+
+    def serialize(self, stream, value=None):
+        transactions_step = self.get_serializer().steps[1]
+        stream.write(self.serialize_header())
+        transactions_step.serialize(self, stream)
+
+    def save(self, *args, **kwargs):
+        self.hash = self.calculate_hash()
+        super().save(*args, **kwargs)
 
     #
     # Other methods
     #
 
+    def serialize_header(self):
+        """Return the raw 80-byte header"""
+        if self.__dict__.get('_raw_header') is None:
+            # The header fields are compiled into a single struct
+            header_step = self.get_serializer().steps[0]
+            self.__dict__['_raw_header'] = header_step.pack(self)
+        return self._raw_header
+
     def calculate_hash(self):
-        hash_fields = [f for f in self._fields if f.name != 'transactions']
-        stream = BytesIO()
-        for field in hash_fields:
-            field.serializer.serialize(stream, getattr(self, field.name))
-        h = hashlib.sha256(stream.getvalue()).digest()
-        h = hashlib.sha256(h).digest()
-        return binascii.hexlify(h[::-1]).decode('ascii')
+        if self.__dict__.get('_hash') is None:
+            self.__dict__['_hash'] = sha256d(self.serialize_header())
+        return self._hash
 
     def calculate_claimed_target(self):
         """Calculates the target based on the claimed difficulty bits, which should normally not be trusted"""
@@ -73,8 +149,50 @@ class Block(BitcoinSerializable, models.Model):
 
     def validate_proof_of_work(self, target):
         """Validate proof of work based on the given difficulty"""
-        return int(self.calculate_hash(), 16) <= target
+        return int.from_bytes(self.calculate_hash(), 'little') <= target
 
     def __repr__(self):
         return "<%s Version=[%d] Timestamp=[%s] Nonce=[%d] Hash=[%s] Transaction Count=[%d]>" % \
-            (self.__class__.__name__, self.version, self.timestamp, self.nonce, self.calculate_hash(), len(self.transactions))
+            (self.__class__.__name__, self.version, self.timestamp, self.nonce, hash_to_hex(self.calculate_hash()),
+            len(self.transactions))
+
+class HeaderVector(BitcoinSerializable):
+    """The header only vector. It's defined here rather than in datatypes.messages, since the headers are Blocks."""
+    command = "headers"
+    _fields = [
+        Field('headers', fields.ListField(Block), default=list),
+    ]
+
+    def __repr__(self):
+        return "<%s Count=[%d]>" % (self.__class__.__name__, len(self))
+
+    def __len__(self):
+        return len(self.headers)
+
+    def __iter__(self):
+        return iter(self.headers)
+
+class InvalidBlock(models.Model):
+    """The hash of a block which failed validation, or of one descending from it. Headers of these blocks are
+    rejected, so they're never downloaded again, see chain.BlockTree."""
+    hash = HashField(unique=True)
+
+class UnspentOutput(models.Model):
+    """An output which isn't spent by any transaction in our chain. These are written in bulk by the UTXO set, see
+    utxo.UnspentOutputSet, which should be used to look them up."""
+    # The hash of the transaction and the index of the output, see datatypes.structures.OutPoint
+    out_hash = HashField(db_index=True)
+    index = models.IntegerField()
+
+    value = models.BigIntegerField()
+    pubkey_script = models.BinaryField()
+
+    # The height of the block which created the output
+    height = models.IntegerField()
+    coinbase = models.BooleanField(default=False)
+
+    # The address paid by standard pubkey scripts, for balance queries
+    address = models.CharField(max_length=35, null=True, db_index=True)
+
+    class Meta:
+        unique_together = ('out_hash', 'index')
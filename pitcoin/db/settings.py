@@ -2,19 +2,27 @@
 Django settings for db project.
 
 For more information on this file, see
-https://docs.djangoproject.com/en/1.6/topics/settings/
+https://docs.djangoproject.com/en/4.2/topics/settings/
 
 For the full list of settings and their values, see
-https://docs.djangoproject.com/en/1.6/ref/settings/
+https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 import os
 BASE_DIR = os.path.dirname(os.path.dirname(__file__))
 
-from .local_settings import *
-
 INSTALLED_APPS = (
-    'south',
     'db',
 )
+
+DEFAULT_AUTO_FIELD = 'django.db.models.AutoField'
+
+# Block timestamps are naive UTC datetimes
+USE_TZ = False
+
+# The database and secret key. Without them, only the code which doesn't query the database works, like the tests.
+try:
+    from .local_settings import *
+except ImportError:
+    pass
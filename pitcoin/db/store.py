@@ -0,0 +1,93 @@
+import time
+
+from django.db import connection, transaction
+
+from db.models import Block
+
+class BlockStore(object):
+    """Write-behind store for validated blocks.
+
+    Instead of one autocommitted query per block, new blocks (and header-only blocks which have been fully validated)
+    are buffered, and written in bulk in a single transaction once `flush_size` blocks are buffered or the oldest
+    buffered block has waited for `flush_interval` seconds. Blocks are always added in chain order and each flush is
+    atomic, so the saved chain is a prefix of the added chain; after a crash, sync resumes from the last flushed block.
+    Buffered blocks aren't in the database yet, but they are in the chain index.
+
+    If a UTXO set is given, its changes are written in the same transaction as the blocks. Each block is saved with
+    its undo data (see utxo.BlockUndo), which is cleared once the block is more than `undo_depth` blocks deep.
+    """
+
+    FLUSH_SIZE = 500
+    FLUSH_INTERVAL = 0.5
+    UNDO_DEPTH = 1000
+
+    def __init__(self, flush_size=FLUSH_SIZE, flush_interval=FLUSH_INTERVAL, utxos=None, undo_depth=UNDO_DEPTH):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.utxos = utxos
+        self.undo_depth = undo_depth
+
+        # Undo data below this height has been cleared. Unknown until the first flush.
+        self.pruned_height = None
+
+        # New blocks to insert
+        self.blocks = []
+
+        # (Primary key, height, undo data) of header-only blocks which are now fully validated
+        self.validated = []
+
+        # When the oldest buffered write was added
+        self.oldest = None
+
+    def __len__(self):
+        return len(self.blocks) + len(self.validated)
+
+    def add(self, block):
+        """Add a new, validated block. Its `prev_block` must be saved or added before it."""
+        self.blocks.append(block)
+        self._added()
+
+    def set_validated(self, block, undo):
+        """Mark a saved header-only block as fully validated, and set its serialized undo data"""
+        self.validated.append((block.pk, block.height, undo))
+        self._added()
+
+    def _added(self):
+        if self.oldest is None:
+            self.oldest = time.time()
+        if len(self) >= self.flush_size or (self.utxos is not None and self.utxos.is_full()):
+            self.flush()
+
+    def flush_if_due(self):
+        """Flush if the oldest buffered write has waited for long enough. Call this periodically."""
+        if self.oldest is not None and time.time() - self.oldest >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Write all buffered blocks in a single transaction"""
+        if len(self) == 0:
+            return
+        with transaction.atomic():
+            Block.objects.bulk_insert(self.blocks)
+            if len(self.validated) > 0:
+                cursor = connection.cursor()
+                cursor.execute(
+                    "UPDATE %s SET header_only = false, undo = v.undo FROM (VALUES %s) AS v (id, undo) "
+                    "WHERE %s.id = v.id" % (
+                        Block._meta.db_table, ", ".join(["(%s, %s)"] * len(self.validated)), Block._meta.db_table),
+                    [value for pk, height, undo in self.validated for value in (pk, undo)])
+            if self.utxos is not None:
+                self.utxos.flush()
+            self.prune_undo(max([block.height for block in self.blocks] + [v[1] for v in self.validated]))
+        self.blocks = []
+        self.validated = []
+        self.oldest = None
+
+    def prune_undo(self, height):
+        """Clear the undo data of the blocks which are too deep below the given height to be disconnected"""
+        prune_height = height - self.undo_depth
+        blocks = Block.objects.filter(height__lt=prune_height)
+        if self.pruned_height is not None:
+            blocks = blocks.filter(height__gte=self.pruned_height)
+        blocks.exclude(undo=None).update(undo=None)
+        self.pruned_height = max(prune_height, self.pruned_height or 0)
@@ -0,0 +1,297 @@
+import heapq
+import time
+
+from util.hashing import NULL_HASH
+import signatures
+
+# Lock times below this are block heights, and from it on unix timestamps
+LOCKTIME_THRESHOLD = 500000000
+
+# The sequence of inputs which don't take part in the lock time
+SEQUENCE_FINAL = 0xFFFFFFFF
+
+def is_final(transaction, height, timestamp):
+    """Whether the transaction may be included in a block with the given height and unix timestamp: its lock time
+    has passed, or all its inputs opt out of it. See IsFinalTx in the reference client."""
+    if transaction.lock_time == 0:
+        return True
+    if transaction.lock_time < (height if transaction.lock_time < LOCKTIME_THRESHOLD else timestamp):
+        return True
+    return all(i.sequence == SEQUENCE_FINAL for i in transaction.inputs)
+
+class PoolEntry(object):
+    """A transaction in the TransactionPool"""
+    __slots__ = ('transaction', 'txid', 'size', 'fee', 'fee_rate', 'time', 'sequence', 'parents')
+
+    def __init__(self, transaction, fee, sequence, parents):
+        self.transaction = transaction
+        self.txid = transaction.txid
+        self.size = len(transaction.raw)
+        self.fee = fee
+        # Satoshis per 1000 bytes
+        self.fee_rate = fee * 1000 // self.size
+        self.time = time.time()
+        self.sequence = sequence
+        # The txids of the transactions in the pool whose outputs this one spends
+        self.parents = parents
+
+class TransactionPool(object):
+    """The memory pool of unconfirmed transactions, relayed by peers and waiting to be included in a block.
+
+    Transactions are indexed by txid, and by the outpoints they spend, so a transaction spending the same output as
+    one already in the pool is rejected as a conflict. Transactions may spend the outputs of other transactions in
+    the pool. The fee rates are kept in two heaps: the lowest fee rate is evicted first when the pool exceeds
+    `max_size`, and `get_block_transactions` selects the highest first. Removed entries are left in the heaps and
+    skipped when they come up; the heaps are rebuilt once they're mostly made of those.
+
+    `max_size` bounds the total serialized size of the transactions; the parsed transactions take about four times
+    as much memory.
+
+    :param utxos: The UTXO set of our chain, see utxo.UnspentOutputSet
+    :param min_fee_rate: The lowest fee rate accepted, in satoshis per 1000 bytes
+    """
+
+    MAX_SIZE = 1024 * 1024 * 32
+
+    MIN_FEE_RATE = 1000
+
+    # Larger transactions aren't relayed, see MAX_STANDARD_TX_SIZE in the reference client
+    MAX_TRANSACTION_SIZE = 100000
+
+    # Blocks before coinbase outputs can be spent
+    COINBASE_MATURITY = 100
+
+    # Stop filling a block after this many transactions in a row didn't fit
+    MAX_SKIPPED = 100
+
+    # Removed entries tolerated in each heap, beyond the number of entries
+    MAX_STALE = 1000
+
+    def __init__(self, utxos, max_size=MAX_SIZE, min_fee_rate=MIN_FEE_RATE):
+        self.utxos = utxos
+        self.max_size = max_size
+        self.min_fee_rate = min_fee_rate
+
+        # Txid -> PoolEntry
+        self.entries = {}
+
+        # Outpoint -> txid of the transaction in the pool spending it
+        self.spenders = {}
+
+        # (fee rate, sequence, txid), lowest fee rate first
+        self.by_lowest_fee_rate = []
+
+        # (-fee rate, sequence, txid), highest fee rate first
+        self.by_highest_fee_rate = []
+
+        # The total serialized size of the transactions
+        self.size = 0
+
+        self.sequence = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, txid):
+        return txid in self.entries
+
+    def get(self, txid):
+        """Return the transaction with the given txid, or None"""
+        entry = self.entries.get(txid)
+        return entry.transaction if entry is not None else None
+
+    def get_output(self, out_hash, index):
+        """Return the output of a transaction in the pool, or None"""
+        entry = self.entries.get(out_hash)
+        if entry is None or index >= len(entry.transaction.outputs):
+            return None
+        return entry.transaction.outputs[index]
+
+    def accept(self, transaction, height=None):
+        """Validate a transaction against our chain and the pool, and add it. Returns whether it was added.
+
+        :param height: The height of the next block, to reject spends of immature coinbase outputs, and
+                       transactions which couldn't be included in it as their lock time hasn't passed
+        """
+        txid = transaction.txid
+        if txid in self.entries:
+            return False
+        if len(transaction.inputs) == 0 or len(transaction.outputs) == 0:
+            return False
+        if len(transaction.raw) > self.MAX_TRANSACTION_SIZE:
+            return False
+        if height is not None and not is_final(transaction, height, time.time()):
+            return False
+
+        # Look up the spent outputs, from our chain or the pool
+        input_value = 0
+        pubkey_scripts = []
+        parents = set()
+        outpoints = set()
+        for i in transaction.inputs:
+            outpoint = (i.previous_output.out_hash, i.previous_output.index)
+            if outpoint[0] == NULL_HASH:
+                # Coinbase transactions are only valid in blocks
+                return False
+            if outpoint in self.spenders or outpoint in outpoints:
+                # A double spend
+                return False
+            outpoints.add(outpoint)
+            output = self.get_output(*outpoint)
+            if output is not None:
+                parents.add(outpoint[0])
+                input_value += output.value
+                pubkey_scripts.append(output.pubkey_script)
+                continue
+            coin = self.utxos.get(*outpoint)
+            if coin is None:
+                # A missing or spent output. We don't keep orphans; the peer will announce it again.
+                return False
+            if coin.coinbase and height is not None and height - coin.height < self.COINBASE_MATURITY:
+                return False
+            input_value += coin.value
+            pubkey_scripts.append(coin.pubkey_script)
+
+        output_value = 0
+        for output in transaction.outputs:
+            if output.value < 0:
+                return False
+            output_value += output.value
+        fee = input_value - output_value
+        if fee < 0 or fee * 1000 // len(transaction.raw) < self.min_fee_rate:
+            return False
+
+        # The valid signatures are cached, so they aren't verified again when the transaction is mined
+        for input_index, pubkey_script in enumerate(pubkey_scripts):
+            if not signatures.verify_input(transaction, input_index, pubkey_script):
+                return False
+
+        self.add(transaction, fee, parents)
+        self.trim()
+        return txid in self.entries
+
+    def add(self, transaction, fee, parents=()):
+        """Add a validated transaction"""
+        self.sequence += 1
+        entry = PoolEntry(transaction, fee, self.sequence, set(parents))
+        self.entries[entry.txid] = entry
+        for i in transaction.inputs:
+            self.spenders[(i.previous_output.out_hash, i.previous_output.index)] = entry.txid
+        heapq.heappush(self.by_lowest_fee_rate, (entry.fee_rate, entry.sequence, entry.txid))
+        heapq.heappush(self.by_highest_fee_rate, (-entry.fee_rate, entry.sequence, entry.txid))
+        self.size += entry.size
+
+    def remove(self, txid, descendants=True):
+        """Remove a transaction, and the transactions spending its outputs unless `descendants` is False. Returns
+        the removed transactions."""
+        removed = []
+        stack = [txid]
+        while len(stack) > 0:
+            entry = self.entries.pop(stack.pop(), None)
+            if entry is None:
+                continue
+            removed.append(entry.transaction)
+            self.size -= entry.size
+            for i in entry.transaction.inputs:
+                outpoint = (i.previous_output.out_hash, i.previous_output.index)
+                if self.spenders.get(outpoint) == entry.txid:
+                    del self.spenders[outpoint]
+            for index in range(len(entry.transaction.outputs)):
+                child = self.spenders.get((entry.txid, index))
+                if child is None:
+                    continue
+                if descendants:
+                    stack.append(child)
+                else:
+                    # The output is confirmed now
+                    self.entries[child].parents.discard(entry.txid)
+        self.compact()
+        return removed
+
+    def remove_block(self, block):
+        """Remove the transactions included in a newly connected block, and those conflicting with them"""
+        for transaction in block.transactions:
+            self.remove(transaction.txid, descendants=False)
+        for transaction in block.transactions[1:]:
+            for i in transaction.inputs:
+                spender = self.spenders.get((i.previous_output.out_hash, i.previous_output.index))
+                if spender is not None:
+                    # Spends an output which the block spent as well
+                    self.remove(spender)
+
+    def reorganize(self, disconnected, height):
+        """Validate the pool again after a reorg, which may have removed the outputs its transactions spend. The
+        transactions of the disconnected blocks, in chain order and without their coinbases, are accepted first, so
+        they can be mined again, followed by the transactions which were in the pool.
+
+        :param height: The height of the next block on the new tip
+        """
+        pooled = [entry.transaction for entry in sorted(self.entries.values(), key=lambda entry: entry.sequence)]
+        self.clear()
+        for transaction in list(disconnected) + pooled:
+            self.accept(transaction, height)
+
+    def clear(self):
+        self.entries.clear()
+        self.spenders.clear()
+        self.by_lowest_fee_rate = []
+        self.by_highest_fee_rate = []
+        self.size = 0
+
+    def trim(self):
+        """Evict the transactions with the lowest fee rates, along with their descendants, until the pool fits in
+        `max_size`"""
+        while self.size > self.max_size and len(self.by_lowest_fee_rate) > 0:
+            # Removing transactions may rebuild the heap
+            fee_rate, sequence, txid = heapq.heappop(self.by_lowest_fee_rate)
+            entry = self.entries.get(txid)
+            if entry is not None and entry.sequence == sequence:
+                self.remove(txid)
+
+    def compact(self):
+        """Rebuild the heaps without the removed entries, once they're mostly made of those"""
+        if len(self.by_lowest_fee_rate) + len(self.by_highest_fee_rate) <= 2 * (len(self.entries) + self.MAX_STALE):
+            return
+        self.by_lowest_fee_rate = [(e.fee_rate, e.sequence, e.txid) for e in self.entries.values()]
+        self.by_highest_fee_rate = [(-e.fee_rate, e.sequence, e.txid) for e in self.entries.values()]
+        heapq.heapify(self.by_lowest_fee_rate)
+        heapq.heapify(self.by_highest_fee_rate)
+
+    def get_block_transactions(self, max_size=1000000 - 1000):
+        """Select transactions for a new block, highest fee rate first, up to a total size of `max_size` bytes. A
+        transaction is only selected after the transactions it spends from, which come first in the result."""
+        # Items are popped from the heap itself rather than a copy of it, and those still in the pool are pushed
+        # back afterwards, so only the part of the heap which is looked at costs time. Stale items are dropped.
+        heap = self.by_highest_fee_rate
+        popped = []
+        selected = []
+        selected_txids = set()
+        size = 0
+        # Parent txid -> heap items of transactions waiting for it to be selected
+        waiting = {}
+        skipped = 0
+        while len(heap) > 0 and skipped < self.MAX_SKIPPED:
+            item = heapq.heappop(heap)
+            entry = self.entries.get(item[2])
+            if entry is None or entry.sequence != item[1] or entry.txid in selected_txids:
+                continue
+            if size + entry.size > max_size:
+                popped.append(item)
+                skipped += 1
+                continue
+            missing = [txid for txid in entry.parents if txid not in selected_txids]
+            if len(missing) > 0:
+                waiting.setdefault(missing[0], []).append(item)
+                continue
+            popped.append(item)
+            selected.append(entry.transaction)
+            selected_txids.add(entry.txid)
+            size += entry.size
+            for child in waiting.pop(entry.txid, []):
+                heapq.heappush(heap, child)
+
+        for items in waiting.values():
+            popped.extend(items)
+        for item in popped:
+            heapq.heappush(heap, item)
+        return selected
@@ -0,0 +1,119 @@
+from datatypes import structures
+from net.exceptions import MessageTooLarge
+
+class PayloadStream(object):
+    """A read-only, file-like stream over a memoryview. Used to deserialize message payloads directly from the
+    receive buffer without first copying them into a BytesIO."""
+    def __init__(self, view):
+        self._view = view
+        self._position = 0
+
+    def read(self, size=-1):
+        start = self._position
+        if size is None or size < 0:
+            end = len(self._view)
+        else:
+            end = min(start + size, len(self._view))
+        self._position = end
+        return bytes(self._view[start:end])
+
+    def tell(self):
+        return self._position
+
+    def seek(self, position):
+        self._position = position
+        return position
+
+    def getbuffer(self):
+        return self._view
+
+class MessageBuffer(object):
+    """Receive buffer which frames the incoming byte stream into messages.
+
+    Data is received directly into a preallocated bytearray with `recv_into`. Consumed bytes are only moved out of
+    the way when the free space at the end of the buffer runs out, so framing costs amortized O(1) per byte no
+    matter how many messages are pipelined in each read. The header of a message is parsed once, even if the
+    payload arrives over several reads.
+
+    A header announcing a payload larger than `MAX_MESSAGE_SIZE` raises MessageTooLarge, so a peer can't make us
+    allocate more than that; the connection should be dropped, as the rest of the stream can't be framed.
+
+    :param size: The initial buffer capacity. The buffer grows if a single message is larger than this.
+    """
+
+    DEFAULT_SIZE = 1024 * 1024 * 2
+
+    # The amount of free space we want available before each recv_into call
+    RECEIVE_SIZE = 1024 * 64
+
+    # The largest payload accepted, see MAX_SIZE in the reference client
+    MAX_MESSAGE_SIZE = 1024 * 1024 * 32
+
+    def __init__(self, size=DEFAULT_SIZE):
+        self._data = bytearray(size)
+        self._start = 0 # Start of unconsumed data
+        self._end = 0 # End of received data
+        self._header = None # Header of the current, incomplete frame
+
+    def __len__(self):
+        return self._end - self._start
+
+    def recv_from(self, sock):
+        """Receive available data from the given socket directly into the buffer. Returns the amount of received
+        bytes, which is 0 if the peer closed the connection."""
+        self._reserve(self.RECEIVE_SIZE)
+        received = sock.recv_into(memoryview(self._data)[self._end:])
+        self._end += received
+        return received
+
+    def feed(self, data):
+        """Append the given data to the buffer, for transports which hand us data instead of reading it."""
+        self._reserve(len(data))
+        self._data[self._end:self._end + len(data)] = data
+        self._end += len(data)
+
+    def next_frame(self):
+        """Return a (header, payload) tuple for the next complete message, or None if more data is needed. The
+        payload is a memoryview into the buffer and is only valid until the next call which adds data to the
+        buffer; release it when done."""
+        header_size = structures.MessageHeader.calcsize()
+
+        if self._header is None:
+            if len(self) < header_size:
+                return None
+            view = memoryview(self._data)[self._start:self._start + header_size]
+            header = structures.MessageHeader(stream=PayloadStream(view))
+            view.release()
+            if header.length > self.MAX_MESSAGE_SIZE:
+                raise MessageTooLarge("The '%s' message has %d bytes, more than the maximum of %d" %
+                    (header.command, header.length, self.MAX_MESSAGE_SIZE))
+            self._header = header
+
+        header = self._header
+        frame_end = self._start + header_size + header.length
+        if self._end < frame_end:
+            # Make sure the complete frame will fit so we don't need to check again for every read. The frame is at
+            # most MAX_MESSAGE_SIZE plus the header.
+            self._reserve(frame_end - self._end)
+            return None
+
+        payload = memoryview(self._data)[self._start + header_size:frame_end]
+        self._start = frame_end
+        self._header = None
+        return header, payload
+
+    def _reserve(self, size):
+        """Ensure that at least `size` bytes are free at the end of the buffer. Unconsumed data is moved to the
+        front of the buffer, and the buffer grows if that's not enough."""
+        if len(self._data) - self._end >= size:
+            return
+
+        remaining = self._end - self._start
+        if self._start > 0:
+            self._data[:remaining] = self._data[self._start:self._end]
+            self._start = 0
+            self._end = remaining
+
+        missing = size - (len(self._data) - self._end)
+        if missing > 0:
+            self._data.extend(bytes(missing))
@@ -1,20 +1,19 @@
 from io import BytesIO
 import sys
-import os
 import socket
 
 from datatypes import messages, structures
 from config import logger
-from net.exceptions import NodeDisconnected, UnknownCommand, InvalidChecksum
+from net.exceptions import NodeDisconnected, UnknownCommand, InvalidChecksum, MessageTooLarge, \
+    InvalidMessage
 from net import messaging
+from net.buffer import MessageBuffer, PayloadStream
 
-class BitcoinBasicClient(object):
-    """The base class for a Bitcoin network client, this class
-    implements utility functions to create your own class.
-
-    :param seed_address: The initial node address from which we will get further node addresses
-    :param seed_port: Optional port number
-    :param coin: E.g. 'bitcoin', 'bitcoin_testnet3', etc. See datatypes.values.MAGIC_VALUES.
+class BitcoinProtocol(object):
+    """The transport independent part of a Bitcoin network client: message
+    framing, (de)serialization and dispatching of received messages to
+    `handle_<command>` methods. Subclasses provide the transport by setting
+    `self._buffer` and implementing `send_message`.
     """
 
     coin = "bitcoin"
@@ -24,31 +23,13 @@ class BitcoinBasicClient(object):
         'bitcoin_testnet3': 18333,
     }
 
-    def __init__(self, seed_address, seed_port=None, coin=None):
-        if coin is not None:
-            BitcoinBasicClient.coin = coin
-
-        if seed_port is None:
-            seed_port = BitcoinClient.DEFAULT_PORTS[BitcoinBasicClient.coin]
-
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect((seed_address, seed_port))
-
-        self._socket = sock
-        self._buffer = BytesIO()
-        self._running = True
-
-    def disconnect(self):
-        """Disconnect from the peer node"""
-        self._running = False
-        self._socket.shutdown(socket.SHUT_RDWR)
-
     def handle_message_header(self, header, payload):
         """This method will be called for every message before the
         message payload deserialization.
 
         :param header: The message header
-        :param payload: The payload of the message
+        :param payload: The payload of the message, as a memoryview into the receive buffer. It's released after
+                        the message is handled; copy it with bytes() if you need to keep it.
         """
         pass
 
@@ -61,54 +42,84 @@ class BitcoinBasicClient(object):
         pass
 
     def read_message(self):
-        """This method is called inside the loop() method to
-        receive a message from the stream (socket) and then
+        """This method is called by the transport to
+        receive a message from the receive buffer and then
         deserialize it."""
 
-        # Calculate the size of the buffer
-        self._buffer.seek(0, os.SEEK_END)
-        buffer_size = self._buffer.tell()
-
-        # If a complete header isn't present, keep buffer and return to wait for more data
-        if buffer_size < structures.MessageHeader.calcsize():
-            return
-
-        # Go to the beginning of the buffer
-        self._buffer.seek(0, os.SEEK_SET)
-
-        # Deserialize the header
-        header = structures.MessageHeader()
-        header.deserialize(self._buffer)
-        total_length = structures.MessageHeader.calcsize() + header.length
-
-        # If incomplete message, keep buffer and return to wait for more data
-        if buffer_size < total_length:
-            self._buffer.seek(0, os.SEEK_END)
+        frame = self._buffer.next_frame()
+        if frame is None:
+            # Incomplete message, wait for more data
             return
 
-        # Read the payload and reset buffer
-        payload = self._buffer.read(header.length)
-        remaining_data = self._buffer.read()
-        self._buffer = BytesIO(remaining_data)
+        header, payload = frame
+        try:
+            self.handle_message_header(header, payload)
 
-        self.handle_message_header(header, payload)
-
-        # Verify the payload checksum
-        payload_checksum = structures.MessageHeader.calc_checksum(payload)
-        if payload_checksum != header.checksum:
-            raise InvalidChecksum("The provided checksum '%s' doesn't match the calculated checksum '%s'" %
-                (header.checksum, payload_checksum))
+            # Verify the payload checksum
+            payload_checksum = structures.MessageHeader.calc_checksum(payload)
+            if payload_checksum != header.checksum:
+                raise InvalidChecksum("The provided checksum '%s' doesn't match the calculated checksum '%s'" %
+                    (header.checksum, payload_checksum))
 
-        # Deserialize the message
-        message = messaging.deserialize(header.command, BytesIO(payload))
-        return (header, message, len(remaining_data) > 0)
+            # Deserialize the message straight from the buffer. A truncated or malformed payload may fail in any
+            # field, with struct.error, IndexError, ValueError and the like.
+            try:
+                message = messaging.deserialize(header.command, PayloadStream(payload))
+            except UnknownCommand:
+                raise
+            except Exception as e:
+                raise InvalidMessage("Invalid '%s' message: %r" % (header.command, e)) from e
+        finally:
+            # The payload is a view into the receive buffer, which can't be resized while the view is alive
+            payload.release()
+        return (header, message, len(self._buffer) > 0)
+
+    def read_messages(self):
+        """Read and dispatch all complete messages in the receive buffer"""
+        # Loop while there's more data after the parsed message. The next message may be complete, in which
+        # case we should read it right away instead of waiting for more data.
+        while True:
+            try:
+                data = self.read_message()
+            except (InvalidChecksum, UnknownCommand) as e:
+                logger.warning("Error parsing data packet: %s" % e,
+                    exc_info=sys.exc_info(),
+                )
+                continue
+            except MessageTooLarge as e:
+                # The rest of the stream can't be framed without buffering the whole message
+                logger.warning("Disconnecting from peer: %s" % e)
+                self.disconnect()
+                return
+            except InvalidMessage as e:
+                self.on_invalid_message(e)
+                return
+
+            if data is None:
+                # Incomplete buffer, wait for more data
+                return
+
+            header, message, more_data = data
+            if hasattr(self, "handle_%s" % header.command):
+                getattr(self, "handle_%s" % header.command)(header, message)
+            if not more_data:
+                return
+
+    def on_invalid_message(self, exc):
+        """Called when a message can't be parsed. The peer is disconnected; override to hold it against the peer
+        as well.
+
+        :param exc: The InvalidMessage exception
+        """
+        logger.warning("Disconnecting from peer: %s" % exc)
+        self.disconnect()
 
-    def send_message(self, message):
-        """This method will serialize the message using the
-        appropriate serializer based on the message command
-        and then it will send it to the socket stream.
+    def pack_message(self, message):
+        """Serialize the message using the appropriate serializer
+        based on the message command, and prepend its header.
 
-        :param message: The message object to send
+        :param message: The message object to serialize
+        :returns: A (header, data) tuple, where data is ready to be sent
         """
         header = structures.MessageHeader()
         header.set_coin(self.coin)
@@ -128,49 +139,73 @@ class BitcoinBasicClient(object):
         transmission = BytesIO()
         header.serialize(transmission)
         transmission.write(payload)
+        return header, transmission.getvalue()
+
+class BitcoinBasicClient(BitcoinProtocol):
+    """The base class for a Bitcoin network client using a
+    blocking socket, this class implements utility functions
+    to create your own class.
+
+    :param seed_address: The initial node address from which we will get further node addresses
+    :param seed_port: Optional port number
+    :param coin: E.g. 'bitcoin', 'bitcoin_testnet3', etc. See datatypes.values.MAGIC_VALUES.
+    """
+
+    def __init__(self, seed_address, seed_port=None, coin=None):
+        if coin is not None:
+            BitcoinBasicClient.coin = coin
+
+        if seed_port is None:
+            seed_port = BitcoinClient.DEFAULT_PORTS[BitcoinBasicClient.coin]
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect((seed_address, seed_port))
+
+        self._socket = sock
+        self._buffer = MessageBuffer()
+        self._running = True
+
+    def disconnect(self):
+        """Disconnect from the peer node"""
+        self._running = False
+        self._socket.shutdown(socket.SHUT_RDWR)
+
+    def send_message(self, message):
+        """This method will serialize the message using the
+        appropriate serializer based on the message command
+        and then it will send it to the socket stream.
+
+        :param message: The message object to send
+        """
+        header, transmission = self.pack_message(message)
 
         # Cool, fire it away
-        self._socket.sendall(transmission.getvalue())
+        self._socket.sendall(transmission)
         self.handle_send_message(header, message)
 
     def loop(self):
         """The main receive/send loop."""
 
         while self._running:
-            try:
-                data = self._socket.recv(1024*8)
-                self._buffer.write(data)
-
-                if len(data) <= 0:
-                    if self._running:
-                        raise NodeDisconnected("Node disconnected.")
-                    else:
-                        # Looks like an intentional disconnect, just return
-                        return
-
-                # Loop while there's more data after the parsed message. The next message may be complete, in which
-                # case we should read it right away instead of waiting for more data.
-                while True:
-                    data = self.read_message()
-                    if data is None:
-                        # Incomplete buffer, wait for more data
-                        break
-
-                    header, message, more_data = data
-                    if hasattr(self, "handle_%s" % header.command):
-                        getattr(self, "handle_%s" % header.command)(header, message)
-                    if not more_data:
-                        break
-            except (InvalidChecksum, UnknownCommand) as e:
-                logger.warning("Error parsing data packet: %s" % e.message,
-                    exc_info=sys.exc_info(),
-                )
+            received = self._buffer.recv_from(self._socket)
+
+            if received <= 0:
+                if self._running:
+                    raise NodeDisconnected("Node disconnected.")
+                else:
+                    # Looks like an intentional disconnect, just return
+                    return
 
+            self.read_messages()
 
-class BitcoinClient(BitcoinBasicClient):
+class ProtocolRulesMixin(object):
     """This class implements all the protocol rules needed
     for a client to stay up in the network. It will handle
-    the handshake rules as well answer the ping messages."""
+    the handshake rules as well answer the ping messages.
+    It can be mixed into any transport, see BitcoinClient."""
+
+    # The protocol version of the peer, from its version message
+    peer_version = 0
 
     def handshake(self, callback=None):
         """Initiate the connection with a Version exchange """
@@ -178,6 +213,7 @@ class BitcoinClient(BitcoinBasicClient):
 
     def handle_version(self, header, message):
         """Handle the Version message and reply with VerAck"""
+        self.peer_version = message.version
         self.send_message(messages.VerAck())
 
     def handle_verack(self, header, message):
@@ -189,3 +225,7 @@ class BitcoinClient(BitcoinBasicClient):
     def handle_ping(self, header, message):
         """Handle the Ping message and reploy with Pong"""
         self.send_message(messages.Pong(nonce=message.nonce))
+
+class BitcoinClient(ProtocolRulesMixin, BitcoinBasicClient):
+    """A blocking socket client following the protocol rules,
+    see ProtocolRulesMixin."""
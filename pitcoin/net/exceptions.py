@@ -9,3 +9,9 @@ class UnknownCommand(Exception):
 
 class InvalidChecksum(Exception):
     """Thrown when a parsed message has an invalid checksum"""
+
+class MessageTooLarge(Exception):
+    """Thrown when a message header announces a payload larger than we accept"""
+
+class InvalidMessage(Exception):
+    """Thrown when the payload of a message can't be parsed"""
@@ -0,0 +1,150 @@
+import hashlib
+import math
+import os
+import time
+
+class RollingBloomFilter(object):
+    """A probabilistic set of recently added items, like the block and transaction hashes announced by a peer.
+
+    It remembers at least the last `capacity` items, in a fixed amount of memory. An item which wasn't added is
+    reported as present with a probability of about `2 * false_positive_rate`. The items are kept in two generations
+    of `capacity` items each; when the newest is full, the oldest is dropped and a new one started.
+
+    The bit positions are derived from a keyed hash with a random key, so peers can't pick hashes which collide in
+    our filters.
+    """
+
+    def __init__(self, capacity, false_positive_rate=0.000001):
+        self.capacity = capacity
+        self.bit_count = max(8, int(-capacity * math.log(false_positive_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.bit_count / capacity * math.log(2)))
+        self.key = os.urandom(16)
+        self.current = bytearray((self.bit_count + 7) // 8)
+        self.previous = bytearray(len(self.current))
+        self.count = 0
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item, digest_size=16, key=self.key).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        # Odd, so the positions don't repeat
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        bit_count = self.bit_count
+        return [(h1 + i * h2) % bit_count for i in range(self.hash_count)]
+
+    def add(self, item):
+        if self.count >= self.capacity:
+            self.previous = self.current
+            self.current = bytearray(len(self.previous))
+            self.count = 0
+        current = self.current
+        for position in self._positions(item):
+            current[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        positions = self._positions(item)
+        for bits in (self.current, self.previous):
+            for position in positions:
+                if not bits[position >> 3] & (1 << (position & 7)):
+                    break
+            else:
+                return True
+        return False
+
+    def clear(self):
+        self.current = bytearray(len(self.current))
+        self.previous = bytearray(len(self.current))
+        self.count = 0
+
+class InventoryTracker(object):
+    """Keeps track of which announced transactions we still need, so each is only downloaded once, from the first
+    peer announcing it, and isn't announced back to peers which already know it.
+
+    Each peer gets a rolling bloom filter of the hashes it announced or we announced to it, as `known_inventory`.
+    Announced transactions which we already have (as told by `have`), which are requested from another peer, or
+    which we recently rejected, aren't requested. Requests which aren't answered within `request_timeout` seconds
+    may be made to another peer announcing the transaction.
+
+    :param have: Called with a hash; returns whether we already have it, e.g. in the mempool
+    """
+
+    # Hashes remembered per peer. A false positive only means a transaction isn't announced to that peer, so the
+    # filters can be small.
+    PEER_CAPACITY = 50000
+    PEER_FALSE_POSITIVE_RATE = 0.0001
+
+    # Rejected transactions remembered, until the next block
+    REJECTED_CAPACITY = 120000
+
+    REQUEST_TIMEOUT = 60
+
+    def __init__(self, have, request_timeout=REQUEST_TIMEOUT):
+        self.have = have
+        self.request_timeout = request_timeout
+
+        # Hash -> (peer, deadline) of transactions requested from a peer
+        self.requested = {}
+        self.next_expiry = time.time() + request_timeout
+
+        self.rejected = RollingBloomFilter(self.REJECTED_CAPACITY)
+
+    def add_peer(self, peer):
+        peer.known_inventory = RollingBloomFilter(self.PEER_CAPACITY, self.PEER_FALSE_POSITIVE_RATE)
+
+    def remove_peer(self, peer):
+        """Forget the requests to the peer, so other peers' announcements are requested right away"""
+        for inv_hash in [h for h, (p, deadline) in self.requested.items() if p is peer]:
+            del self.requested[inv_hash]
+
+    def announced(self, peer, hashes, request=True):
+        """Record the hashes announced by the peer, and return those we should request from it. They're marked as
+        requested from the peer. With `request` False, the hashes are only recorded."""
+        known = peer.known_inventory
+        now = time.time()
+        wanted = []
+        for inv_hash in hashes:
+            known.add(inv_hash)
+            if not request:
+                continue
+            requested = self.requested.get(inv_hash)
+            if requested is not None and requested[1] > now:
+                continue
+            if self.have(inv_hash) or inv_hash in self.rejected:
+                continue
+            self.requested[inv_hash] = (peer, now + self.request_timeout)
+            wanted.append(inv_hash)
+        if now >= self.next_expiry:
+            self.expire(now)
+        return wanted
+
+    def received(self, peer, inv_hash, accepted):
+        """Record that the item arrived from the peer, and whether it was accepted"""
+        peer.known_inventory.add(inv_hash)
+        self.requested.pop(inv_hash, None)
+        if not accepted:
+            self.rejected.add(inv_hash)
+
+    def not_found(self, hashes):
+        """The peer doesn't have the requested items after all; request them from the next peer announcing them"""
+        for inv_hash in hashes:
+            self.requested.pop(inv_hash, None)
+
+    def expire(self, now=None):
+        """Forget the requests which timed out"""
+        if now is None:
+            now = time.time()
+        for inv_hash in [h for h, (peer, deadline) in self.requested.items() if deadline <= now]:
+            del self.requested[inv_hash]
+        self.next_expiry = now + self.request_timeout
+
+    def clear_rejected(self):
+        """Forget the rejected transactions when a block is connected, since they may have become valid"""
+        self.rejected.clear()
+
+    def should_announce(self, peer, inv_hash):
+        """Whether the peer may not know the hash yet. If so, it's recorded as known, since we'll announce it."""
+        known = peer.known_inventory
+        if inv_hash in known:
+            return False
+        known.add(inv_hash)
+        return True
@@ -5,18 +5,21 @@ from .exceptions import UnknownCommand
 from datatypes.meta import BitcoinSerializable
 import db.models
 
-# All messages are subclasses of BitcoinSerializable. Most are defined in the 'datatypes.messages' module,
-# and some that are saveable through the ORM are defined in 'db.models'.
+# All messages are subclasses of BitcoinSerializable with a command. Most are defined in the 'datatypes.messages'
+# module, and some that are saveable through the ORM are defined in 'db.models'. Structures nested in messages may
+# be defined along with them, without a command.
 MESSAGES = {}
 for module in ['datatypes.messages', 'db.models']:
     MESSAGES.update({
         c.command: c \
         for name, c in inspect.getmembers(sys.modules[module])
         if inspect.isclass(c) and issubclass(c, BitcoinSerializable) and c is not BitcoinSerializable
+            and getattr(c, 'command', None) is not None
     })
 
 def deserialize(command, stream):
     try:
-        return MESSAGES[command](stream=stream)
+        message_class = MESSAGES[command]
     except KeyError:
         raise UnknownCommand("Unknown command: %s" % command)
+    return message_class.from_stream(stream)
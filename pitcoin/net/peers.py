@@ -0,0 +1,116 @@
+import asyncio
+import time
+
+from config import logger
+from net.clients import BitcoinProtocol, ProtocolRulesMixin
+from net.buffer import MessageBuffer
+
+class AsyncBitcoinBasicClient(BitcoinProtocol, asyncio.Protocol):
+    """An asyncio based Bitcoin network client. It exposes the same
+    `handle_<command>`, `send_message` and `disconnect` surface as the
+    blocking BitcoinBasicClient, but doesn't own a thread or socket loop;
+    any number of clients can share one event loop.
+
+    Connect with `await SomeClient.connect(address)`.
+
+    :param coin: E.g. 'bitcoin', 'bitcoin_testnet3', etc. See datatypes.values.MAGIC_VALUES.
+    :param idle_timeout: Disconnect if the peer is silent for this many seconds
+    """
+
+    # Initial receive buffer size per peer. Kept small so that hundreds of peers can be held; the buffer grows when
+    # a larger message arrives.
+    BUFFER_SIZE = 1024 * 128
+
+    # Default timeouts, in seconds
+    CONNECT_TIMEOUT = 10
+    IDLE_TIMEOUT = 60 * 5
+
+    def __init__(self, coin=None, idle_timeout=None):
+        if coin is not None:
+            self.coin = coin
+        self.idle_timeout = idle_timeout if idle_timeout is not None else self.IDLE_TIMEOUT
+        self.address = None
+        self.last_received = None
+        self._buffer = MessageBuffer(self.BUFFER_SIZE)
+        self._transport = None
+        self._timeout_handle = None
+        self._closed = asyncio.get_event_loop().create_future()
+
+    @classmethod
+    async def connect(cls, address, port=None, timeout=None, **kwargs):
+        """Connect to the given peer and return the connected client. Raises OSError on connection failures and
+        asyncio.TimeoutError if the connection isn't established within `timeout` seconds."""
+        client = cls(**kwargs)
+        if port is None:
+            port = client.DEFAULT_PORTS[client.coin]
+        if timeout is None:
+            timeout = client.CONNECT_TIMEOUT
+        loop = asyncio.get_event_loop()
+        await asyncio.wait_for(loop.create_connection(lambda: client, address, port), timeout)
+        return client
+
+    def connection_made(self, transport):
+        self._transport = transport
+        self.address = transport.get_extra_info('peername')
+        self.last_received = time.time()
+        self._schedule_timeout(self.idle_timeout)
+
+    def data_received(self, data):
+        self.last_received = time.time()
+        self._buffer.feed(data)
+        self.read_messages()
+
+    def connection_lost(self, exc):
+        if self._timeout_handle is not None:
+            self._timeout_handle.cancel()
+        self._transport = None
+        if not self._closed.done():
+            self._closed.set_result(exc)
+        self.on_disconnect(exc)
+
+    def on_disconnect(self, exc):
+        """Called when the connection is closed, by either side.
+
+        :param exc: The exception that caused the disconnect, or None if the connection was closed normally
+        """
+        pass
+
+    @property
+    def connected(self):
+        return self._transport is not None and not self._transport.is_closing()
+
+    def wait_closed(self):
+        """Return an awaitable which completes when the connection is closed"""
+        return asyncio.shield(self._closed)
+
+    def disconnect(self):
+        """Disconnect from the peer node"""
+        if self._transport is not None:
+            self._transport.close()
+
+    def send_message(self, message):
+        """Serialize the message and queue it for sending. Returns immediately; the event loop writes the data
+        when the socket is ready.
+
+        :param message: The message object to send
+        """
+        header, transmission = self.pack_message(message)
+        self._transport.write(transmission)
+        self.handle_send_message(header, message)
+
+    def _schedule_timeout(self, delay):
+        loop = asyncio.get_event_loop()
+        self._timeout_handle = loop.call_later(delay, self._check_timeout)
+
+    def _check_timeout(self):
+        # Rescheduling a timer on every received packet is expensive with many busy peers, so compare against the
+        # time of the last received data instead, and reschedule for the remaining time.
+        silent = time.time() - self.last_received
+        if silent >= self.idle_timeout:
+            logger.info("Disconnecting from %s: silent for %d seconds" % (self.address, silent))
+            self._transport.abort()
+        else:
+            self._schedule_timeout(self.idle_timeout - silent)
+
+class AsyncBitcoinClient(ProtocolRulesMixin, AsyncBitcoinBasicClient):
+    """An asyncio client following the protocol rules, see ProtocolRulesMixin."""
@@ -1,10 +1,14 @@
+import functools
 import hashlib
 
+import script_opcodes
 from net.clients import BitcoinClient
 from datatypes import messages, structures, values
 from db.models import Block
 from script_opcodes import *
 from util.mpi import num2mpi, mpi2num
+from util.hashing import sha256d, hash160
+from util.base58 import base58check_encode
 
 def run():
     client = TestClient("as")
@@ -30,463 +34,563 @@ class TestClient(BitcoinClient):
                 script.execute()
 
 class Script(object):
-    """The stack-based bitcoin script language for transaction redemption. See https://en.bitcoin.it/wiki/Script"""
+    """The stack-based bitcoin script language for transaction redemption. See https://en.bitcoin.it/wiki/Script
+
+    Opcodes are executed by looking up their handler in the HANDLERS table, see `handles`.
+
+    :param script: The raw script
+    :param checker: Checks the signatures of OP_CHECK[MULTI]SIG*, with a method
+                    `check_signature(signature, pubkey, script_code)` returning True or False
+    """
 
     MAX_SCRIPT_DATA_SIZE = 520
     MAX_OPCODE_COUNT = 201
     MAX_SCRIPTNUM_SIZE = 4
+    MAX_PUBKEYS_PER_MULTISIG = 20
+
+    # The number of parsed scripts to cache, see parse_script
+    PARSE_CACHE_SIZE = 1024 * 64
 
-    def __init__(self, script):
-        self.datastack = []
+    def __init__(self, script, checker=None, datastack=None):
+        self.script = script
+        self.checker = checker
+        self.datastack = datastack if datastack is not None else []
         self.altstack = [] # Alternative data stack
         self.ifstack = []
-        self.chunks = []
-        self.parse(script)
-
-    def parse(self, script):
-        """Parse pushed data and non-pushdata opcodes into chunks"""
-
-        i = 0
-        opcode_count = 0
-        while i < len(script):
-            opcode = script[i]
-            start_index = i
-            i += 1
-
-            if opcode >= 0 and opcode < OP_PUSHDATA1:
-                read_length = opcode
-                self.chunks.append({'type': 'data', 'value': script[i:i+read_length], 'start_index': start_index})
-                i += read_length
-            elif opcode == OP_PUSHDATA1:
-                read_length = int.from_bytes(script.read(1), byteorder='little')
-                self.chunks.append({'type': 'data', 'value': script[i:i+read_length], 'start_index': start_index})
-                i += read_length
-            elif opcode == OP_PUSHDATA2:
-                read_length = int.from_bytes(script.read(2), byteorder='little')
-                self.chunks.append({'type': 'data', 'value': script[i:i+read_length], 'start_index': start_index})
-                i += read_length
-            elif opcode == OP_PUSHDATA4:
-                # OP_PUSHDATA4 should never be used, as pushes over 520 bytes are not allowed, and
-                # those below can be done using OP_PUSHDATA2, but we'll implement it nevertheless
-                read_length = int.from_bytes(script.read(4), byteorder='little')
-                self.chunks.append({'type': 'data', 'value': script[i:i+read_length], 'start_index': start_index})
-                i += read_length
-            else:
-                if opcode >= OP_NOP:
-                    # Note how OP_RESERVED does not count towards the opcode limit.
-                    # https://github.com/bitcoin/bitcoin/blob/0.9.0/src/script.cpp#L335
-                    opcode_count += 1
-                    if opcode_count > Script.MAX_OPCODE_COUNT:
-                        raise ScriptException("Script contains more than the allowed %s opcodes" % Script.MAX_OPCODE_COUNT)
-                self.chunks.append({'type': 'opcode', 'value': opcode, 'start_index': start_index})
+        self.executing = True # False while in a branch which isn't taken
+        self.last_code_separator_index = 0 # Used by OP_CODESEPARATOR, OP_CHECK[MULTI]SIG*
+        self.chunks, self.opcode_count = parse_script(script)
 
     def execute(self):
+        """Execute the script on the current stacks. Raises ScriptFailure if it fails, and ScriptException if the
+        script is invalid."""
+        datastack = self.datastack
         for chunk in self.chunks:
-
-            # Handles the current flow control (execute or not)
-            execute = False not in self.ifstack
-
-            # Used by OP_CODESEPARATOR, OP_CHECK[MULTI]SIG*
-            last_code_separator_index = 0
-
-            if chunk['type'] == 'data':
-                # Verify chunk length
-                if len(chunk['value']) > Script.MAX_SCRIPT_DATA_SIZE:
-                    raise ScriptException("Script pushed %s bytes of data, max is %s" % (len(chunk['value']), Script.MAX_SCRIPT_DATA_SIZE))
-
-                if not execute:
-                    continue
-
-                self.datastack.append(chunk['value'])
+            opcode, data, start_index = chunk
+            if data is not None:
+                if self.executing:
+                    datastack.append(data)
+                continue
+
+            if not self.executing and opcode not in FLOW_CONTROL_OPCODES:
+                # Disabled opcodes fail the script even in branches which aren't taken
+                if opcode in DISABLED_OPCODES:
+                    raise ScriptException("Script contains disabled operation %s" % OPCODE_NAMES[opcode])
+                continue
+
+            handler, stack_size = HANDLERS[opcode]
+            if len(datastack) < stack_size:
+                raise ScriptException("Script attempted %s on too small stack" % OPCODE_NAMES[opcode])
+            handler(self, opcode, chunk)
+
+        if len(self.ifstack) > 0:
+            raise ScriptException("Script ended with unbalanced conditionals")
+
+    def check_signature(self, signature, pubkey):
+        if self.checker is None:
+            raise ScriptException("Script needs a signature checker for OP_CHECK[MULTI]SIG*")
+        return self.checker.check_signature(signature, pubkey, self.script[self.last_code_separator_index:])
+
+@functools.lru_cache(maxsize=Script.PARSE_CACHE_SIZE)
+def parse_script(script):
+    """Parse the raw script into a tuple of (opcode, data, start index) chunks, where data is the pushed bytes, or
+    None for non-pushdata opcodes. Returns the chunks and the opcode count.
+
+    Parsed scripts are cached by their bytes, since the same scripts are parsed over and over; in the mempool and
+    again in a block, or for each output paying the same address."""
+    chunks = []
+    i = 0
+    opcode_count = 0
+    while i < len(script):
+        opcode = script[i]
+        start_index = i
+        i += 1
+
+        if opcode <= OP_PUSHDATA4:
+            if opcode < OP_PUSHDATA1:
+                read_length = opcode
             else:
-                if chunk['value'] in [OP_CAT, OP_SUBSTR, OP_LEFT, OP_RIGHT, OP_INVERT, OP_AND, OP_OR, OP_XOR, OP_2MUL,
-                    OP_2DIV, OP_MUL, OP_DIV, OP_MOD, OP_LSHIFT, OP_RSHIFT]:
-                    raise ScriptException("Script contains disabled operation '%s'" % chunk['value'])
-
-                #
-                # FLOW CONTROL
-                #
-
-                if chunk['value'] == OP_IF:
-                    if not execute:
-                        # Append an irrelevant value to the flow control stack to keep track of nesting
-                        self.ifstack.append(False)
-                        continue
-                    if len(self.stack) == 0:
-                        raise ScriptException("Script attempted OP_IF on empty stack")
-                    self.ifstack.append(cast_to_bool(self.stack.pop()))
-                    continue
-
-                elif chunk['value'] == OP_NOTIF:
-                    if not execute:
-                        # Append an irrelevant value to the flow control stack to keep track of nesting
-                        self.ifstack.append(False)
-                        continue
-                    if len(self.stack) == 0:
-                        raise ScriptException("Script attempted OP_NOTIF on empty stack")
-                    self.ifstack.append(not cast_to_bool(self.stack.pop()))
-                    continue
-
-                elif chunk['value'] == OP_ELSE:
-                    if len(self.ifstack) == 0:
-                        raise ScriptException("Script attempted OP_ELSE on empty if-stack")
-                    self.ifstack.append(not ifstack.pop())
-                    continue
-
-                elif chunk['value'] == OP_ENDIF:
-                    if len(self.ifstack) == 0:
-                        raise ScriptException("Script attempted OP_ENDIF on empty if-stack")
-                    self.ifstack.pop()
-                    continue
-
-                if not execute:
-                    # Done with control operations and not executing. Skip ahead to next operation
-                    continue
-
-                #
-                # PUSH VALUE
-                #
-
-                if chunk['value'] == OP_1NEGATE:
-                    self.datastack.add(int_to_scriptnum(-1))
-                    continue
-
-                if chunk['value'] >= OP_1 and chunk['value'] <= OP_16:
-                    push_value = chunk['value'] + 1 - OP_1 # 1 for OP_1, 2 for OP_2, ..., 16 for OP_16
-                    self.datastack.add(int_to_scriptnum(push_value))
-                    continue
-
-                #
-                # NOPES
-                #
-
-                if chunk['value'] in [OP_NOP, OP_NOP1, OP_NOP2, OP_NOP3, OP_NOP4, OP_NOP5, OP_NOP6, OP_NOP7, OP_NOP8,
-                    OP_NOP9, OP_NOP10]:
-                    continue
-
-                #
-                # VERIFICATION
-                #
-
-                if chunk['value'] == OP_VERIFY:
-                    if len(self.datastack) < 1:
-                        raise ScriptException("Script attempted OP_VERIFY on empty stack")
-                    if not cast_to_bool(self.datastack.pop()):
-                        raise ScriptFailure("OP_VERIFY failed")
-
-                if chunk['value'] == OP_RETURN:
-                    raise ScriptFailure("Script used OP_RETURN")
-
-                #
-                # STACK OPERATIONS
-                #
-
-                if chunk['value'] == OP_TOALTSTACK:
-                    if len(self.datastack) < 1:
-                        raise ScriptException("Script attempted OP_TOALTSTACK on empty stack")
-                    self.altstack.append(self.datastack.pop())
-                    continue
-
-                if chunk['value'] == OP_FROMALTSTACK:
-                    if len(self.altstack) < 1:
-                        raise ScriptException("Script attempted OP_FROMALTSTACK on empty stack")
-                    self.datastack.append(self.altstack.pop())
-                    continue
-
-                if chunk['value'] == OP_2DROP:
-                    if len(self.datastack) < 2:
-                        raise ScriptException("Script attempted OP_2DROP on too small stack")
-                    self.datastack.pop()
-                    self.datastack.pop()
-                    continue
-
-                if chunk['value'] == OP_2DUP:
-                    if len(self.datastack) < 2:
-                        raise ScriptException("Script attempted OP_2DUP on too small stack")
-                    self.datastack.append(self.datastack[-2])
-                    self.datastack.append(self.datastack[-2])
-                    continue
-
-                if chunk['value'] == OP_3DUP:
-                    if len(self.datastack) < 3:
-                        raise ScriptException("Script attempted OP_3DUP on too small stack")
-                    self.datastack.append(self.datastack[-3])
-                    self.datastack.append(self.datastack[-3])
-                    self.datastack.append(self.datastack[-3])
-                    continue
-
-                if chunk['value'] == OP_2OVER:
-                    if len(self.datastack) < 4:
-                        raise ScriptException("Script attempted OP_2OVER on too small stack")
-                    self.datastack.append(self.datastack[-4])
-                    self.datastack.append(self.datastack[-4])
-                    continue
-
-                if chunk['value'] == OP_2ROT:
-                    if len(self.datastack) < 6:
-                        raise ScriptException("Script attempted OP_2ROT on too small stack")
-                    self.datastack.append(self.datastack.pop(-6))
-                    self.datastack.append(self.datastack.pop(-6))
-                    continue
-
-                if chunk['value'] == OP_2SWAP:
-                    if len(self.datastack) < 4:
-                        raise ScriptException("Script attempted OP_2SWAP on too small stack")
-                    self.datastack.insert(len(self.datastack) - 4, self.datastack.pop())
-                    self.datastack.insert(len(self.datastack) - 4, self.datastack.pop())
-                    continue
-
-                if chunk['value'] == OP_IFDUP:
-                    if len(self.datastack) < 1:
-                        raise ScriptException("Script attempted OP_2ROT on empty stack")
-                    if cast_to_bool(self.datastack[-1]):
-                        self.datastack.append(self.datastack[-1])
-                    continue
-
-                if chunk['value'] == OP_DEPTH:
-                    self.datastack.append(int_to_scriptnum(len(self.datastack)))
-                    continue
-
-                if chunk['value'] == OP_DROP:
-                    if len(self.datastack) < 1:
-                        raise ScriptException("Script attempted OP_DROP on empty stack")
-                    self.datastack.pop()
-                    continue
-
-                if chunk['value'] == OP_DUP:
-                    if len(self.datastack) < 1:
-                        raise ScriptException("Script attempted OP_DUP on empty stack")
-                    self.datastack.append(self.datastack[-1])
-                    continue
-
-                if chunk['value'] == OP_NIP:
-                    if len(self.datastack) < 2:
-                        raise ScriptException("Script attempted OP_NIP on too small stack")
-                    self.datastack.pop(-2)
-                    continue
-
-                if chunk['value'] == OP_OVER:
-                    if len(self.datastack) < 2:
-                        raise ScriptException("Script attempted OP_OVER on too small stack")
-                    self.datastack.append(self.datastack[-2])
-                    continue
-
-                if chunk['value'] == OP_PICK:
-                    if len(self.datastack) < 2:
-                        raise ScriptException("Script attempted OP_PICK on too small stack")
-                    n = scriptnum_to_int(self.datastack.pop())
-                    if n < 0 or n > len(self.datastack):
-                        raise ScriptException("OP_PICK at index %s on too small stack" % n)
-                    self.datastack.append(self.datastack[(n + 1) * -1])
-                    continue
-
-                if chunk['value'] == OP_ROLL:
-                    if len(self.datastack) < 2:
-                        raise ScriptException("Script attempted OP_ROLL on too small stack")
-                    n = scriptnum_to_int(self.datastack.pop())
-                    if n < 0 or n > len(self.datastack):
-                        raise ScriptException("OP_ROLL at index %s on too small stack" % n)
-                    self.datastack.append(self.datastack.pop((n + 1) * -1))
-                    continue
-
-                if chunk['value'] == OP_ROT:
-                    if len(self.datastack) < 3:
-                        raise ScriptException("Script attempted OP_ROT on too small stack")
-                    self.datastack.append(self.datastack.pop(-3))
-                    continue
-
-                if chunk['value'] == OP_SWAP:
-                    if len(self.datastack) < 2:
-                        raise ScriptException("Script attempted OP_SWAP on too small stack")
-                    self.datastack.append(self.datastack.pop(-2))
-                    continue
-
-                if chunk['value'] == OP_TUCK:
-                    if len(self.datastack) < 2:
-                        raise ScriptException("Script attempted OP_TUCK on too small stack")
-                    self.datastack.insert(len(self.datastack) - 2, self.datastack[-1])
-                    continue
-
-                if chunk['value'] == OP_SIZE:
-                    if len(self.datastack) < 1:
-                        raise ScriptException("Script attempted OP_SIZE on empty stack")
-                    self.datastack.push(int_to_scriptnum(len(self.datastack[-1])))
-                    continue
-
-                #
-                # BITWISE LOGIC
-                #
-
-                if chunk['value'] == OP_EQUAL:
-                    if len(self.datastack) < 2:
-                        raise ScriptException("Script attempted OP_EQUAL on too small stack")
-                    res = self.datastack.pop() == self.datastack.pop()
-                    self.datastack.append(bytes([res]))
-                    continue
-
-                if chunk['value'] == OP_EQUALVERIFY:
-                    if len(self.datastack) < 2:
-                        raise ScriptException("Script attempted OP_EQUALVERIFY on too small stack")
-                    if not self.datastack.pop() == self.datastack.pop():
-                        raise ScriptFailure("OP_EQUALVERIFY failed")
-                    continue
-
-                #
-                # NUMERIC
-                #
-
-                if chunk['value'] in [OP_1ADD, OP_1SUB, OP_NEGATE, OP_ABS, OP_NOT, OP_0NOTEQUAL]:
-                    if len(self.datastack) < 1:
-                        raise ScriptException("Script attempted single-numeric opcode on empty stack")
-
-                    val = scriptnum_to_int(self.datastack.pop())
-
-                    if chunk['value'] == OP_1ADD:
-                        val += 1
-                    elif chunk['value'] == OP_1SUB:
-                        val -= 1
-                    elif chunk['value'] == OP_NEGATE:
-                        val *= -1
-                    elif chunk['value'] == OP_ABS:
-                        val = abs(val)
-                    elif chunk['value'] == OP_NOT:
-                        val = 1 if val == 0 else 0
-                    elif chunk['value'] == OP_0NOTEQUAL:
-                        val = 0 if val == 0 else 1
-                    else:
-                        raise Exception("Reached unreachable code path, fix your logic")
-
-                    self.datastack.append(int_to_scriptnum(val))
-                    continue
-
-                if chunk['value'] in [OP_ADD, OP_SUB, OP_BOOLAND, OP_BOOLOR, OP_NUMEQUAL, OP_NUMEQUALVERIFY,
-                    OP_NUMNOTEQUAL, OP_LESSTHAN, OP_GREATERTHAN, OP_LESSTHANOREQUAL, OP_GREATERTHANOREQUAL, OP_MIN,
-                    OP_MAX]:
-
-                    if len(self.datastack) < 2:
-                        raise ScriptException("Script attempted double-numeric opcode on too small stack")
-
-                    val2, val1 = scriptnum_to_int(self.datastack.pop()), scriptnum_to_int(self.datastack.pop())
-
-                    if chunk['value'] == OP_ADD:
-                        res = val1 + val2
-                    elif chunk['value'] == OP_SUB:
-                        res = val1 - val2
-                    elif chunk['value'] == OP_BOOLAND:
-                        res = 1 if val1 != 0 and val2 != 0 else 0
-                    elif chunk['value'] == OP_BOOLOR:
-                        res = 1 if val1 != 0 or val2 != 0 else 0
-                    elif chunk['value'] == OP_NUMEQUAL or chunk['value'] == OP_NUMEQUALVERIFY:
-                        res = 1 if val1 == val2 else 0
-                    elif chunk['value'] == OP_NUMNOTEQUAL:
-                        res = 1 if val1 != val2 else 0
-                    elif chunk['value'] == OP_LESSTHAN:
-                        res = 1 if val1 < val2 else 0
-                    elif chunk['value'] == OP_GREATERTHAN:
-                        res = 1 if val1 > val2 else 0
-                    elif chunk['value'] == OP_LESSTHANOREQUAL:
-                        res = 1 if val1 <= val2 else 0
-                    elif chunk['value'] == OP_GREATERTHANOREQUAL:
-                        res = 1 if val1 >= val2 else 0
-                    elif chunk['value'] == OP_MIN:
-                        res = min(val1, val2)
-                    elif chunk['value'] == OP_MAX:
-                        res = max(val1, val2)
-
-                    if chunk['value'] == OP_NUMEQUALVERIFY:
-                        # OP_NUMEQUALVERIFY doesn't add the result to the stack; it just verifies it
-                        if not cast_to_bool(res):
-                            raise ScriptFailure("OP_NUMEQUALVERIFY failed")
-                    else:
-                        self.datastack.append(res)
-                    continue
-
-                if chunk['value'] == OP_WITHIN:
-                    if len(self.datastack) < 3:
-                        raise ScriptException("Script attempted OP_WITHIN on too small stack")
-                    max_ = scriptnum_to_int(self.datastack.pop())
-                    min_ = scriptnum_to_int(self.datastack.pop())
-                    val = scriptnum_to_int(self.datastack.pop())
-                    res = val >= min_ and val < max_
-                    self.datastack.append(bytes([res]))
-                    continue
-
-                #
-                # CRYPTO
-                #
-
-                if chunk['value'] == OP_RIPEMD160:
-                    if len(self.datastack) < 1:
-                        raise ScriptException("Script attempted OP_RIPEMD160 on empty stack")
-                    self.datastack.append(hashlib.new('ripemd160', self.datastack.pop()).digest())
-                    continue
-
-                if chunk['value'] == OP_SHA1:
-                    if len(self.datastack) < 1:
-                        raise ScriptException("Script attempted OP_SHA1 on empty stack")
-                    self.datastack.append(hashlib.new('sha1', self.datastack.pop()).digest())
-                    continue
-
-                if chunk['value'] == OP_SHA256:
-                    if len(self.datastack) < 1:
-                        raise ScriptException("Script attempted OP_SHA256 on empty stack")
-                    self.datastack.append(hashlib.new('sha256', self.datastack.pop()).digest())
-                    continue
-
-                if chunk['value'] == OP_HASH160:
-                    if len(self.datastack) < 1:
-                        raise ScriptException("Script attempted OP_HASH160 on empty stack")
-
-                    res = hashlib.new('sha256', self.datastack.pop()).digest()
-                    res = hashlib.new('ripemd160', res).digest()
-                    self.datastack.append(res)
-                    continue
-
-                if chunk['value'] == OP_HASH256:
-                    if len(self.datastack) < 1:
-                        raise ScriptException("Script attempted OP_HASH256 on empty stack")
-
-                    res = hashlib.new('sha256', self.datastack.pop()).digest()
-                    res = hashlib.new('sha256', res).digest()
-                    self.datastack.append(res)
-                    continue
-
-                if chunk['value'] == OP_CODESEPARATOR:
-                    last_code_separator_index = chunk['start_index'] + 1
-
-                if chunk['value'] in [OP_CHECKSIG, OP_CHECKSIGVERIFY]:
-                    if len(self.datastack) < 2:
-                        raise ScriptException("Script attempted OP_CHECKSIG* on too small stack")
-
-                    pub_key = self.datastack.pop()
-                    signature = self.datastack.pop()
-
-                    # TODO: WIP
-
-                    if chunk['value'] == OP_CHECKSIG:
-                        self.datastack.append(bytes[sig_valid])
-                    elif chunk['value'] == OP_CHECKSIGVERIFY:
-                        if not sig_valid:
-                            raise ScriptFailure("OP_CHECKSIGVERIFY failed")
-
-    def cast_to_bool(data):
-        """Evaluate data to boolean. Exclude 0x80 from last byte because "Can be negative zero" -reference client.
-        https://github.com/bitcoin/bitcoin/blob/0.9.0/src/script.cpp#L44"""
-        return any([b != 0 for b in data[:-1]]) or (data[-1] != 0 and data[-1] != 0x80)
-
-    def int_to_scriptnum(num):
-        """Convert an integer to the interesting number format used in Script. See https://en.bitcoin.it/wiki/Script"""
-        return num2mpi(num, include_length=False)[::-1]
-
-    def scriptnum_to_int(snum):
-        """Convert the interesting number format used in Script to an integer. See https://en.bitcoin.it/wiki/Script"""
-        if len(snum) > MAX_SCRIPTNUM_SIZE:
-            # See https://github.com/bitcoin/bitcoin/blob/0.9.0/src/script.cpp#L38
-            raise ScriptException("Script tried to use an integer larger than %s bytes" % MAX_SCRIPTNUM_SIZE)
-        return mpi2num(snum[::-1], has_length=False)
+                # OP_PUSHDATA4 should never be used, as pushes over 520 bytes are not allowed, and
+                # those below can be done using OP_PUSHDATA2, but we'll implement it nevertheless
+                size = PUSHDATA_SIZES[opcode]
+                if i + size > len(script):
+                    raise ScriptException("Script ends in the middle of a pushdata length")
+                read_length = int.from_bytes(script[i:i+size], byteorder='little')
+                i += size
+            if read_length > Script.MAX_SCRIPT_DATA_SIZE:
+                raise ScriptException("Script pushed %s bytes of data, max is %s" % (read_length, Script.MAX_SCRIPT_DATA_SIZE))
+            if i + read_length > len(script):
+                raise ScriptException("Script pushes %s bytes, but only %s remain" % (read_length, len(script) - i))
+            chunks.append((opcode, script[i:i+read_length], start_index))
+            i += read_length
+        else:
+            if opcode > OP_16:
+                # Note how OP_RESERVED does not count towards the opcode limit.
+                # https://github.com/bitcoin/bitcoin/blob/0.9.0/src/script.cpp#L335
+                opcode_count += 1
+                if opcode_count > Script.MAX_OPCODE_COUNT:
+                    raise ScriptException("Script contains more than the allowed %s opcodes" % Script.MAX_OPCODE_COUNT)
+            chunks.append((opcode, None, start_index))
+    return tuple(chunks), opcode_count
 
 class ScriptFailure(Exception):
     """Thrown if a valid operation caused the script to fail verification."""
 
 class ScriptException(ScriptFailure):
     """Thrown if the provided script has a syntax error or is otherwise invalid according to the Bitcoin Script rules."""
+
+def cast_to_bool(data):
+    """Evaluate data to boolean. Exclude 0x80 from last byte because "Can be negative zero" -reference client.
+    https://github.com/bitcoin/bitcoin/blob/0.9.0/src/script.cpp#L44"""
+    if len(data) == 0:
+        return False
+    return any(b != 0 for b in data[:-1]) or (data[-1] != 0 and data[-1] != 0x80)
+
+def int_to_scriptnum(num):
+    """Convert an integer to the interesting number format used in Script. See https://en.bitcoin.it/wiki/Script"""
+    return num2mpi(num, include_length=False)[::-1]
+
+def scriptnum_to_int(snum):
+    """Convert the interesting number format used in Script to an integer. See https://en.bitcoin.it/wiki/Script"""
+    if len(snum) > Script.MAX_SCRIPTNUM_SIZE:
+        # See https://github.com/bitcoin/bitcoin/blob/0.9.0/src/script.cpp#L38
+        raise ScriptException("Script tried to use an integer larger than %s bytes" % Script.MAX_SCRIPTNUM_SIZE)
+    return mpi2num(snum[::-1], has_length=False)
+
+TRUE = b'\x01'
+FALSE = b''
+
+# The length of the size of the pushed data following OP_PUSHDATA*
+PUSHDATA_SIZES = {OP_PUSHDATA1: 1, OP_PUSHDATA2: 2, OP_PUSHDATA4: 4}
+
+# Opcode -> name, for error messages. Where there are aliases, like OP_0 and OP_FALSE, the first is used.
+OPCODE_NAMES = ['OP_UNKNOWN_%#x' % opcode for opcode in range(256)]
+for name, opcode in reversed(list(vars(script_opcodes).items())):
+    if name.startswith('OP_'):
+        OPCODE_NAMES[opcode] = name
+
+# Opcodes handled even in branches which aren't taken. OP_VERIF and OP_VERNOTIF have no handler, so they fail the
+# script wherever they are.
+FLOW_CONTROL_OPCODES = frozenset([OP_IF, OP_NOTIF, OP_ELSE, OP_ENDIF, OP_VERIF, OP_VERNOTIF])
+DISABLED_OPCODES = frozenset([OP_CAT, OP_SUBSTR, OP_LEFT, OP_RIGHT, OP_INVERT, OP_AND, OP_OR, OP_XOR, OP_2MUL,
+    OP_2DIV, OP_MUL, OP_DIV, OP_MOD, OP_LSHIFT, OP_RSHIFT])
+NOP_OPCODES = frozenset([OP_NOP, OP_NOP1, OP_NOP2, OP_NOP3, OP_NOP4, OP_NOP5, OP_NOP6, OP_NOP7, OP_NOP8, OP_NOP9,
+    OP_NOP10])
+
+def invalid_opcode(script, opcode, chunk):
+    raise ScriptException("Script contains invalid operation %s" % OPCODE_NAMES[opcode])
+
+# Opcode -> (handler, minimum stack size). Handlers are called with the script, the opcode and the chunk, after the
+# stack size is checked. Opcodes without a handler are invalid.
+HANDLERS = [(invalid_opcode, 0)] * 256
+
+def handles(*opcodes, stack=0):
+    """Register the decorated function as the handler of the given opcodes, which need at least `stack` items on
+    the data stack"""
+    def register(handler):
+        for opcode in opcodes:
+            HANDLERS[opcode] = (handler, stack)
+        return handler
+    return register
+
+@handles(*DISABLED_OPCODES)
+def disabled_opcode(script, opcode, chunk):
+    raise ScriptException("Script contains disabled operation %s" % OPCODE_NAMES[opcode])
+
+#
+# PUSH VALUE
+#
+
+# Opcode -> the value pushed: -1 for OP_1NEGATE, 1 for OP_1, 2 for OP_2, ..., 16 for OP_16
+PUSH_VALUES = {opcode: int_to_scriptnum(opcode + 1 - OP_1) for opcode in (OP_1NEGATE, *range(OP_1, OP_16 + 1))}
+
+@handles(*PUSH_VALUES)
+def push_value(script, opcode, chunk):
+    script.datastack.append(PUSH_VALUES[opcode])
+
+#
+# FLOW CONTROL
+#
+
+@handles(*NOP_OPCODES)
+def nop(script, opcode, chunk):
+    pass
+
+@handles(OP_IF, OP_NOTIF)
+def op_if(script, opcode, chunk):
+    if not script.executing:
+        # Append an irrelevant value to the flow control stack to keep track of nesting
+        script.ifstack.append(False)
+        return
+    if len(script.datastack) == 0:
+        raise ScriptException("Script attempted %s on empty stack" % OPCODE_NAMES[opcode])
+    value = cast_to_bool(script.datastack.pop())
+    script.ifstack.append(value if opcode == OP_IF else not value)
+    script.executing = value if opcode == OP_IF else not value
+
+@handles(OP_ELSE)
+def op_else(script, opcode, chunk):
+    if len(script.ifstack) == 0:
+        raise ScriptException("Script attempted OP_ELSE on empty if-stack")
+    script.ifstack[-1] = not script.ifstack[-1]
+    script.executing = False not in script.ifstack
+
+@handles(OP_ENDIF)
+def op_endif(script, opcode, chunk):
+    if len(script.ifstack) == 0:
+        raise ScriptException("Script attempted OP_ENDIF on empty if-stack")
+    script.ifstack.pop()
+    script.executing = False not in script.ifstack
+
+@handles(OP_VERIFY, stack=1)
+def op_verify(script, opcode, chunk):
+    if not cast_to_bool(script.datastack.pop()):
+        raise ScriptFailure("OP_VERIFY failed")
+
+@handles(OP_RETURN)
+def op_return(script, opcode, chunk):
+    raise ScriptFailure("Script used OP_RETURN")
+
+#
+# STACK OPERATIONS
+#
+
+@handles(OP_TOALTSTACK, stack=1)
+def op_toaltstack(script, opcode, chunk):
+    script.altstack.append(script.datastack.pop())
+
+@handles(OP_FROMALTSTACK)
+def op_fromaltstack(script, opcode, chunk):
+    if len(script.altstack) < 1:
+        raise ScriptException("Script attempted OP_FROMALTSTACK on empty stack")
+    script.datastack.append(script.altstack.pop())
+
+@handles(OP_2DROP, stack=2)
+def op_2drop(script, opcode, chunk):
+    del script.datastack[-2:]
+
+@handles(OP_2DUP, stack=2)
+def op_2dup(script, opcode, chunk):
+    script.datastack.extend(script.datastack[-2:])
+
+@handles(OP_3DUP, stack=3)
+def op_3dup(script, opcode, chunk):
+    script.datastack.extend(script.datastack[-3:])
+
+@handles(OP_2OVER, stack=4)
+def op_2over(script, opcode, chunk):
+    script.datastack.extend(script.datastack[-4:-2])
+
+@handles(OP_2ROT, stack=6)
+def op_2rot(script, opcode, chunk):
+    script.datastack.append(script.datastack.pop(-6))
+    script.datastack.append(script.datastack.pop(-6))
+
+@handles(OP_2SWAP, stack=4)
+def op_2swap(script, opcode, chunk):
+    stack = script.datastack
+    stack[-4:] = stack[-2:] + stack[-4:-2]
+
+@handles(OP_IFDUP, stack=1)
+def op_ifdup(script, opcode, chunk):
+    if cast_to_bool(script.datastack[-1]):
+        script.datastack.append(script.datastack[-1])
+
+@handles(OP_DEPTH)
+def op_depth(script, opcode, chunk):
+    script.datastack.append(int_to_scriptnum(len(script.datastack)))
+
+@handles(OP_DROP, stack=1)
+def op_drop(script, opcode, chunk):
+    script.datastack.pop()
+
+@handles(OP_DUP, stack=1)
+def op_dup(script, opcode, chunk):
+    script.datastack.append(script.datastack[-1])
+
+@handles(OP_NIP, stack=2)
+def op_nip(script, opcode, chunk):
+    script.datastack.pop(-2)
+
+@handles(OP_OVER, stack=2)
+def op_over(script, opcode, chunk):
+    script.datastack.append(script.datastack[-2])
+
+@handles(OP_PICK, OP_ROLL, stack=2)
+def op_pick(script, opcode, chunk):
+    n = scriptnum_to_int(script.datastack.pop())
+    if n < 0 or n >= len(script.datastack):
+        raise ScriptException("%s at index %s on too small stack" % (OPCODE_NAMES[opcode], n))
+    if opcode == OP_PICK:
+        script.datastack.append(script.datastack[-n - 1])
+    else:
+        script.datastack.append(script.datastack.pop(-n - 1))
+
+@handles(OP_ROT, stack=3)
+def op_rot(script, opcode, chunk):
+    script.datastack.append(script.datastack.pop(-3))
+
+@handles(OP_SWAP, stack=2)
+def op_swap(script, opcode, chunk):
+    script.datastack.append(script.datastack.pop(-2))
+
+@handles(OP_TUCK, stack=2)
+def op_tuck(script, opcode, chunk):
+    script.datastack.insert(-2, script.datastack[-1])
+
+@handles(OP_SIZE, stack=1)
+def op_size(script, opcode, chunk):
+    script.datastack.append(int_to_scriptnum(len(script.datastack[-1])))
+
+#
+# BITWISE LOGIC
+#
+
+@handles(OP_EQUAL, stack=2)
+def op_equal(script, opcode, chunk):
+    script.datastack.append(TRUE if script.datastack.pop() == script.datastack.pop() else FALSE)
+
+@handles(OP_EQUALVERIFY, stack=2)
+def op_equalverify(script, opcode, chunk):
+    if script.datastack.pop() != script.datastack.pop():
+        raise ScriptFailure("OP_EQUALVERIFY failed")
+
+#
+# NUMERIC
+#
+
+UNARY_OPERATIONS = {
+    OP_1ADD: lambda val: val + 1,
+    OP_1SUB: lambda val: val - 1,
+    OP_NEGATE: lambda val: -val,
+    OP_ABS: abs,
+    OP_NOT: lambda val: 1 if val == 0 else 0,
+    OP_0NOTEQUAL: lambda val: 0 if val == 0 else 1,
+}
+
+@handles(*UNARY_OPERATIONS, stack=1)
+def unary_operation(script, opcode, chunk):
+    val = scriptnum_to_int(script.datastack.pop())
+    script.datastack.append(int_to_scriptnum(UNARY_OPERATIONS[opcode](val)))
+
+BINARY_OPERATIONS = {
+    OP_ADD: lambda val1, val2: val1 + val2,
+    OP_SUB: lambda val1, val2: val1 - val2,
+    OP_BOOLAND: lambda val1, val2: 1 if val1 != 0 and val2 != 0 else 0,
+    OP_BOOLOR: lambda val1, val2: 1 if val1 != 0 or val2 != 0 else 0,
+    OP_NUMEQUAL: lambda val1, val2: 1 if val1 == val2 else 0,
+    OP_NUMEQUALVERIFY: lambda val1, val2: 1 if val1 == val2 else 0,
+    OP_NUMNOTEQUAL: lambda val1, val2: 1 if val1 != val2 else 0,
+    OP_LESSTHAN: lambda val1, val2: 1 if val1 < val2 else 0,
+    OP_GREATERTHAN: lambda val1, val2: 1 if val1 > val2 else 0,
+    OP_LESSTHANOREQUAL: lambda val1, val2: 1 if val1 <= val2 else 0,
+    OP_GREATERTHANOREQUAL: lambda val1, val2: 1 if val1 >= val2 else 0,
+    OP_MIN: min,
+    OP_MAX: max,
+}
+
+@handles(*BINARY_OPERATIONS, stack=2)
+def binary_operation(script, opcode, chunk):
+    val2, val1 = scriptnum_to_int(script.datastack.pop()), scriptnum_to_int(script.datastack.pop())
+    res = BINARY_OPERATIONS[opcode](val1, val2)
+    if opcode == OP_NUMEQUALVERIFY:
+        # OP_NUMEQUALVERIFY doesn't add the result to the stack; it just verifies it
+        if not res:
+            raise ScriptFailure("OP_NUMEQUALVERIFY failed")
+    else:
+        script.datastack.append(int_to_scriptnum(res))
+
+@handles(OP_WITHIN, stack=3)
+def op_within(script, opcode, chunk):
+    max_ = scriptnum_to_int(script.datastack.pop())
+    min_ = scriptnum_to_int(script.datastack.pop())
+    val = scriptnum_to_int(script.datastack.pop())
+    script.datastack.append(TRUE if min_ <= val < max_ else FALSE)
+
+#
+# CRYPTO
+#
+
+HASHES = {
+    OP_RIPEMD160: lambda data: hashlib.new('ripemd160', data).digest(),
+    OP_SHA1: lambda data: hashlib.sha1(data).digest(),
+    OP_SHA256: lambda data: hashlib.sha256(data).digest(),
+    OP_HASH160: hash160,
+    OP_HASH256: sha256d,
+}
+
+@handles(*HASHES, stack=1)
+def op_hash(script, opcode, chunk):
+    script.datastack.append(HASHES[opcode](script.datastack.pop()))
+
+@handles(OP_CODESEPARATOR)
+def op_codeseparator(script, opcode, chunk):
+    script.last_code_separator_index = chunk[2] + 1
+
+@handles(OP_CHECKSIG, OP_CHECKSIGVERIFY, stack=2)
+def op_checksig(script, opcode, chunk):
+    pubkey = script.datastack.pop()
+    signature = script.datastack.pop()
+    valid = script.check_signature(signature, pubkey)
+    if opcode == OP_CHECKSIG:
+        script.datastack.append(TRUE if valid else FALSE)
+    elif not valid:
+        raise ScriptFailure("OP_CHECKSIGVERIFY failed")
+
+@handles(OP_CHECKMULTISIG, OP_CHECKMULTISIGVERIFY, stack=1)
+def op_checkmultisig(script, opcode, chunk):
+    stack = script.datastack
+    pubkey_count = scriptnum_to_int(stack.pop())
+    if pubkey_count < 0 or pubkey_count > Script.MAX_PUBKEYS_PER_MULTISIG:
+        raise ScriptException("Script attempted %s with %s public keys" % (OPCODE_NAMES[opcode], pubkey_count))
+    script.opcode_count += pubkey_count
+    if script.opcode_count > Script.MAX_OPCODE_COUNT:
+        raise ScriptException("Script contains more than the allowed %s opcodes" % Script.MAX_OPCODE_COUNT)
+    if len(stack) < pubkey_count + 1:
+        raise ScriptException("Script attempted %s on too small stack" % OPCODE_NAMES[opcode])
+    pubkeys = [stack.pop() for i in range(pubkey_count)]
+
+    signature_count = scriptnum_to_int(stack.pop())
+    if signature_count < 0 or signature_count > pubkey_count:
+        raise ScriptException("Script attempted %s with %s signatures" % (OPCODE_NAMES[opcode], signature_count))
+    # One more item is popped, due to an off-by-one error in the reference client which is now part of the rules
+    if len(stack) < signature_count + 1:
+        raise ScriptException("Script attempted %s on too small stack" % OPCODE_NAMES[opcode])
+    signatures = [stack.pop() for i in range(signature_count)]
+    stack.pop()
+
+    # The signatures must be in the same order as their public keys, so each key is tried once
+    valid = True
+    remaining_pubkeys = iter(pubkeys)
+    for signature in signatures:
+        for pubkey in remaining_pubkeys:
+            if script.check_signature(signature, pubkey):
+                break
+        else:
+            valid = False
+            break
+
+    if opcode == OP_CHECKMULTISIG:
+        stack.append(TRUE if valid else FALSE)
+    elif not valid:
+        raise ScriptFailure("OP_CHECKMULTISIGVERIFY failed")
+
+#
+# STANDARD TEMPLATES
+#
+# The standard scripts are recognized from their raw bytes, without parsing or executing them.
+#
+
+NONSTANDARD = 'nonstandard'
+P2PK = 'pubkey'
+P2PKH = 'pubkeyhash'
+P2SH = 'scripthash'
+MULTISIG = 'multisig'
+NULL_DATA = 'nulldata'
+
+PUBKEY_SIZES = (33, 65)
+
+def match_template(script):
+    """Recognize a standard pubkey script. Returns (template, data), where data is:
+
+    - P2PK: the public key
+    - P2PKH and P2SH: the 20-byte hash
+    - MULTISIG: (required signature count, [public keys])
+    - NULL_DATA: [pushed data]
+    - NONSTANDARD: None
+    """
+    length = len(script)
+    if length == 25 and script[0] == OP_DUP and script[1] == OP_HASH160 and script[2] == 20 and \
+            script[23] == OP_EQUALVERIFY and script[24] == OP_CHECKSIG:
+        return P2PKH, script[3:23]
+    if length == 23 and script[0] == OP_HASH160 and script[1] == 20 and script[22] == OP_EQUAL:
+        return P2SH, script[2:22]
+    if length > 0 and script[0] in PUBKEY_SIZES and length == script[0] + 2 and script[-1] == OP_CHECKSIG:
+        return P2PK, script[1:-1]
+    if length == 0 or (script[0] != OP_RETURN and script[-1] != OP_CHECKMULTISIG):
+        return NONSTANDARD, None
+
+    # The remaining templates need to be parsed
+    try:
+        chunks, opcode_count = parse_script(script)
+    except ScriptException:
+        return NONSTANDARD, None
+
+    if script[0] == OP_RETURN:
+        if all(data is not None for opcode, data, start_index in chunks[1:]):
+            return NULL_DATA, [data for opcode, data, start_index in chunks[1:]]
+        return NONSTANDARD, None
+
+    # OP_m <pubkey>... OP_n OP_CHECKMULTISIG
+    if len(chunks) < 4 or chunks[-1][1] is not None:
+        return NONSTANDARD, None
+    required, pubkey_count = chunks[0][0] + 1 - OP_1, chunks[-2][0] + 1 - OP_1
+    pubkeys = [data for opcode, data, start_index in chunks[1:-2]]
+    if not 1 <= required <= pubkey_count <= 16 or pubkey_count != len(pubkeys) or \
+            chunks[0][1] is not None or chunks[-2][1] is not None or \
+            any(pubkey is None or len(pubkey) not in PUBKEY_SIZES for pubkey in pubkeys):
+        return NONSTANDARD, None
+    return MULTISIG, (required, pubkeys)
+
+def extract_addresses(script, coin="bitcoin"):
+    """Return the addresses paid to by the given pubkey script; empty for non-standard scripts and data outputs.
+
+    :param coin: E.g. 'bitcoin' or 'bitcoin_testnet3', see datatypes.values.ADDRESS_VERSIONS
+    """
+    versions = values.ADDRESS_VERSIONS[coin]
+    template, data = match_template(script)
+    if template == P2PKH:
+        return [base58check_encode(versions[P2PKH], data)]
+    elif template == P2SH:
+        return [base58check_encode(versions[P2SH], data)]
+    elif template == P2PK:
+        return [base58check_encode(versions[P2PKH], hash160(data))]
+    elif template == MULTISIG:
+        return [base58check_encode(versions[P2PKH], hash160(pubkey)) for pubkey in data[1]]
+    return []
+
+def verify_script(signature_script, pubkey_script, checker, p2sh=True):
+    """Verify that the signature script satisfies the pubkey script, including the redeem script of P2SH outputs
+    (BIP 16). Returns True or False.
+
+    Spends of P2PKH and P2PK outputs with the standard signature script are verified directly, without the
+    interpreter.
+
+    :param checker: The signature checker, see Script
+    :param p2sh: Whether the BIP 16 rules apply. Before they did, P2SH outputs only checked the hash of the pushed
+                 redeem script, like any other script.
+    """
+    try:
+        template, data = match_template(pubkey_script)
+        if template == P2SH and not p2sh:
+            template = NONSTANDARD
+        if template in (P2PKH, P2PK, P2SH):
+            chunks = parse_script(signature_script)[0]
+            pushes = [PUSH_VALUES.get(opcode) if pushed is None else pushed for opcode, pushed, start_index in chunks]
+            if any(pushed is None for pushed in pushes):
+                # The standard signature scripts only push data, or small numbers (OP_0, OP_1NEGATE, OP_1..OP_16)
+                if template == P2SH:
+                    return False
+                template = NONSTANDARD
+
+            if template == P2PKH and len(pushes) == 2:
+                signature, pubkey = pushes
+                return hash160(pubkey) == data and checker.check_signature(signature, pubkey, pubkey_script)
+            if template == P2PK and len(pushes) == 1:
+                return checker.check_signature(pushes[0], data, pubkey_script)
+            if template == P2SH:
+                if len(pushes) == 0 or hash160(pushes[-1]) != data:
+                    return False
+                return run_script(pushes[-1], pushes[:-1], checker)
+
+        script = Script(signature_script, checker)
+        script.execute()
+        return run_script(pubkey_script, script.datastack, checker)
+    except ScriptFailure:
+        return False
+
+def run_script(script, datastack, checker):
+    """Execute the script on the given stack, and return True if it succeeds with a true value on top"""
+    script = Script(script, checker, datastack)
+    script.execute()
+    return len(script.datastack) > 0 and cast_to_bool(script.datastack[-1])
@@ -0,0 +1,278 @@
+from collections import OrderedDict
+from io import BytesIO
+
+from datatypes import messages, structures
+from script import parse_script, verify_script, OP_CODESEPARATOR, OP_PUSHDATA1, OP_PUSHDATA2, OP_PUSHDATA4
+from util.hashing import sha256d
+
+# Signature hash types, see https://en.bitcoin.it/wiki/OP_CHECKSIG
+SIGHASH_ALL = 1
+SIGHASH_NONE = 2
+SIGHASH_SINGLE = 3
+SIGHASH_ANYONECANPAY = 0x80
+
+# The hash signed by SIGHASH_SINGLE signatures of inputs without a matching output, due to a bug in the reference
+# client which is now part of the rules
+SIGHASH_SINGLE_BUG = b'\x01' + b'\x00' * 31
+
+def signature_hash(transaction, input_index, script_code, hash_type):
+    """Calculate the hash signed by a signature of the given input. See https://en.bitcoin.it/wiki/OP_CHECKSIG
+
+    :param script_code: The script being executed, from the last OP_CODESEPARATOR, with the signature removed. See
+                        remove_signature.
+    :param hash_type: The hash type, which is the last byte of the signature
+    """
+    inputs = [
+        structures.Input(previous_output=i.previous_output, signature_script=b"", sequence=i.sequence)
+        for i in transaction.inputs
+    ]
+    inputs[input_index].signature_script = script_code
+    outputs = list(transaction.outputs)
+
+    base_type = hash_type & 0x1F
+    if base_type == SIGHASH_NONE:
+        # Sign none of the outputs, and let others update the other inputs
+        outputs = []
+        for i, other in enumerate(inputs):
+            if i != input_index:
+                other.sequence = 0
+    elif base_type == SIGHASH_SINGLE:
+        # Sign only the output at the same index as the input
+        if input_index >= len(outputs):
+            return SIGHASH_SINGLE_BUG
+        outputs = [structures.Output(value=-1, pubkey_script=b"") for i in range(input_index)]
+        outputs.append(transaction.outputs[input_index])
+        for i, other in enumerate(inputs):
+            if i != input_index:
+                other.sequence = 0
+
+    if hash_type & SIGHASH_ANYONECANPAY:
+        # Sign only this input
+        inputs = [inputs[input_index]]
+
+    copy = messages.Transaction(
+        version=transaction.version,
+        inputs=inputs,
+        outputs=outputs,
+        lock_time=transaction.lock_time,
+    )
+    stream = BytesIO()
+    copy.serialize(stream)
+    stream.write(hash_type.to_bytes(4, 'little'))
+    return sha256d(stream.getvalue())
+
+def push_data(data):
+    """Return the script which pushes the given data, with the shortest encoding"""
+    length = len(data)
+    if length < OP_PUSHDATA1:
+        return bytes([length]) + data
+    elif length <= 0xFF:
+        return bytes([OP_PUSHDATA1, length]) + data
+    elif length <= 0xFFFF:
+        return bytes([OP_PUSHDATA2]) + length.to_bytes(2, 'little') + data
+    return bytes([OP_PUSHDATA4]) + length.to_bytes(4, 'little') + data
+
+def remove_signature(script_code, signature):
+    """Remove the pushes of the signature and any OP_CODESEPARATORs from the script, since a signature can't sign
+    itself"""
+    chunks = parse_script(script_code)[0]
+    signature_push = push_data(signature)
+    parts = []
+    for i, (opcode, data, start_index) in enumerate(chunks):
+        end_index = chunks[i + 1][2] if i + 1 < len(chunks) else len(script_code)
+        if opcode == OP_CODESEPARATOR:
+            continue
+        part = script_code[start_index:end_index]
+        if data is not None and part == signature_push:
+            continue
+        parts.append(part)
+    return b"".join(parts)
+
+def _read_der_length(der, pos):
+    """Read a DER length at the given position, allowing any number of length bytes. Returns the length and the
+    position after it, or None."""
+    if pos == len(der):
+        return None
+    length = der[pos]
+    pos += 1
+    if length & 0x80:
+        size = length - 0x80
+        if size > len(der) - pos:
+            return None
+        while size > 0 and der[pos] == 0:
+            pos += 1
+            size -= 1
+        if size >= 8:
+            return None
+        length = int.from_bytes(der[pos:pos + size], 'big')
+        pos += size
+    return length, pos
+
+def parse_der_lax(der):
+    """Parse a DER encoded signature into its (r, s) integers, as leniently as OpenSSL did before BIP66 made strict
+    DER a rule: lengths may be padded or use more bytes than needed, and integers may be padded with zeros or
+    negative. Signatures like these are in the block chain. Returns None if the signature can't be parsed, or if r
+    or s don't fit in 32 bytes.
+
+    Ported from ecdsa_signature_parse_der_lax in Bitcoin Core's pubkey.cpp."""
+    # The sequence tag and length; the length is ignored
+    if len(der) < 2 or der[0] != 0x30:
+        return None
+    pos = 2
+    if der[1] & 0x80:
+        size = der[1] - 0x80
+        if size > len(der) - pos:
+            return None
+        pos += size
+
+    integers = []
+    for i in range(2):
+        if pos == len(der) or der[pos] != 0x02:
+            return None
+        length = _read_der_length(der, pos + 1)
+        if length is None or length[0] > len(der) - length[1]:
+            return None
+        length, pos = length
+        value = der[pos:pos + length].lstrip(b'\0')
+        if len(value) > 32:
+            return None
+        integers.append(int.from_bytes(value, 'big'))
+        pos += length
+    return tuple(integers)
+
+class EcdsaBackend(object):
+    """Verifies signatures with the pure-Python ecdsa package. Slow, but has no native dependencies."""
+    name = "ecdsa"
+
+    def __init__(self):
+        import ecdsa
+        self.ecdsa = ecdsa
+
+    def verify(self, pubkey, signature, digest):
+        """Verify the DER encoded signature of the digest, with the serialized public key. The signature is parsed
+        leniently, see parse_der_lax."""
+        ecdsa = self.ecdsa
+        parsed = parse_der_lax(signature)
+        if parsed is None:
+            return False
+        try:
+            key = ecdsa.VerifyingKey.from_string(pubkey, curve=ecdsa.SECP256k1)
+            return key.verify_digest(parsed, digest, sigdecode=lambda parsed, order: parsed)
+        except (ecdsa.BadSignatureError, ecdsa.errors.MalformedPointError, ValueError):
+            return False
+
+class Secp256k1Backend(object):
+    """Verifies signatures with libsecp256k1, through the secp256k1 package. Much faster than EcdsaBackend."""
+    name = "secp256k1"
+
+    def __init__(self):
+        import secp256k1
+        self.secp256k1 = secp256k1
+        # Only used to parse signatures
+        self.parser = secp256k1.PublicKey()
+
+    def verify(self, pubkey, signature, digest):
+        """Verify the DER encoded signature of the digest, with the serialized public key. The signature is parsed
+        leniently, see parse_der_lax."""
+        parsed = parse_der_lax(signature)
+        if parsed is None:
+            return False
+        r, s = parsed
+        try:
+            key = self.secp256k1.PublicKey(pubkey, raw=True)
+            parsed = self.parser.ecdsa_deserialize_compact(r.to_bytes(32, 'big') + s.to_bytes(32, 'big'))
+        except Exception:
+            # The binding raises plain Exceptions for malformed keys and signatures
+            return False
+        # libsecp256k1 only accepts low S values, but both are valid in the block chain
+        was_high, parsed = self.parser.ecdsa_signature_normalize(parsed)
+        return key.ecdsa_verify(digest, parsed, raw=True)
+
+#: Backends in order of preference
+BACKENDS = [Secp256k1Backend, EcdsaBackend]
+
+_default_backend = None
+
+def get_backend(name=None):
+    """Return the backend with the given name, or the fastest one available"""
+    global _default_backend
+    for backend_class in BACKENDS:
+        if name is not None and backend_class.name != name:
+            continue
+        if name is None and _default_backend is not None:
+            return _default_backend
+        try:
+            backend = backend_class()
+        except ImportError:
+            if name is not None:
+                raise
+            continue
+        if name is None:
+            _default_backend = backend
+        return backend
+    raise ImportError("No signature verification backend is available. Install ecdsa or secp256k1.")
+
+class SignatureCache(object):
+    """A bounded LRU set of valid signatures, keyed by (signature hash, public key, signature). A transaction which
+    was verified when it entered the mempool doesn't have its signatures verified again when it's included in a
+    block."""
+
+    MAX_SIZE = 1024 * 64
+
+    def __init__(self, max_size=MAX_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        if key not in self.entries:
+            return False
+        self.entries.move_to_end(key)
+        return True
+
+    def clear(self):
+        self.entries.clear()
+
+    def add(self, key):
+        self.entries[key] = True
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+#: The signature cache shared by the mempool and block validation
+cache = SignatureCache()
+
+class TransactionSignatureChecker(object):
+    """Checks the signatures of an input of a transaction, for the script interpreter (see script.Script)
+
+    :param backend: The verification backend, defaults to the fastest available. See get_backend.
+    :param cache: The signature cache, defaults to the shared one
+    """
+    def __init__(self, transaction, input_index, backend=None, cache=None):
+        self.transaction = transaction
+        self.input_index = input_index
+        self.backend = backend if backend is not None else get_backend()
+        self.cache = cache if cache is not None else globals()['cache']
+
+    def check_signature(self, signature, pubkey, script_code):
+        if len(signature) == 0:
+            return False
+        hash_type = signature[-1]
+        script_code = remove_signature(script_code, signature)
+        digest = signature_hash(self.transaction, self.input_index, script_code, hash_type)
+
+        key = (digest, pubkey, signature)
+        if key in self.cache:
+            return True
+        if not self.backend.verify(pubkey, signature[:-1], digest):
+            return False
+        self.cache.add(key)
+        return True
+
+def verify_input(transaction, input_index, pubkey_script, backend=None, cache=None, p2sh=True):
+    """Verify that the given input of the transaction may spend the output with the given pubkey script. See
+    script.verify_script for `p2sh`."""
+    checker = TransactionSignatureChecker(transaction, input_index, backend, cache)
+    return verify_script(transaction.inputs[input_index].signature_script, pubkey_script, checker, p2sh)
@@ -1,77 +1,653 @@
-from datetime import datetime
+from collections import deque
+from io import BytesIO
+import asyncio
+import time
 
-from net.clients import BitcoinClient
-from datatypes import messages
-from address import AddressBook
-from db.models import Block
+from django.db import transaction
+
+from config import logger
+from net.peers import AsyncBitcoinClient
+from net.inventory import InventoryTracker
+from datatypes import messages, structures, values
+from address import AddressBook, ConnectionManager
+from db.models import Block, InvalidBlock
+from db.store import BlockStore
+from util.hashing import hex_to_hash
 import validator
+import chain
+import utxo
+import mempool
+import compactblocks
+
+class SyncClient(AsyncBitcoinClient):
+    """A peer we're downloading blocks from. Which blocks to request is decided by the BlockDownloader; the client
+    only passes messages on to it.
 
-class SyncClient(BitcoinClient):
-    def __init__(self, *args, **kwargs):
+    :param node: The address.Node of the peer, which records how fast it delivers blocks and whether it misbehaves
+    """
+    def __init__(self, downloader, node=None, *args, **kwargs):
         from testnet import testnet
         if not testnet:
             super(SyncClient, self).__init__(*args, **kwargs)
         else:
             super(SyncClient, self).__init__(coin='bitcoin_testnet3', *args, **kwargs)
 
-        # We'll keep a reference to the highest block for performance. Note that this means the
-        # synchronization should never run in parallel with other processes that writes to the local
-        # block chain.
-        self.prev_block = Block.objects.order_by('height').last()
+        self.downloader = downloader
+        self.node = node
+
+        # When the peer last delivered a block we requested
+        self.last_delivery = 0
+
+        # Hashes of the blocks requested from this peer, which we haven't received yet
+        self.in_flight = set()
+
+        # Whether the peer sends compact blocks we can use
+        self.compact_blocks = False
 
     def on_handshake(self):
-        """Send the initial GetBlocks after handshaking"""
-        self.get_more_blocks()
+        if self.peer_version >= values.SHORT_IDS_BLOCKS_VERSION:
+            # We'll request compact blocks when we need them, rather than have new blocks pushed to us
+            self.send_message(messages.SendCmpct(announce=False, version=1))
+        self.send_message(messages.GetAddr())
+        self.downloader.add_peer(self)
+
+    def on_disconnect(self, exc):
+        self.downloader.remove_peer(self)
+
+    def on_invalid_message(self, exc):
+        logger.warning("Disconnecting from %s: %s" % (self.address, exc))
+        self.downloader.punish(self, self.downloader.INVALID_MESSAGE_SCORE)
 
     def handle_inv(self, header, message):
-        """Request data for any inv - the block handling will sort out random invs"""
-        self.last_expected_block_hash = message.inventory[-1].inv_hash
-        self.send_message(messages.GetData(inventory=message.inventory))
+        self.downloader.handle_inv(self, message)
+
+    def handle_headers(self, header, message):
+        self.downloader.handle_headers(self, message)
 
     def handle_block(self, header, block):
-        """Validate and save new blocks"""
-        if not validator.validate_block(block, self.prev_block):
+        self.downloader.handle_block(self, block, header.length)
+
+    def handle_addr(self, header, message):
+        AddressBook.add_addresses(message.addresses)
+
+    def handle_sendcmpct(self, header, message):
+        if message.version == 1:
+            self.compact_blocks = True
+
+    def handle_cmpctblock(self, header, message):
+        self.downloader.handle_cmpctblock(self, message)
+
+    def handle_blocktxn(self, header, message):
+        self.downloader.handle_blocktxn(self, message)
+
+    def handle_notfound(self, header, message):
+        self.downloader.handle_notfound(self, message)
+
+    def handle_tx(self, header, transaction):
+        self.downloader.handle_tx(self, transaction)
+
+    def handle_mempool(self, header, message):
+        self.downloader.handle_mempool(self)
+
+    def handle_getdata(self, header, message):
+        self.downloader.handle_getdata(self, message)
+
+class BlockDownloader(object):
+    """Schedules block downloads across all connected peers.
+
+    In headers-first mode (the default), the header chain is synced first with `getheaders`. Headers are validated
+    on their own and saved in bulk, ahead of the full blocks. The headers of competing branches are kept in a block
+    tree, and when another branch gets more work than ours, we switch to it: the blocks above the fork are
+    disconnected from the UTXO set with their undo data, and the blocks of the new branch are downloaded.
+    Otherwise, block hashes are learned from `inv` replies to `getblocks`, following a single branch.
+
+    Once our chain is synced, announced transactions are downloaded into the mempool, and served to peers asking
+    for them. Transactions are removed from the mempool as the blocks including them are connected. New blocks are
+    then requested as compact blocks from the peers supporting them, and rebuilt from the mempool (see
+    compactblocks.py), so only the transactions we don't have yet are downloaded.
+
+    The hashes of the blocks we want are kept in chain order. They are requested
+    from any peer with free capacity, with at most `MAX_IN_FLIGHT_PER_PEER` outstanding requests per peer, and at
+    most `WINDOW` blocks requested or waiting in the reorder buffer, so a single slow peer can't make the buffer grow
+    without bound. Requests which aren't answered within `REQUEST_TIMEOUT` seconds are given to another peer. Blocks
+    arriving out of order wait in the reorder buffer until all their predecessors are validated and saved.
+    """
+
+    MAX_IN_FLIGHT_PER_PEER = 16
+    WINDOW = 1024
+    REQUEST_TIMEOUT = 60
+
+    # Peers send at most this many headers per message; a shorter reply means there are no more
+    MAX_HEADERS = 2000
+
+    # The most entries of an inv message
+    MAX_INVENTORY = 50000
+
+    # Blocks are requested as compact blocks when our chain is at most this many blocks behind
+    MAX_COMPACT_PENDING = 3
+
+    # Ban scores, see AddressBook.misbehaved
+    INVALID_MESSAGE_SCORE = 20
+    INVALID_BLOCK_SCORE = AddressBook.BAN_SCORE
+
+    # Connected blocks kept in memory, to return their transactions to the mempool in a reorg
+    MAX_RECENT_BLOCKS = 10
+
+    def __init__(self, headers_first=True):
+        from testnet import testnet
+        self.peers = []
+        self.headers_first = headers_first
+        self.utxos = utxo.UnspentOutputSet(coin='bitcoin_testnet3' if testnet else 'bitcoin')
+        self.store = BlockStore(utxos=self.utxos, undo_depth=chain.MAX_REORG_DEPTH)
+        self.scripts = validator.ScriptValidator()
+        self.mempool = mempool.TransactionPool(self.utxos)
+        self.inventory = InventoryTracker(lambda txid: txid in self.mempool)
+        chain.index.load()
+        self.tree = chain.BlockTree()
+        self.tree.load()
+
+        # We'll keep a reference to the highest block for performance. Note that this means the
+        # synchronization should never run in parallel with other processes that writes to the local
+        # block chain.
+        self.prev_block = Block.objects.filter(header_only=False).defer('undo').order_by('height').last()
+
+        # The highest saved header, which is ahead of prev_block while the full blocks are being downloaded
+        self.header_tip = self.tree.get(hex_to_hash(
+            Block.objects.order_by('height').values_list('hash', flat=True).last()))
+        self.headers_synced = False
+
+        # Hashes of the blocks following our tip, in chain order, which aren't validated and saved yet
+        self.pending = deque()
+        self.pending_set = set()
+
+        # Pending hashes which aren't requested from any peer
+        self.queue = deque()
+
+        # Hash -> (peer, request time) of blocks requested from a peer
+        self.in_flight = {}
+
+        # Hash -> (block, the peer which sent it) of received blocks waiting for their predecessors
+        self.received = {}
+
+        # Hash -> saved header, for pending blocks whose headers are already validated and saved
+        self.headers = {}
+
+        # Hash -> compactblocks.PartialBlock of compact blocks waiting for their missing transactions
+        self.partial_blocks = {}
+
+        # (height, transactions) of the last connected blocks, whose transactions go back to the mempool if they're
+        # disconnected in a reorg
+        self.recent_blocks = deque(maxlen=self.MAX_RECENT_BLOCKS)
+
+        # The peer we've asked for more block hashes, if any, and when we'll give up on it
+        self.locator_peer = None
+        self.locator_deadline = 0
+
+        if self.headers_first:
+            # Resume downloading the blocks of headers saved in an earlier run
+            self.queue_headers(Block.objects.filter(header_only=True).order_by('height').iterator())
+
+    def add_peer(self, peer):
+        self.inventory.add_peer(peer)
+        self.peers.append(peer)
+        self.schedule()
+
+    def remove_peer(self, peer):
+        if peer not in self.peers:
+            return
+        self.peers.remove(peer)
+        self.inventory.remove_peer(peer)
+        for block_hash in peer.in_flight:
+            self.partial_blocks.pop(block_hash, None)
+        self.requeue(peer.in_flight)
+        peer.in_flight.clear()
+        if self.locator_peer is peer:
+            self.locator_peer = None
+        self.schedule()
+
+    def is_synced(self):
+        """Whether all the blocks we know of are connected, so the mempool can be validated against our chain"""
+        return self.headers_synced and len(self.pending) == 0
+
+    def handle_inv(self, peer, message):
+        """Queue any blocks we haven't seen before, and request new transactions if we're synced. Transactions are
+        only requested from the first peer announcing them, see InventoryTracker."""
+        msg_tx = values.INVENTORY_TYPE["MSG_TX"]
+        self.inventory.announced(peer, [i.inv_hash for i in message.inventory if i.inv_type != msg_tx], False)
+        wanted = self.inventory.announced(
+            peer, [i.inv_hash for i in message.inventory if i.inv_type == msg_tx], self.is_synced())
+        if len(wanted) > 0:
+            peer.send_message(messages.GetData(
+                inventory=[structures.Inventory(inv_type=msg_tx, inv_hash=txid) for txid in wanted]))
+
+        if self.headers_first:
+            # Newly announced blocks; get their headers first
+            if any(i.inv_type == values.INVENTORY_TYPE["MSG_BLOCK"] for i in message.inventory):
+                self.headers_synced = False
+                self.schedule()
+            return
+
+        if peer is self.locator_peer:
+            self.locator_peer = None
+        tip_hash = self.prev_block.calculate_hash()
+        for inventory in message.inventory:
+            if inventory.inv_type != values.INVENTORY_TYPE["MSG_BLOCK"]:
+                continue
+            if inventory.inv_hash in self.pending_set or inventory.inv_hash == tip_hash:
+                continue
+            if inventory.inv_hash in self.tree.invalid:
+                continue
+            self.pending.append(inventory.inv_hash)
+            self.pending_set.add(inventory.inv_hash)
+            self.queue.append(inventory.inv_hash)
+        self.schedule()
+
+    def handle_headers(self, peer, message):
+        """Validate a batch of headers and add them to the block tree. If they make another branch the best one,
+        switch to it; the new headers of our branch are saved all at once, and their blocks queued for download."""
+        if peer is self.locator_peer:
+            self.locator_peer = None
+
+        valid = True
+        for header in message.headers:
+            block_hash = header.calculate_hash()
+            if block_hash in self.tree.invalid or header.prev_hash in self.tree.invalid:
+                # A block we found invalid, or one descending from it
+                valid = False
+                self.punish(peer, self.INVALID_BLOCK_SCORE)
+                break
+            if block_hash in self.tree:
+                continue
+            prev_block = self.tree.get(header.prev_hash)
+            if prev_block is None:
+                # A chain we can't connect to. Don't waste more time on this peer.
+                valid = False
+                peer.disconnect()
+                break
+            if not validator.validate_header(header, prev_block, self.tree):
+                valid = False
+                self.punish(peer, AddressBook.BAN_SCORE)
+                break
+            header.prev_block = prev_block
+            header.height = prev_block.height + 1
+            header.header_only = True
+            self.tree.add(header)
+
+        self.switch_to(self.tree.get_best(self.header_tip))
+
+        if valid and len(message.headers) < self.MAX_HEADERS:
+            self.headers_synced = True
+        self.schedule()
+
+    def switch_to(self, tip):
+        """Make the given header in the block tree the tip of our header chain, reorganizing if it isn't on our
+        branch"""
+        if tip is self.header_tip:
+            return
+        fork = self.tree.find_fork(self.header_tip, tip)
+        if fork.calculate_hash() != self.header_tip.calculate_hash():
+            self.disconnect_to(fork)
+        headers = self.tree.get_branch(fork, tip)
+        for header in headers:
+            header.header_only = True
+            chain.index.append(header)
+        Block.objects.bulk_insert(headers)
+        self.header_tip = tip
+        self.queue_headers(headers)
+        self.tree.prune(tip)
+
+    def disconnect_to(self, fork):
+        """Remove the blocks and headers above the fork from our chain. Full blocks are disconnected from the UTXO
+        set with their saved undo data, so even a reorg from the best block doesn't need more than a few queries."""
+        logger.info("Reorganizing from block #%s to #%s" % (self.header_tip.height, fork.height))
+        self.store.flush()
+        disconnecting = fork.height < self.prev_block.height
+        with transaction.atomic():
+            if disconnecting:
+                undos = list(Block.objects.filter(height__gt=fork.height, header_only=False).order_by(
+                    '-height').values_list('undo', flat=True))
+                for undo in undos:
+                    self.utxos.disconnect_block(utxo.BlockUndo.from_stream(BytesIO(undo)))
+                self.utxos.flush()
+                self.prev_block = Block.objects.defer('undo').get(hash=fork.calculate_hash())
+            Block.objects.filter(height__gt=fork.height).delete()
+        chain.index.truncate(fork.height)
+        if disconnecting:
+            # The transactions of the disconnected blocks go back to the mempool. In reorgs deeper than
+            # MAX_RECENT_BLOCKS, those of the older blocks are lost until peers announce them again.
+            disconnected = []
+            while len(self.recent_blocks) > 0 and self.recent_blocks[-1][0] > fork.height:
+                disconnected.append(self.recent_blocks.pop()[1])
+            self.mempool.reorganize([t for transactions in reversed(disconnected) for t in transactions[1:]],
+                fork.height + 1)
+        self.header_tip = fork
+        self.reset()
+
+    def queue_headers(self, headers):
+        """Queue the blocks of the given saved headers for download"""
+        for header in headers:
+            block_hash = header.calculate_hash()
+            self.headers[block_hash] = header
+            self.pending.append(block_hash)
+            self.pending_set.add(block_hash)
+            self.queue.append(block_hash)
+
+    def handle_block(self, peer, block, size=None):
+        """Queue a received block for validation. Given the `size` of its message, the rate at which the peer
+        delivered it is recorded, counting from the later of its request and the peer's previous delivery."""
+        block_hash = block.calculate_hash()
+        if block_hash not in self.pending_set or block_hash in self.received:
+            # Unsolicited or duplicate block
+            return
+
+        # The block may have been re-requested from another peer after a timeout
+        requested = self.in_flight.pop(block_hash, None)
+        if requested is not None:
+            requested[0].in_flight.discard(block_hash)
+            if requested[0] is peer and size is not None and peer.node is not None:
+                now = time.time()
+                AddressBook.delivered(peer.node, size, now - max(requested[1], peer.last_delivery))
+                peer.last_delivery = now
+        peer.in_flight.discard(block_hash)
+        self.received[block_hash] = (block, peer)
+        self.connect_received()
+        self.schedule()
+
+    def handle_tx(self, peer, transaction):
+        """Add the transaction to the mempool, and announce it to the peers which don't know it yet"""
+        if not self.is_synced():
+            return
+        txid = transaction.txid
+        accepted = self.mempool.accept(transaction, self.prev_block.height + 1)
+        self.inventory.received(peer, txid, accepted)
+        if not accepted:
             return
+        inventory = [structures.Inventory(inv_type=values.INVENTORY_TYPE["MSG_TX"], inv_hash=txid)]
+        for other in self.peers:
+            if other is not peer and self.inventory.should_announce(other, txid):
+                other.send_message(messages.InventoryVector(inventory=inventory))
 
-        # Save the new block
-        block.prev_block = self.prev_block
-        block.height = self.prev_block.height + 1
-        block.save()
-        self.prev_block = block
+    def handle_mempool(self, peer):
+        """Announce the transactions in our mempool"""
+        inventory = [structures.Inventory(inv_type=values.INVENTORY_TYPE["MSG_TX"], inv_hash=txid)
+            for txid in self.mempool.entries if self.inventory.should_announce(peer, txid)]
+        for i in range(0, len(inventory), self.MAX_INVENTORY):
+            peer.send_message(messages.InventoryVector(inventory=inventory[i:i + self.MAX_INVENTORY]))
 
-        if block.calculate_hash() == self.last_expected_block_hash:
-            # Last hash of the expected invs - fetch more
+    def handle_getdata(self, peer, message):
+        """Send the requested transactions of our mempool"""
+        missing = []
+        for inventory in message.inventory:
+            transaction = None
+            if inventory.inv_type == values.INVENTORY_TYPE["MSG_TX"]:
+                transaction = self.mempool.get(inventory.inv_hash)
+            if transaction is not None:
+                peer.send_message(transaction)
+            else:
+                missing.append(inventory)
+        if len(missing) > 0:
+            peer.send_message(messages.NotFound(inventory=missing))
+
+    def handle_cmpctblock(self, peer, message):
+        """Rebuild a requested compact block from the mempool, and request the transactions we don't have"""
+        block_hash = message.header.calculate_hash()
+        if block_hash not in peer.in_flight or block_hash in self.partial_blocks:
+            return
+        try:
+            partial = compactblocks.PartialBlock(message, self.mempool)
+        except ValueError:
+            self.request_full_block(peer, block_hash)
+            return
+        if len(partial.missing) > 0:
+            self.partial_blocks[block_hash] = partial
+            peer.send_message(messages.GetBlockTxn(block_hash=block_hash, indexes=partial.missing))
+            return
+        self.complete_partial_block(peer, block_hash, partial)
+
+    def handle_blocktxn(self, peer, message):
+        partial = self.partial_blocks.get(message.block_hash)
+        if partial is None or message.block_hash not in peer.in_flight:
+            return
+        del self.partial_blocks[message.block_hash]
+        try:
+            partial.fill(message.transactions)
+        except ValueError:
+            self.request_full_block(peer, message.block_hash)
+            return
+        self.complete_partial_block(peer, message.block_hash, partial)
+
+    def complete_partial_block(self, peer, block_hash, partial):
+        block = partial.get_block()
+        if block is None:
+            # A short id collision with our mempool
+            self.request_full_block(peer, block_hash)
+            return
+        self.handle_block(peer, block)
+
+    def request_full_block(self, peer, block_hash):
+        """Request a block we asked for as a compact block again, in full"""
+        peer.send_message(messages.GetData(inventory=[
+            structures.Inventory(inv_type=values.INVENTORY_TYPE["MSG_BLOCK"], inv_hash=block_hash)]))
+
+    def handle_notfound(self, peer, message):
+        """The peer doesn't have the blocks; ask someone else"""
+        self.inventory.not_found(
+            [i.inv_hash for i in message.inventory if i.inv_type == values.INVENTORY_TYPE["MSG_TX"]])
+        hashes = [i.inv_hash for i in message.inventory if i.inv_hash in peer.in_flight]
+        peer.in_flight.difference_update(hashes)
+        self.requeue(hashes)
+        self.schedule()
+
+    def connect_received(self):
+        """Validate and save received blocks, in chain order. The scripts of all the blocks which are ready are
+        verified at once, spread over the workers of the script validator."""
+        blocks = []
+        while len(self.pending) > 0 and self.pending[0] in self.received:
+            block_hash = self.pending.popleft()
+            self.pending_set.discard(block_hash)
+            blocks.append((block_hash, self.received.pop(block_hash)))
+        if len(blocks) == 0:
+            return
+
+        self.utxos.load_spent([block for block_hash, (block, peer) in blocks])
+        verdicts = self.scripts.validate([block for block_hash, (block, peer) in blocks], self.utxos.get_pubkey_script)
+        for (block_hash, (block, peer)), valid in zip(blocks, verdicts):
+            # The header may have been validated and saved when the header chain was synced
+            header = self.headers.pop(block_hash, None)
+            if header is None and not validator.validate_block(block, self.prev_block):
+                valid = False
+            elif header is not None and not validator.validate_transactions(block):
+                valid = False
+            height = self.prev_block.height + 1
+            undo = self.utxos.connect_block(block, height) if valid else None
+            if undo is None:
+                # Don't download the rest from the peer which sent an invalid block. None of the following blocks
+                # will connect either.
+                self.punish(peer, self.INVALID_BLOCK_SCORE)
+                self.reject(block_hash, header)
+                return
+            stream = BytesIO()
+            undo.serialize(stream)
+            self.mempool.remove_block(block)
+            self.recent_blocks.append((height, block.transactions))
+            if self.is_synced():
+                self.inventory.clear_rejected()
+
+            if header is not None:
+                self.store.set_validated(header, stream.getvalue())
+                self.prev_block = header
+                continue
+
+            # Save the new block
+            block.prev_block = self.prev_block
+            block.height = height
+            block.undo = stream.getvalue()
+            chain.index.append(block)
+            self.store.add(block)
+            self.prev_block = block
+
+    def reject(self, block_hash, header):
+        """Mark an invalid block and its descendants invalid, in the block tree and the database, so they're never
+        downloaded again. If its header was synced, our header chain above the last valid block is dropped and we
+        switch to the best valid branch; otherwise the download starts over from our tip."""
+        invalid = self.tree.invalidate(block_hash)
+        if header is not None:
+            # The invalid block is the first of our header chain above the last valid block, so the rest descend
+            # from it
+            descendants = set(hex_to_hash(h) for h in Block.objects.filter(
+                height__gt=self.prev_block.height).values_list('hash', flat=True)) - self.tree.invalid
+            self.tree.invalid.update(descendants)
+            invalid.update(descendants)
+        InvalidBlock.objects.bulk_create([InvalidBlock(hash=h) for h in invalid])
+        if header is None:
+            self.reset()
+            return
+
+        # The last valid block may have been pruned from the tree if the header chain got far ahead; reload it
+        # from our chain, which ends there once the invalid headers are removed
+        fork = self.tree.get(self.prev_block.calculate_hash())
+        self.disconnect_to(fork or self.prev_block)
+        if fork is None:
+            self.tree.load()
+            self.header_tip = self.tree.get(self.prev_block.calculate_hash())
+        self.headers_synced = False
+        self.switch_to(self.tree.get_best(self.header_tip))
+
+    def reset(self):
+        for peer in self.peers:
+            peer.in_flight.clear()
+        self.pending.clear()
+        self.pending_set.clear()
+        self.queue.clear()
+        self.in_flight.clear()
+        self.received.clear()
+        self.headers.clear()
+        self.partial_blocks.clear()
+        self.store.flush()
+        if self.headers_first:
+            self.queue_headers(Block.objects.filter(
+                header_only=True, height__gt=self.prev_block.height).order_by('height').iterator())
+
+    def requeue(self, hashes):
+        """Put the given hashes back in the queue, keeping the chain order"""
+        queued = set(self.queue)
+        queued.update(hashes)
+        for block_hash in hashes:
+            self.in_flight.pop(block_hash, None)
+        self.queue = deque(h for h in self.pending if h in queued)
+
+    def schedule(self):
+        """Hand out queued block requests to peers with free capacity, and ask for more block hashes when we're
+        running low"""
+        if len(self.queue) > 0:
+            # Near the tip, most transactions of new blocks are in our mempool already
+            compact = self.headers_synced and len(self.pending) <= self.MAX_COMPACT_PENDING
+            # The fastest of the least busy peers first
+            for peer in sorted(self.peers, key=lambda p: (len(p.in_flight), -self.get_bandwidth(p))):
+                capacity = self.MAX_IN_FLIGHT_PER_PEER - len(peer.in_flight)
+                inv_type = values.INVENTORY_TYPE["MSG_CMPCT_BLOCK" if compact and peer.compact_blocks else "MSG_BLOCK"]
+                inventory = []
+                while capacity > 0 and len(self.queue) > 0 and \
+                        len(self.in_flight) + len(self.received) < self.WINDOW:
+                    block_hash = self.queue.popleft()
+                    if block_hash in self.received or block_hash not in self.pending_set:
+                        # A late answer to a request which timed out
+                        continue
+                    self.in_flight[block_hash] = (peer, time.time())
+                    peer.in_flight.add(block_hash)
+                    inventory.append(structures.Inventory(
+                        inv_type=inv_type,
+                        inv_hash=block_hash,
+                    ))
+                    capacity -= 1
+                if len(inventory) > 0:
+                    peer.send_message(messages.GetData(inventory=inventory))
+
+        if len(self.peers) == 0 or (self.locator_peer is not None and time.time() < self.locator_deadline):
+            # Nobody to ask, or already waiting for an answer
+            return
+
+        if self.headers_first:
+            if not self.headers_synced:
+                self.get_more_headers()
+        elif len(self.pending) < self.WINDOW // 2:
             self.get_more_blocks()
-            # Logic when we're done?
 
-    def handle_notfound(self, header, message):
-        print(message)
+    def get_more_headers(self):
+        self.send_locator(messages.GetHeaders(
+            block_locator_hashes=Synchronizer.get_locator_blocks(self.header_tip),
+        ))
 
     def get_more_blocks(self):
-        self.send_message(messages.GetBlocks(
-            block_locator_hashes=Synchronizer.get_locator_blocks(self.prev_block),
-        ))
+        # Continue from the last block we know of, falling back to our local chain if it has diverged
+        locator = Synchronizer.get_locator_blocks(self.prev_block)
+        if len(self.pending) > 0:
+            locator.insert(0, self.pending[-1])
+        self.send_locator(messages.GetBlocks(block_locator_hashes=locator))
+
+    def send_locator(self, message):
+        self.locator_peer = min(self.peers, key=lambda p: len(p.in_flight))
+        self.locator_deadline = time.time() + self.REQUEST_TIMEOUT
+        self.locator_peer.send_message(message)
+
+    def check_timeouts(self):
+        """Give requests which timed out to other peers. The peers which didn't answer are stalling the whole
+        download, so they're disconnected to make room for better ones."""
+        deadline = time.time() - self.REQUEST_TIMEOUT
+        stalling = set(peer for peer, requested in self.in_flight.values() if requested < deadline)
+        for peer in stalling:
+            if peer.node is not None:
+                AddressBook.stalled(peer.node)
+            self.remove_peer(peer)
+            peer.disconnect()
+        self.schedule()
+
+    def punish(self, peer, score):
+        """Disconnect a misbehaving peer, adding to its ban score"""
+        if peer.node is not None:
+            AddressBook.misbehaved(peer.node, score)
+        self.remove_peer(peer)
+        peer.disconnect()
+
+    @staticmethod
+    def get_bandwidth(peer):
+        """The rate at which the peer delivered blocks, in bytes per second, or 0 if unknown"""
+        if peer.node is None or peer.node.bandwidth is None:
+            return 0
+        return peer.node.bandwidth
 
 class Synchronizer(object):
+    # The number of peers to download from in parallel
+    PEER_COUNT = 8
+
     @staticmethod
     def synchronize():
-        # Test against as for now
-        # node = AddressBook.get_node()
-        client = SyncClient("as")
+        asyncio.run(Synchronizer.run())
+
+    @staticmethod
+    async def run():
+        AddressBook.open()
+        downloader = BlockDownloader()
+        connections = ConnectionManager(
+            lambda node: Synchronizer.connect(downloader, node), target=Synchronizer.PEER_COUNT)
+        while True:
+            # Keep the wanted number of peers connected, replacing the slowest
+            await connections.maintain()
+
+            await asyncio.sleep(downloader.store.flush_interval)
+            downloader.store.flush_if_due()
+            downloader.check_timeouts()
+            connections.evict_slowest()
+            AddressBook.save()
+
+    @staticmethod
+    async def connect(downloader, node):
+        client = await SyncClient.connect(node.ip_address, node.port, downloader=downloader, node=node)
         client.handshake()
-        client.loop()
+        return client
 
     @staticmethod
     def get_locator_blocks(prev_block):
         """When catching up, in case the chain has diverged, use these hashes to detect the newest
         valid block in our local chain. See https://en.bitcoin.it/wiki/Protocol_specification#getblocks"""
-        top = prev_block.height
-        i = top
-        step = 1
-        hashes = []
-        while i >= 0:
-            hashes.append(Block.objects.get(height=i).calculate_hash())
-            if i <= top - 10:
-                step *= 2
-            i -= step
-        return hashes
+        return chain.index.locator(prev_block.height)
@@ -0,0 +1,11 @@
+import os
+import sys
+
+import django
+
+# The modules import each other by their top-level names, as when run from the pitcoin directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Configure Django settings and load the models before importing local code
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "db.settings")
+django.setup()
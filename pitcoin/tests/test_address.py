@@ -0,0 +1,64 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from address import AddressStore, Node
+
+class AddressStoreTest(unittest.TestCase):
+    key = bytes(range(16))
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "peers.dat")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_node(self, i):
+        node = Node("10.0.0.%d" % i, 8333, 1400000000 + i, latency=0.25 * i or None, last_success=1300000000,
+            successes=i, failures=1, attempts=2)
+        node.bucket = i
+        return node
+
+    def test_missing_file(self):
+        self.assertIsNone(AddressStore(self.path).load())
+
+    def test_round_trip(self):
+        store = AddressStore(self.path)
+        nodes = [self.make_node(i) for i in range(3)]
+        store.rewrite(self.key, [AddressStore.to_record(node, AddressStore.NEW) for node in nodes])
+        store.append([AddressStore.to_record(nodes[1], AddressStore.TRIED),
+            AddressStore.to_removal_record(nodes[2].key), AddressStore.to_ban_record("10.0.0.9", 1500000000)])
+        self.assertEqual(os.path.getsize(self.path), AddressStore.HEADER.size + 6 * AddressStore.RECORD.size)
+
+        store = AddressStore(self.path)
+        key, records = store.load()
+        records = list(records)
+        self.assertEqual(key, self.key)
+        self.assertEqual(store.count, 6)
+        self.assertEqual([record[0] for record in records], [AddressStore.NEW] * 3 +
+            [AddressStore.TRIED, AddressStore.REMOVED, AddressStore.BANNED])
+
+        for record, node in zip(records, nodes):
+            loaded, bucket = AddressStore.from_record(record)
+            self.assertEqual(bucket, node.bucket)
+            for name in ('ip_address', 'port', 'time', 'services', 'latency', 'bandwidth', 'last_attempt',
+                    'last_success', 'successes', 'failures', 'attempts'):
+                self.assertEqual(getattr(loaded, name), getattr(node, name), name)
+        self.assertEqual(records[5][4], 1500000000)
+
+    def test_partial_record(self):
+        # A record half-written by a crash is cut off
+        store = AddressStore(self.path)
+        store.rewrite(self.key, [AddressStore.to_record(self.make_node(1), AddressStore.NEW)])
+        with open(self.path, 'ab') as f:
+            f.write(b"\x01" * (AddressStore.RECORD.size // 2))
+        key, records = AddressStore(self.path).load()
+        self.assertEqual(len(list(records)), 1)
+        self.assertEqual(os.path.getsize(self.path), AddressStore.HEADER.size + AddressStore.RECORD.size)
+
+    def test_wrong_magic(self):
+        with open(self.path, 'wb') as f:
+            f.write(b"\0" * 100)
+        self.assertIsNone(AddressStore(self.path).load())
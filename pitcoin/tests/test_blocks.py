@@ -0,0 +1,56 @@
+from io import BytesIO
+import unittest
+
+from db.models import Block
+from util.hashing import hash_to_hex, hex_to_hash
+from util.merkle import merkle_root
+
+GENESIS_BLOCK = bytes.fromhex(
+    "0100000000000000000000000000000000000000000000000000000000000000000000003ba3edfd7a7b12b27ac72c3e67768f617fc81bc3"
+    "888a51323a9fb8aa4b1e5e4a29ab5f49ffff001d1dac2b7c01010000000100000000000000000000000000000000000000000000000000"
+    "00000000000000ffffffff4d04ffff001d0104455468652054696d65732030332f4a616e2f32303039204368616e63656c6c6f72206f"
+    "6e206272696e6b206f66207365636f6e64206261696c6f757420666f722062616e6b73ffffffff0100f2052a01000000434104678afd"
+    "b0fe5548271967f1a67130b7105cd6a828e03909a67962e0ea1f61deb649f6bc3f4cef38c4f35504e51ec112de5c384df7ba0b8d578a"
+    "4c702b6bf11d5fac00000000")
+
+BLOCK_1 = bytes.fromhex(
+    "010000006fe28c0ab6f1b372c1a6a246ae63f74f931e8365e15a089c68d6190000000000982051fd1e4ba744bbbe680e1fee14677ba1a3"
+    "c3540bf7b1cdb606e857233e0e61bc6649ffff001d01e362990101000000010000000000000000000000000000000000000000000000"
+    "000000000000000000ffffffff0704ffff001d0104ffffffff0100f2052a0100000043410496b538e853519c726a2c91e61ec11600ae1"
+    "390813a627c66fb8be7947be63c52da7589379515d4e0a604f8141781e62294721166bf621e73a82cbf2342c858eeac00000000")
+
+class KnownBlocksTest(unittest.TestCase):
+    def check_block(self, raw_block, block_hash, merkle):
+        block = Block(stream=BytesIO(raw_block))
+        self.assertEqual(hash_to_hex(block.calculate_hash()), block_hash)
+        self.assertEqual(hash_to_hex(block.merkle_root), merkle)
+        self.assertEqual(hash_to_hex(merkle_root([t.txid for t in block.transactions])), merkle)
+        stream = BytesIO()
+        block.serialize(stream)
+        self.assertEqual(stream.getvalue(), raw_block)
+        return block
+
+    def test_genesis_block(self):
+        block = self.check_block(GENESIS_BLOCK, "000000000019d6689c085ae165831e934ff763ae46a2a6c172b3f1b60a8ce26f",
+            "4a5e1e4baab89f3a32518a88c31bc87f618f76673e2cc77ab2127b7afdeda33b")
+        self.assertEqual(block.prev_hash, b"\0" * 32)
+        self.assertEqual(block.bits, 0x1d00ffff)
+        self.assertEqual(len(block.transactions), 1)
+
+    def test_block_1(self):
+        block = self.check_block(BLOCK_1, "00000000839a8e6886ab5951d76f411475428afc90947ee320161bbf18eb6048",
+            "0e3e2357e806b6cdb1f70b54c3a3a17b6714ee1f0e68bebb44a74b1efd512098")
+        self.assertEqual(hash_to_hex(block.prev_hash),
+            "000000000019d6689c085ae165831e934ff763ae46a2a6c172b3f1b60a8ce26f")
+
+    def test_merkle_root_of_block_170(self):
+        # The first block with a transaction other than its coinbase
+        txids = [hex_to_hash("b1fea52486ce0c62bb442b530a3f0132b826c74e473d1f2c220bfa78111c5082"),
+            hex_to_hash("f4184fc596403b9d638783cf57adfe4c75c605f6356fbc91338530e9831e9e16")]
+        self.assertEqual(hash_to_hex(merkle_root(txids)),
+            "7dac2c5666815c17a3b36427de37bb9d2e2c5ccec3f8633eb91a4205cb4c10ff")
+
+    def test_merkle_root_of_odd_count(self):
+        # The last hash of a level with an odd count is paired with itself
+        txids = [bytes([i]) * 32 for i in range(3)]
+        self.assertEqual(merkle_root(txids), merkle_root(txids + txids[-1:]))
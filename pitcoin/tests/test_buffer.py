@@ -0,0 +1,83 @@
+from io import BytesIO
+import unittest
+
+from datatypes import structures
+from net.buffer import MessageBuffer, PayloadStream
+from net.exceptions import MessageTooLarge
+
+def make_frame(command, payload, length=None):
+    """Return the serialized header and payload of a message"""
+    header = structures.MessageHeader()
+    header.command = command
+    header.length = len(payload) if length is None else length
+    header.checksum = structures.MessageHeader.calc_checksum(payload)
+    stream = BytesIO()
+    header.serialize(stream)
+    return stream.getvalue() + payload
+
+class MessageBufferTest(unittest.TestCase):
+    def test_complete_frame(self):
+        buffer = MessageBuffer(size=64)
+        buffer.feed(make_frame("ping", b"\1" * 8))
+        header, payload = buffer.next_frame()
+        self.assertEqual(header.command, "ping")
+        self.assertEqual(header.length, 8)
+        self.assertEqual(bytes(payload), b"\1" * 8)
+        payload.release()
+        self.assertEqual(len(buffer), 0)
+        self.assertIsNone(buffer.next_frame())
+
+    def test_partial_frame(self):
+        # A small buffer, so the frame is moved and the buffer grows while it arrives
+        buffer = MessageBuffer(size=16)
+        frame = make_frame("tx", bytes(range(200)))
+        header_size = structures.MessageHeader.calcsize()
+        for start, end in [(0, 10), (10, header_size), (header_size, 100), (100, len(frame) - 1)]:
+            buffer.feed(frame[start:end])
+            self.assertIsNone(buffer.next_frame())
+        buffer.feed(frame[-1:])
+        header, payload = buffer.next_frame()
+        self.assertEqual(header.command, "tx")
+        self.assertEqual(bytes(payload), bytes(range(200)))
+        payload.release()
+
+    def test_pipelined_frames(self):
+        buffer = MessageBuffer(size=64)
+        payloads = [bytes([i]) * i * 10 for i in range(20)]
+        data = b"".join(make_frame("inv", payload) for payload in payloads)
+        # Fed in odd chunks, which split frames anywhere
+        received = []
+        for start in range(0, len(data), 37):
+            buffer.feed(data[start:start + 37])
+            frame = buffer.next_frame()
+            while frame is not None:
+                header, payload = frame
+                self.assertEqual(header.checksum, structures.MessageHeader.calc_checksum(bytes(payload)))
+                received.append(bytes(payload))
+                payload.release()
+                frame = buffer.next_frame()
+        self.assertEqual(received, payloads)
+        self.assertEqual(len(buffer), 0)
+
+    def test_too_large(self):
+        buffer = MessageBuffer(size=64)
+        # Only the header is sent; the announced payload isn't allocated
+        buffer.feed(make_frame("block", b"", length=MessageBuffer.MAX_MESSAGE_SIZE + 1))
+        with self.assertRaises(MessageTooLarge):
+            buffer.next_frame()
+        self.assertLess(len(buffer._data), MessageBuffer.MAX_MESSAGE_SIZE)
+
+    def test_largest_accepted(self):
+        buffer = MessageBuffer(size=64)
+        buffer.feed(make_frame("block", b"", length=MessageBuffer.MAX_MESSAGE_SIZE))
+        self.assertIsNone(buffer.next_frame())
+
+class PayloadStreamTest(unittest.TestCase):
+    def test_read(self):
+        stream = PayloadStream(memoryview(b"abcdef"))
+        self.assertEqual(stream.read(2), b"ab")
+        self.assertEqual(stream.tell(), 2)
+        self.assertEqual(stream.read(10), b"cdef")
+        self.assertEqual(stream.read(), b"")
+        stream.seek(1)
+        self.assertEqual(stream.read(), b"bcdef")
@@ -0,0 +1,48 @@
+from datetime import datetime
+import unittest
+
+from chain import BlockTree
+from db.models import Block
+
+def make_header(prev, nonce=0, bits=0x1d00ffff):
+    header = Block(version=1, prev_hash=prev.calculate_hash() if prev is not None else b"\0" * 32,
+        merkle_root=b"\0" * 32, timestamp=datetime(2009, 1, 3), bits=bits, nonce=nonce)
+    header.height = prev.height + 1 if prev is not None else 0
+    return header
+
+def make_branch(tree, prev, length, nonce):
+    headers = []
+    for i in range(length):
+        prev = make_header(prev, nonce)
+        tree.add(prev)
+        headers.append(prev)
+    return headers
+
+class BlockTreeTest(unittest.TestCase):
+    def setUp(self):
+        self.tree = BlockTree()
+        self.genesis = make_header(None)
+        self.tree.add(self.genesis)
+
+    def test_most_work(self):
+        short = make_branch(self.tree, self.genesis, 2, 1)
+        long = make_branch(self.tree, self.genesis, 3, 2)
+        self.assertIs(self.tree.get_best(short[-1]), long[-1])
+        self.assertIs(self.tree.find_fork(short[-1], long[-1]), self.genesis)
+
+    def test_invalid_branch(self):
+        short = make_branch(self.tree, self.genesis, 2, 1)
+        long = make_branch(self.tree, self.genesis, 3, 2)
+        invalid = self.tree.invalidate(long[1].calculate_hash())
+        self.assertEqual(invalid, set(header.calculate_hash() for header in long[1:]))
+        # The valid part of the long branch has less work
+        self.assertIs(self.tree.get_best(self.genesis), short[-1])
+        # Already invalid
+        self.assertEqual(self.tree.invalidate(long[2].calculate_hash()), set())
+
+    def test_descendants_of_invalid_block(self):
+        branch = make_branch(self.tree, self.genesis, 2, 1)
+        self.tree.invalidate(branch[-1].calculate_hash())
+        child = make_branch(self.tree, branch[-1], 5, 1)[0]
+        self.assertIn(child.calculate_hash(), self.tree.invalid)
+        self.assertIs(self.tree.get_best(self.genesis), branch[0])
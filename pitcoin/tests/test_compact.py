@@ -0,0 +1,56 @@
+import unittest
+
+from util import compact
+
+# The work of a block at difficulty 1
+DIFFICULTY_1_WORK = 0x100010001
+
+class CompactTest(unittest.TestCase):
+    def test_bits_to_target(self):
+        # The vectors of the reference client's arith_uint256 tests
+        self.assertEqual(compact.bits_to_target(0x01003456), 0)
+        self.assertEqual(compact.bits_to_target(0x01123456), 0x12)
+        self.assertEqual(compact.bits_to_target(0x02123456), 0x1234)
+        self.assertEqual(compact.bits_to_target(0x03123456), 0x123456)
+        self.assertEqual(compact.bits_to_target(0x04123456), 0x12345600)
+        self.assertEqual(compact.bits_to_target(0x05009234), 0x92340000)
+        self.assertEqual(compact.bits_to_target(0x1d00ffff), compact.DIFFICULTY_1_TARGET)
+
+    def test_negative_target(self):
+        self.assertEqual(compact.bits_to_target(0x04923456), -0x12345600)
+        self.assertEqual(compact.bits_to_work(0x04923456), 0)
+        self.assertEqual(compact.bits_to_difficulty(0x04923456), 0.0)
+
+    def test_target_to_bits(self):
+        self.assertEqual(compact.target_to_bits(0x12), 0x01120000)
+        self.assertEqual(compact.target_to_bits(0x12345600), 0x04123456)
+        # The sign bit isn't set
+        self.assertEqual(compact.target_to_bits(0x80), 0x02008000)
+        self.assertEqual(compact.target_to_bits(compact.DIFFICULTY_1_TARGET), 0x1d00ffff)
+        # Bits beyond the three most significant bytes are truncated
+        self.assertEqual(compact.target_to_bits(0x123456789), 0x05012345)
+        for bits in (0x1d00ffff, 0x1b0404cb, 0x180526fd):
+            self.assertEqual(compact.target_to_bits(compact.bits_to_target(bits)), bits)
+
+    def test_work_and_difficulty(self):
+        self.assertEqual(compact.bits_to_work(0x1d00ffff), DIFFICULTY_1_WORK)
+        self.assertEqual(compact.bits_to_difficulty(0x1d00ffff), 1.0)
+        # Block 100000
+        self.assertAlmostEqual(compact.bits_to_difficulty(0x1b04864c), 14484.162361225399)
+
+    def test_chain(self):
+        bits = [0x1d00ffff] * 3 + [0x1c7fffff]
+        self.assertEqual(compact.get_work(bits)[:3], [DIFFICULTY_1_WORK] * 3)
+        chainwork = compact.get_chainwork(bits, initial=1)
+        self.assertEqual(chainwork[:3], [1 + DIFFICULTY_1_WORK * i for i in range(1, 4)])
+        self.assertEqual(chainwork[3], chainwork[2] + compact.bits_to_work(0x1c7fffff))
+        self.assertEqual(compact.get_targets(bits), [compact.bits_to_target(b) for b in bits])
+        self.assertEqual(compact.get_difficulties(bits)[:3], [1.0] * 3)
+
+    def test_hashrates(self):
+        bits = [0x1d00ffff] * 5
+        timestamps = [i * 600 for i in range(5)]
+        hashrates = compact.get_hashrates(bits, timestamps, window=2)
+        self.assertEqual(hashrates[0], 0.0)
+        for hashrate in hashrates[1:]:
+            self.assertAlmostEqual(hashrate, DIFFICULTY_1_WORK / 600)
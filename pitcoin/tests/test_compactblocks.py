@@ -0,0 +1,102 @@
+from datetime import datetime
+from io import BytesIO
+import unittest
+
+from compactblocks import PartialBlock, create_compact_block
+from datatypes import messages, structures
+from db.models import Block
+from util.hashing import NULL_HASH
+from util.merkle import merkle_root
+
+def make_transaction(out_hash, index):
+    transaction = messages.Transaction(
+        version=1,
+        inputs=[structures.Input(previous_output=structures.OutPoint(out_hash=out_hash, index=index),
+            signature_script=b"\x01\x01", sequence=0xFFFFFFFF)],
+        outputs=[structures.Output(value=10 ** 8, pubkey_script=b"\x51")],
+        lock_time=0,
+    )
+    return messages.Transaction.from_stream(BytesIO(transaction.raw))
+
+def make_block(transactions):
+    block = Block(version=1, prev_hash=b"\1" * 32, merkle_root=merkle_root([t.txid for t in transactions]),
+        timestamp=datetime(2016, 1, 1), bits=0x1d00ffff, nonce=0)
+    block.transactions = transactions
+    stream = BytesIO()
+    block.serialize(stream)
+    stream.seek(0)
+    return Block(stream=stream)
+
+class FakeMempool(object):
+    def __init__(self, transactions):
+        self.entries = dict((transaction.txid, transaction) for transaction in transactions)
+
+    def get(self, txid):
+        return self.entries.get(txid)
+
+def relay(message):
+    """Return the message as parsed by the receiving peer"""
+    stream = BytesIO()
+    message.serialize(stream)
+    stream.seek(0)
+    return messages.CmpctBlock(stream=stream)
+
+class PartialBlockTest(unittest.TestCase):
+    def setUp(self):
+        self.transactions = [make_transaction(NULL_HASH, 0xFFFFFFFF)] + \
+            [make_transaction(bytes([i]) * 32, 0) for i in range(1, 6)]
+        self.block = make_block(self.transactions)
+
+    def check_block(self, partial):
+        block = partial.get_block()
+        self.assertEqual(block.calculate_hash(), self.block.calculate_hash())
+        self.assertEqual([t.txid for t in block.transactions], [t.txid for t in self.transactions])
+
+    def test_from_mempool(self):
+        message = relay(create_compact_block(self.block, nonce=1))
+        self.assertEqual(len(message.short_ids), 5)
+        # Unrelated transactions in the mempool are ignored
+        mempool = FakeMempool(self.transactions[1:] + [make_transaction(b"\7" * 32, 0)])
+        partial = PartialBlock(message, mempool)
+        self.assertEqual(partial.missing, [])
+        self.check_block(partial)
+
+    def test_missing_transactions(self):
+        message = relay(create_compact_block(self.block, nonce=2))
+        partial = PartialBlock(message, FakeMempool(self.transactions[2:4]))
+        self.assertEqual(partial.missing, [1, 4, 5])
+        with self.assertRaises(ValueError):
+            partial.get_block()
+        with self.assertRaises(ValueError):
+            partial.fill(self.transactions[1:2])
+        partial.fill([self.transactions[i] for i in partial.missing])
+        self.check_block(partial)
+
+    def test_prefilled_transactions(self):
+        message = relay(create_compact_block(self.block, nonce=3, prefilled=(0, 2, 5)))
+        self.assertEqual([p.index for p in message.prefilled_transactions], [0, 1, 2])
+        partial = PartialBlock(message, FakeMempool([]))
+        self.assertEqual(partial.missing, [1, 3, 4])
+        partial.fill([self.transactions[i] for i in partial.missing])
+        self.check_block(partial)
+
+    def test_wrong_transaction(self):
+        message = relay(create_compact_block(self.block, nonce=4))
+        partial = PartialBlock(message, FakeMempool(self.transactions[2:]))
+        partial.fill([make_transaction(b"\7" * 32, 0)])
+        # The merkle root doesn't match; the full block is needed
+        self.assertIsNone(partial.get_block())
+
+    def test_invalid_messages(self):
+        message = create_compact_block(self.block, nonce=5)
+        message.prefilled_transactions[0].index = 6
+        with self.assertRaises(ValueError):
+            PartialBlock(message, FakeMempool([]))
+
+        message = create_compact_block(self.block, nonce=5)
+        message.short_ids[1] = message.short_ids[0]
+        with self.assertRaises(ValueError):
+            PartialBlock(message, FakeMempool([]))
+
+        with self.assertRaises(ValueError):
+            PartialBlock(messages.CmpctBlock(header=message.header), FakeMempool([]))
@@ -0,0 +1,83 @@
+import unittest
+
+from net.inventory import InventoryTracker, RollingBloomFilter
+
+def make_hash(i):
+    return i.to_bytes(32, 'little')
+
+class FakePeer(object):
+    pass
+
+class RollingBloomFilterTest(unittest.TestCase):
+    def test_remembers_last_items(self):
+        bloom = RollingBloomFilter(100, 0.0001)
+        for i in range(250):
+            bloom.add(make_hash(i))
+        # At least the last `capacity` items are kept
+        for i in range(150, 250):
+            self.assertIn(make_hash(i), bloom)
+        # The oldest generations were dropped
+        forgotten = sum(make_hash(i) in bloom for i in range(100))
+        self.assertLess(forgotten, 5)
+
+    def test_false_positives(self):
+        bloom = RollingBloomFilter(1000, 0.001)
+        for i in range(1000):
+            bloom.add(make_hash(i))
+        false_positives = sum(make_hash(i) in bloom for i in range(1000, 11000))
+        self.assertLess(false_positives, 100)
+
+    def test_clear(self):
+        bloom = RollingBloomFilter(10)
+        bloom.add(make_hash(1))
+        bloom.clear()
+        self.assertNotIn(make_hash(1), bloom)
+
+class InventoryTrackerTest(unittest.TestCase):
+    def setUp(self):
+        self.have = set()
+        self.tracker = InventoryTracker(lambda txid: txid in self.have)
+        self.a = FakePeer()
+        self.b = FakePeer()
+        self.tracker.add_peer(self.a)
+        self.tracker.add_peer(self.b)
+
+    def test_request_once(self):
+        self.have.add(make_hash(3))
+        hashes = [make_hash(i) for i in range(4)]
+        self.assertEqual(self.tracker.announced(self.a, hashes), hashes[:3])
+        # Already requested from the first peer
+        self.assertEqual(self.tracker.announced(self.b, hashes), [])
+        self.assertIn(make_hash(0), self.b.known_inventory)
+
+    def test_record_only(self):
+        self.assertEqual(self.tracker.announced(self.a, [make_hash(1)], request=False), [])
+        self.assertIn(make_hash(1), self.a.known_inventory)
+        self.assertEqual(self.tracker.announced(self.b, [make_hash(1)]), [make_hash(1)])
+
+    def test_request_from_next_peer(self):
+        self.tracker.announced(self.a, [make_hash(1), make_hash(2)])
+        self.tracker.not_found([make_hash(1)])
+        self.assertEqual(self.tracker.announced(self.b, [make_hash(1), make_hash(2)]), [make_hash(1)])
+        self.tracker.remove_peer(self.a)
+        self.assertEqual(self.tracker.announced(self.b, [make_hash(2)]), [make_hash(2)])
+
+    def test_expired_request(self):
+        self.tracker.announced(self.a, [make_hash(1)])
+        deadline = self.tracker.requested[make_hash(1)][1]
+        self.tracker.expire(deadline)
+        self.assertEqual(self.tracker.announced(self.b, [make_hash(1)]), [make_hash(1)])
+
+    def test_rejected(self):
+        self.tracker.announced(self.a, [make_hash(1)])
+        self.tracker.received(self.a, make_hash(1), False)
+        self.assertEqual(self.tracker.announced(self.b, [make_hash(1)]), [])
+        # May be valid after the next block
+        self.tracker.clear_rejected()
+        self.assertEqual(self.tracker.announced(self.b, [make_hash(1)]), [make_hash(1)])
+
+    def test_should_announce(self):
+        self.tracker.announced(self.a, [make_hash(1)])
+        self.assertFalse(self.tracker.should_announce(self.a, make_hash(1)))
+        self.assertTrue(self.tracker.should_announce(self.b, make_hash(1)))
+        self.assertFalse(self.tracker.should_announce(self.b, make_hash(1)))
@@ -0,0 +1,98 @@
+from io import BytesIO
+import time
+import unittest
+
+from datatypes import messages, structures
+from mempool import TransactionPool, is_final
+from utxo import Coin
+
+def make_transaction(out_hash, value, lock_time=0, sequence=0xFFFFFFFF):
+    transaction = messages.Transaction(
+        version=1,
+        inputs=[structures.Input(previous_output=structures.OutPoint(out_hash=out_hash, index=0),
+            signature_script=b"", sequence=sequence)],
+        outputs=[structures.Output(value=value, pubkey_script=bytes([0x51]))],
+        lock_time=lock_time,
+    )
+    return messages.Transaction.from_stream(BytesIO(transaction.raw))
+
+class Coins(dict):
+    """A UTXO set of anyone-can-spend outputs"""
+    def get(self, out_hash, index):
+        return super().get((out_hash, index))
+
+    def fund(self, out_hash, value=10 ** 8):
+        self[(out_hash, 0)] = Coin(value, bytes([0x51]), 1, False)
+
+class FinalityTest(unittest.TestCase):
+    def test_lock_time(self):
+        now = int(time.time())
+        self.assertTrue(is_final(make_transaction(b"\1" * 32, 1, 0, 0), 100, now))
+        self.assertTrue(is_final(make_transaction(b"\1" * 32, 1, 99, 0), 100, now))
+        self.assertFalse(is_final(make_transaction(b"\1" * 32, 1, 100, 0), 100, now))
+        self.assertTrue(is_final(make_transaction(b"\1" * 32, 1, now - 1, 0), 100, now))
+        self.assertFalse(is_final(make_transaction(b"\1" * 32, 1, now, 0), 100, now))
+
+    def test_final_sequence(self):
+        # Inputs with the final sequence opt out of the lock time
+        self.assertTrue(is_final(make_transaction(b"\1" * 32, 1, 1000), 100, time.time()))
+
+class TransactionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.coins = Coins()
+        self.pool = TransactionPool(self.coins)
+
+    def test_reject_non_final(self):
+        self.coins.fund(b"\1" * 32)
+        self.assertFalse(self.pool.accept(make_transaction(b"\1" * 32, 10 ** 7, 200, 0), 200))
+        self.assertTrue(self.pool.accept(make_transaction(b"\1" * 32, 10 ** 7, 199, 0), 200))
+
+    def mine_parent(self):
+        """Return a parent transaction which was mined, and its child, which is in the pool"""
+        parent = make_transaction(b"\1" * 32, 9 * 10 ** 7)
+        child = make_transaction(parent.txid, 8 * 10 ** 7)
+        self.coins.fund(parent.txid, 9 * 10 ** 7)
+        self.assertTrue(self.pool.accept(child, 10))
+        return parent, child
+
+    def test_reorganize(self):
+        parent, child = self.mine_parent()
+        # The block with the parent is disconnected
+        del self.coins[(parent.txid, 0)]
+        self.coins.fund(b"\1" * 32)
+        self.pool.reorganize([parent], 10)
+        self.assertIn(parent.txid, self.pool)
+        self.assertIn(child.txid, self.pool)
+
+    def test_reorganize_without_parent(self):
+        # The block with the parent is disconnected, but its transactions aren't known anymore
+        parent, child = self.mine_parent()
+        del self.coins[(parent.txid, 0)]
+        self.pool.reorganize([], 10)
+        self.assertEqual(len(self.pool), 0)
+
+    def test_block_transactions(self):
+        # A parent paying a low fee, with a child paying a high one, and another transaction in between
+        for out_hash in (b"\1" * 32, b"\2" * 32):
+            self.coins.fund(out_hash)
+        parent = make_transaction(b"\1" * 32, 10 ** 8 - 1000)
+        child = make_transaction(parent.txid, 10 ** 8 - 10 ** 6)
+        other = make_transaction(b"\2" * 32, 10 ** 8 - 10 ** 5)
+        for transaction in (parent, child, other):
+            self.assertTrue(self.pool.accept(transaction, 10))
+
+        expected = [other.txid, parent.txid, child.txid]
+        self.assertEqual([t.txid for t in self.pool.get_block_transactions()], expected)
+        # The heap is left as it was
+        self.assertEqual(len(self.pool.by_highest_fee_rate), 3)
+        self.assertEqual([t.txid for t in self.pool.get_block_transactions()], expected)
+
+        # Too small for two transactions
+        max_size = len(parent.raw) + len(child.raw) - 1
+        self.assertEqual([t.txid for t in self.pool.get_block_transactions(max_size)], [other.txid])
+        self.assertEqual([t.txid for t in self.pool.get_block_transactions()], expected)
+
+        # Removed transactions are dropped from the heap
+        self.pool.remove(other.txid)
+        self.assertEqual([t.txid for t in self.pool.get_block_transactions()], expected[1:])
+        self.assertEqual(len(self.pool.by_highest_fee_rate), 2)
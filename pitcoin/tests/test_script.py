@@ -0,0 +1,51 @@
+import unittest
+
+from script import verify_script, run_script, ScriptFailure
+from script_opcodes import *
+from signatures import push_data
+from util.hashing import hash160
+
+def p2sh(redeem_script):
+    """Return the pubkey script paying to the redeem script"""
+    return bytes([OP_HASH160]) + push_data(hash160(redeem_script)) + bytes([OP_EQUAL])
+
+class P2SHTest(unittest.TestCase):
+    def test_small_number_pushes(self):
+        # OP_1NEGATE, OP_0 and OP_1..OP_16 are push-only, and push their numbers
+        redeem_script = bytes([OP_ADD, OP_15, OP_EQUALVERIFY, OP_0, OP_EQUALVERIFY, OP_1NEGATE, OP_EQUAL])
+        signature_script = bytes([OP_1NEGATE, OP_0, OP_7, OP_8]) + push_data(redeem_script)
+        self.assertTrue(verify_script(signature_script, p2sh(redeem_script), None))
+
+        signature_script = bytes([OP_1NEGATE, OP_0, OP_7, OP_9]) + push_data(redeem_script)
+        self.assertFalse(verify_script(signature_script, p2sh(redeem_script), None))
+
+    def test_signature_script_must_be_push_only(self):
+        redeem_script = bytes([OP_2, OP_EQUAL])
+        self.assertTrue(verify_script(bytes([OP_2]) + push_data(redeem_script), p2sh(redeem_script), None))
+        signature_script = bytes([OP_1, OP_1, OP_ADD]) + push_data(redeem_script)
+        self.assertFalse(verify_script(signature_script, p2sh(redeem_script), None))
+
+    def test_wrong_redeem_script(self):
+        redeem_script = bytes([OP_1])
+        self.assertFalse(verify_script(push_data(bytes([OP_2])), p2sh(redeem_script), None))
+
+    def test_before_activation(self):
+        # Only the hash of the redeem script was checked, and the signature script didn't have to be push-only
+        redeem_script = bytes([OP_0])
+        self.assertFalse(verify_script(push_data(redeem_script), p2sh(redeem_script), None))
+        self.assertTrue(verify_script(push_data(redeem_script), p2sh(redeem_script), None, p2sh=False))
+        signature_script = bytes([OP_1, OP_1, OP_ADD, OP_DROP]) + push_data(redeem_script)
+        self.assertTrue(verify_script(signature_script, p2sh(redeem_script), None, p2sh=False))
+        self.assertFalse(verify_script(push_data(bytes([OP_1])), p2sh(redeem_script), None, p2sh=False))
+
+class FlowControlTest(unittest.TestCase):
+    def test_verif_fails_in_unexecuted_branch(self):
+        for opcode in (OP_VERIF, OP_VERNOTIF):
+            with self.assertRaises(ScriptFailure):
+                run_script(bytes([OP_0, OP_IF, opcode, OP_ENDIF, OP_1]), [], None)
+
+    def test_reserved_in_unexecuted_branch(self):
+        # Unlike OP_VERIF, other invalid opcodes only fail when executed
+        self.assertTrue(run_script(bytes([OP_0, OP_IF, OP_VER, OP_ENDIF, OP_1]), [], None))
+        with self.assertRaises(ScriptFailure):
+            run_script(bytes([OP_1, OP_IF, OP_VER, OP_ENDIF, OP_1]), [], None)
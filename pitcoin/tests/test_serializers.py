@@ -0,0 +1,19 @@
+import unittest
+
+from datatypes import fields, structures
+from datatypes.meta import Field, BitcoinSerializable
+
+class SerializerSizeTest(unittest.TestCase):
+    def test_fixed_size(self):
+        self.assertEqual(structures.OutPoint.get_serializer().size, 36)
+        self.assertIsNone(structures.Input.get_serializer().size)
+
+    def test_nested_fixed_size(self):
+        class Nested(BitcoinSerializable):
+            _fields = [
+                Field('outpoint', fields.StructureField(structures.OutPoint), default=structures.OutPoint),
+                Field('value', fields.UInt32LEField(), default=0),
+            ]
+        serializer = Nested.get_serializer()
+        self.assertEqual(serializer.size, 40)
+        self.assertEqual(serializer.skip(b"\0" * 100, 10), 50)
@@ -0,0 +1,115 @@
+from io import BytesIO
+import unittest
+
+import ecdsa
+
+from datatypes import messages, structures
+from script_opcodes import OP_DUP, OP_HASH160, OP_EQUALVERIFY, OP_CHECKSIG
+from util.hashing import hash160
+import signatures
+
+def make_transaction(input_count=2, output_count=2):
+    transaction = messages.Transaction(
+        version=1,
+        inputs=[structures.Input(
+            previous_output=structures.OutPoint(out_hash=bytes([i + 1]) * 32, index=i),
+            signature_script=b"",
+            sequence=0xFFFFFFFF,
+        ) for i in range(input_count)],
+        outputs=[structures.Output(value=(i + 1) * 1000, pubkey_script=bytes([0x51])) for i in range(output_count)],
+        lock_time=0,
+    )
+    # As received from peers, with the serialized data kept
+    return messages.Transaction.from_stream(BytesIO(transaction.raw))
+
+class SignatureHashTest(unittest.TestCase):
+    script_code = bytes([0x51])
+
+    def digest(self, transaction, hash_type, input_index=0):
+        return signatures.signature_hash(transaction, input_index, self.script_code, hash_type)
+
+    def test_single_without_matching_output(self):
+        # The reference client signs the number 1 instead
+        transaction = make_transaction(input_count=3, output_count=2)
+        self.assertEqual(self.digest(transaction, signatures.SIGHASH_SINGLE, 2),
+            b"\x01" + b"\x00" * 31)
+
+    def test_all_signs_outputs_and_other_inputs(self):
+        transaction = make_transaction()
+        digest = self.digest(transaction, signatures.SIGHASH_ALL)
+        transaction.outputs[1].value += 1
+        self.assertNotEqual(self.digest(transaction, signatures.SIGHASH_ALL), digest)
+
+    def test_none_doesnt_sign_outputs(self):
+        transaction = make_transaction()
+        digest = self.digest(transaction, signatures.SIGHASH_NONE)
+        transaction.outputs[1].value += 1
+        transaction.inputs[1].sequence = 0
+        self.assertEqual(self.digest(transaction, signatures.SIGHASH_NONE), digest)
+
+    def test_single_signs_its_output(self):
+        transaction = make_transaction()
+        digest = self.digest(transaction, signatures.SIGHASH_SINGLE)
+        transaction.outputs[1].value += 1
+        self.assertEqual(self.digest(transaction, signatures.SIGHASH_SINGLE), digest)
+        transaction.outputs[0].value += 1
+        self.assertNotEqual(self.digest(transaction, signatures.SIGHASH_SINGLE), digest)
+
+    def test_anyonecanpay_doesnt_sign_other_inputs(self):
+        hash_type = signatures.SIGHASH_ALL | signatures.SIGHASH_ANYONECANPAY
+        transaction = make_transaction()
+        digest = self.digest(transaction, hash_type)
+        transaction.inputs[1].previous_output.index += 1
+        self.assertEqual(self.digest(transaction, hash_type), digest)
+
+class VerifyInputTest(unittest.TestCase):
+    def setUp(self):
+        self.key = ecdsa.SigningKey.generate(curve=ecdsa.SECP256k1)
+        pubkey = self.key.get_verifying_key().to_string("compressed")
+        self.pubkey_script = bytes([OP_DUP, OP_HASH160]) + signatures.push_data(hash160(pubkey)) + \
+            bytes([OP_EQUALVERIFY, OP_CHECKSIG])
+        self.transaction = make_transaction(input_count=1)
+        digest = signatures.signature_hash(self.transaction, 0, self.pubkey_script, signatures.SIGHASH_ALL)
+        self.signature = self.key.sign_digest(digest, sigencode=ecdsa.util.sigencode_der_canonize)
+        self.pubkey = pubkey
+
+    def sign(self, der_signature):
+        self.transaction.inputs[0].signature_script = signatures.push_data(
+            der_signature + bytes([signatures.SIGHASH_ALL])) + signatures.push_data(self.pubkey)
+
+    def backends(self):
+        for backend_class in signatures.BACKENDS:
+            try:
+                yield backend_class()
+            except ImportError:
+                continue
+
+    def test_p2pkh_spend(self):
+        self.sign(self.signature)
+        for backend in self.backends():
+            cache = signatures.SignatureCache()
+            self.assertTrue(signatures.verify_input(self.transaction, 0, self.pubkey_script, backend, cache))
+            self.assertEqual(len(cache), 1)
+            self.transaction.outputs[0].value += 1
+            self.assertFalse(signatures.verify_input(self.transaction, 0, self.pubkey_script, backend, cache))
+            self.transaction.outputs[0].value -= 1
+
+    def test_lax_der(self):
+        # Padded lengths and integers, as accepted before BIP66
+        r, s = ecdsa.util.sigdecode_der(self.signature, ecdsa.SECP256k1.order)
+        r_bytes = b"\x00\x00" + r.to_bytes(32, 'big')
+        s_bytes = s.to_bytes(32, 'big')
+        lax = b"\x30\x82\x00\x00" + b"\x02\x81" + bytes([len(r_bytes)]) + r_bytes + \
+            b"\x02\x84\x00\x00\x00" + bytes([len(s_bytes)]) + s_bytes
+        self.assertEqual(signatures.parse_der_lax(lax), (r, s))
+        self.sign(lax)
+        for backend in self.backends():
+            self.assertTrue(signatures.verify_input(
+                self.transaction, 0, self.pubkey_script, backend, signatures.SignatureCache()))
+
+    def test_unparseable_der(self):
+        self.assertIsNone(signatures.parse_der_lax(b""))
+        self.assertIsNone(signatures.parse_der_lax(b"\x30"))
+        self.assertIsNone(signatures.parse_der_lax(self.signature[:-1]))
+        # An integer over 32 bytes, not counting padding
+        self.assertIsNone(signatures.parse_der_lax(b"\x30\x26\x02\x21\x01" + b"\x00" * 32 + b"\x02\x01\x01"))
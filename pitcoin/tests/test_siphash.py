@@ -0,0 +1,35 @@
+import unittest
+
+from util.siphash import siphash, siphash_hashes
+
+# The key of the reference vectors, bytes 0 to 15
+K0 = 0x0706050403020100
+K1 = 0x0F0E0D0C0B0A0908
+
+# The SipHash-2-4 reference vectors: the hash of bytes 0 to n-1, by n
+VECTORS = {
+    0: 0x726fdb47dd0e0e31,
+    1: 0x74f839c593dc67fd,
+    2: 0x0d6c8009d9a94f5a,
+    3: 0x85676696d7fb7e2d,
+    4: 0xcf2794e0277187b7,
+    5: 0x18765564cd99a68d,
+    6: 0xcbc9466e58fee3ce,
+    7: 0xab0200f58b01d137,
+    8: 0x93f5f5799a932462,
+    15: 0xa129ca6149be45e5,
+    32: 0x7127512f72f27cce,
+}
+
+class SipHashTest(unittest.TestCase):
+    def test_reference_vectors(self):
+        for length, expected in VECTORS.items():
+            self.assertEqual(siphash(K0, K1, bytes(range(length))), expected)
+
+    def test_hashes_at_once(self):
+        # The 32-byte vector, among other hashes, as the short ids of compact blocks are computed
+        digests = [bytes(range(32))] + [bytes([i]) * 32 for i in range(40)]
+        hashes = siphash_hashes(K0, K1, digests)
+        self.assertEqual(hashes[0], VECTORS[32])
+        self.assertEqual(hashes, [siphash(K0, K1, digest) for digest in digests])
+        self.assertEqual(siphash_hashes(K0, K1, []), [])
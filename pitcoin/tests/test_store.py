@@ -0,0 +1,49 @@
+import time
+import unittest
+from unittest import mock
+
+from db.store import BlockStore
+
+class FakeBlock(object):
+    def __init__(self, height):
+        self.pk = height
+        self.height = height
+
+class FakeOutputSet(object):
+    def __init__(self):
+        self.full = False
+
+    def is_full(self):
+        return self.full
+
+class BlockStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.utxos = FakeOutputSet()
+        self.store = BlockStore(flush_size=3, flush_interval=10, utxos=self.utxos)
+        # Count the flushes instead of writing to the database
+        patcher = mock.patch.object(self.store, 'flush')
+        self.flush = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_flush_size(self):
+        self.store.add(FakeBlock(1))
+        self.store.set_validated(FakeBlock(2), b"undo")
+        self.assertEqual(len(self.store), 2)
+        self.assertFalse(self.flush.called)
+        self.store.add(FakeBlock(3))
+        self.assertEqual(self.flush.call_count, 1)
+
+    def test_full_utxo_cache(self):
+        self.utxos.full = True
+        self.store.add(FakeBlock(1))
+        self.assertEqual(self.flush.call_count, 1)
+
+    def test_flush_interval(self):
+        self.store.flush_if_due()
+        self.assertFalse(self.flush.called)
+        self.store.add(FakeBlock(1))
+        self.store.flush_if_due()
+        self.assertFalse(self.flush.called)
+        self.store.oldest = time.time() - 10
+        self.store.flush_if_due()
+        self.assertEqual(self.flush.call_count, 1)
@@ -0,0 +1,222 @@
+from collections import deque
+from datetime import datetime
+import time
+import unittest
+from unittest import mock
+
+from db.models import Block, HeaderVector
+from db.store import BlockStore
+from mempool import TransactionPool
+from net.inventory import InventoryTracker
+from sync import BlockDownloader
+import chain
+
+def block_hash(height):
+    return height.to_bytes(32, 'little')
+
+class FakePeer(object):
+    def __init__(self):
+        self.in_flight = set()
+        self.node = None
+        self.compact_blocks = False
+        self.last_delivery = 0
+        self.messages = []
+        self.disconnected = False
+
+    def send_message(self, message):
+        self.messages.append(message)
+
+    def disconnect(self):
+        self.disconnected = True
+
+    def requested(self):
+        return [i.inv_hash for message in self.messages for i in message.inventory]
+
+class FakeBlock(object):
+    def __init__(self, block_hash):
+        self.block_hash = block_hash
+        self.transactions = []
+
+    def calculate_hash(self):
+        return self.block_hash
+
+class FakeHeader(object):
+    def __init__(self, pk):
+        self.pk = pk
+        self.height = pk
+
+    def calculate_hash(self):
+        return block_hash(self.height)
+
+class FakeUndo(object):
+    def serialize(self, stream):
+        stream.write(b"undo")
+
+class FakeOutputSet(object):
+    """A UTXO set in which every block connects"""
+    def load_spent(self, blocks):
+        pass
+
+    def connect_block(self, block, height):
+        return FakeUndo()
+
+    def get(self, out_hash, index):
+        return None
+
+    def get_pubkey_script(self, out_hash, index):
+        return None
+
+class FakeScriptValidator(object):
+    def __init__(self):
+        self.invalid = set()
+
+    def validate(self, blocks, get_pubkey_script):
+        return [block.calculate_hash() not in self.invalid for block in blocks]
+
+def make_downloader(count):
+    """Return a downloader with the headers of `count` blocks synced and queued, which doesn't touch the
+    database"""
+    downloader = BlockDownloader.__new__(BlockDownloader)
+    downloader.peers = []
+    downloader.headers_first = True
+    downloader.headers_synced = True
+    downloader.utxos = FakeOutputSet()
+    downloader.store = BlockStore(flush_size=count + 1)
+    downloader.scripts = FakeScriptValidator()
+    downloader.mempool = TransactionPool(downloader.utxos)
+    downloader.inventory = InventoryTracker(lambda txid: False)
+    downloader.tree = chain.BlockTree()
+    downloader.prev_block = FakeHeader(0)
+    downloader.header_tip = None
+    downloader.pending = deque()
+    downloader.pending_set = set()
+    downloader.queue = deque()
+    downloader.in_flight = {}
+    downloader.received = {}
+    downloader.headers = {}
+    downloader.partial_blocks = {}
+    downloader.recent_blocks = deque(maxlen=BlockDownloader.MAX_RECENT_BLOCKS)
+    downloader.locator_peer = None
+    downloader.locator_deadline = 0
+    downloader.queue_headers([FakeHeader(i) for i in range(1, count + 1)])
+    return downloader
+
+class BlockDownloaderTest(unittest.TestCase):
+    def test_capacity_per_peer(self):
+        downloader = make_downloader(100)
+        peers = [FakePeer() for i in range(3)]
+        for peer in peers:
+            downloader.add_peer(peer)
+        for peer in peers:
+            self.assertEqual(len(peer.in_flight), BlockDownloader.MAX_IN_FLIGHT_PER_PEER)
+        self.assertEqual(len(downloader.in_flight), 3 * BlockDownloader.MAX_IN_FLIGHT_PER_PEER)
+        # The first blocks of the chain are requested first
+        requested = sorted(h for peer in peers for h in peer.requested())
+        self.assertEqual(requested, sorted(block_hash(i) for i in range(1, 3 * 16 + 1)))
+        self.assertEqual(list(downloader.queue), [block_hash(i) for i in range(3 * 16 + 1, 101)])
+
+    def test_window(self):
+        downloader = make_downloader(100)
+        downloader.WINDOW = 20
+        peers = [FakePeer() for i in range(3)]
+        for peer in peers:
+            downloader.add_peer(peer)
+        self.assertEqual(len(downloader.in_flight), 20)
+
+        # Blocks waiting in the reorder buffer count towards the window
+        for h in sorted(peers[0].in_flight, reverse=True)[:5]:
+            if h != block_hash(1):
+                downloader.handle_block(peers[0], FakeBlock(h))
+        self.assertEqual(len(downloader.in_flight) + len(downloader.received), 20)
+
+    def test_reorder(self):
+        downloader = make_downloader(3)
+        peer = FakePeer()
+        downloader.add_peer(peer)
+        downloader.handle_block(peer, FakeBlock(block_hash(3)))
+        downloader.handle_block(peer, FakeBlock(block_hash(2)))
+        # Waiting for block 1
+        self.assertEqual(set(downloader.received), {block_hash(2), block_hash(3)})
+        self.assertEqual(len(downloader.store), 0)
+
+        with mock.patch('validator.validate_transactions', return_value=True):
+            downloader.handle_block(peer, FakeBlock(block_hash(1)))
+        self.assertEqual(downloader.received, {})
+        self.assertEqual(len(downloader.pending), 0)
+        self.assertEqual([height for pk, height, undo in downloader.store.validated], [1, 2, 3])
+        self.assertEqual(downloader.prev_block.height, 3)
+
+    def test_unsolicited_block(self):
+        downloader = make_downloader(3)
+        peer = FakePeer()
+        downloader.add_peer(peer)
+        downloader.handle_block(peer, FakeBlock(block_hash(10)))
+        self.assertEqual(downloader.received, {})
+
+    def test_timeout(self):
+        downloader = make_downloader(20)
+        slow = FakePeer()
+        downloader.add_peer(slow)
+        requested = sorted(slow.in_flight)
+        fast = FakePeer()
+        downloader.add_peer(fast)
+        self.assertEqual(len(fast.in_flight), 4)
+
+        # Only the slow peer's requests time out
+        expired = time.time() - BlockDownloader.REQUEST_TIMEOUT - 1
+        for h in requested:
+            downloader.in_flight[h] = (slow, expired)
+        for h in list(fast.in_flight):
+            downloader.handle_block(fast, FakeBlock(h))
+        downloader.check_timeouts()
+
+        self.assertTrue(slow.disconnected)
+        self.assertNotIn(slow, downloader.peers)
+        self.assertFalse(fast.disconnected)
+        # Given to the other peer, from the lowest height
+        self.assertEqual(fast.requested()[-16:], requested)
+
+    def test_invalid_block(self):
+        downloader = make_downloader(3)
+        rejected = []
+        downloader.reject = lambda block_hash, header: rejected.append(block_hash)
+        downloader.scripts.invalid.add(block_hash(2))
+        peer = FakePeer()
+        downloader.add_peer(peer)
+        with mock.patch('validator.validate_transactions', return_value=True):
+            downloader.handle_block(peer, FakeBlock(block_hash(2)))
+            downloader.handle_block(peer, FakeBlock(block_hash(1)))
+        self.assertEqual(rejected, [block_hash(2)])
+        self.assertTrue(peer.disconnected)
+        self.assertEqual(downloader.prev_block.height, 1)
+
+def make_header(prev_hash, nonce=0):
+    return Block(version=1, prev_hash=prev_hash, merkle_root=b"\0" * 32, timestamp=datetime(2009, 1, 3),
+        bits=0x1d00ffff, nonce=nonce)
+
+class InvalidHeadersTest(unittest.TestCase):
+    def setUp(self):
+        self.downloader = make_downloader(0)
+        self.downloader.headers_synced = False
+        genesis = make_header(b"\0" * 32)
+        genesis.height = 0
+        self.downloader.tree.add(genesis)
+        self.downloader.header_tip = genesis
+        self.invalid = make_header(genesis.calculate_hash())
+        self.downloader.tree.invalid.add(self.invalid.calculate_hash())
+        self.peer = FakePeer()
+        self.downloader.peers.append(self.peer)
+        self.downloader.inventory.add_peer(self.peer)
+
+    def check_punished(self, headers):
+        self.downloader.handle_headers(self.peer, HeaderVector(headers=headers))
+        self.assertTrue(self.peer.disconnected)
+        self.assertNotIn(self.peer, self.downloader.peers)
+        self.assertEqual(len(self.downloader.tree), 1)
+        self.assertFalse(self.downloader.headers_synced)
+
+    def test_invalid_header(self):
+        self.check_punished([self.invalid])
+
+    def test_descendant_of_invalid_header(self):
+        self.check_punished([make_header(self.invalid.calculate_hash())])
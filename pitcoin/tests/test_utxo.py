@@ -0,0 +1,101 @@
+from io import BytesIO
+import unittest
+
+from datatypes import messages, structures
+from db.models import Block
+from util.hashing import NULL_HASH
+from utxo import UnspentOutputSet
+
+class MemoryOutputSet(UnspentOutputSet):
+    """A UTXO set which is never flushed, so it has no saved outputs to load"""
+    def load(self, outpoints):
+        pass
+
+    def save(self):
+        """Move the new outputs to the cache, as a flush would"""
+        self.cache.update(self.added)
+        self.added = {}
+
+COIN = 10 ** 8
+
+def make_transaction(inputs, values=(25 * COIN,), script=b"\x01\x01"):
+    transaction = messages.Transaction(
+        version=1,
+        inputs=[structures.Input(previous_output=structures.OutPoint(out_hash=out_hash, index=index),
+            signature_script=script, sequence=0xFFFFFFFF) for out_hash, index in inputs],
+        outputs=[structures.Output(value=value, pubkey_script=b"\x51") for value in values],
+        lock_time=0,
+    )
+    return messages.Transaction.from_stream(BytesIO(transaction.raw))
+
+def make_coinbase(value=50 * COIN, script=b"\x01\x02"):
+    return make_transaction([(NULL_HASH, 0xFFFFFFFF)], (value,), script)
+
+def make_block(transactions):
+    block = Block()
+    block.transactions = transactions
+    return block
+
+# The first height at which the coinbase of block 1 can be spent
+MATURE = 1 + UnspentOutputSet.COINBASE_MATURITY
+
+class UnspentOutputSetTest(unittest.TestCase):
+    def setUp(self):
+        self.utxos = MemoryOutputSet()
+        self.coinbase = make_transaction([(NULL_HASH, 0xFFFFFFFF)], (25 * COIN, 25 * COIN))
+        self.assertIsNotNone(self.utxos.connect_block(make_block([self.coinbase]), 1))
+
+    def test_connect_and_disconnect(self):
+        self.utxos.save()
+        spend = make_transaction([(self.coinbase.txid, 0)])
+        undo = self.utxos.connect_block(make_block([make_coinbase(), spend]), MATURE)
+        self.assertIsNone(self.utxos.get(self.coinbase.txid, 0))
+        self.assertIsNotNone(self.utxos.get(spend.txid, 0))
+        self.assertEqual(len(undo.spent), 1)
+
+        self.utxos.disconnect_block(undo)
+        self.assertEqual(self.utxos.get(self.coinbase.txid, 0).height, 1)
+        self.assertIsNone(self.utxos.get(spend.txid, 0))
+
+    def test_double_spend(self):
+        spend = make_transaction([(self.coinbase.txid, 0), (self.coinbase.txid, 0)])
+        coinbase = make_coinbase()
+        self.assertIsNone(self.utxos.connect_block(make_block([coinbase, spend]), MATURE))
+        # Nothing changed
+        self.assertIsNotNone(self.utxos.get(self.coinbase.txid, 0))
+        self.assertIsNone(self.utxos.get(coinbase.txid, 0))
+
+    def test_duplicate_coinbase(self):
+        # Blocks 91842 and 91880 repeat earlier coinbases, whose outputs are overwritten (BIP30)
+        self.utxos.save()
+        self.assertIsNotNone(self.utxos.connect_block(make_block([self.coinbase]), 2))
+        for index in range(2):
+            self.assertEqual(self.utxos.get(self.coinbase.txid, index).height, 2)
+            # The saved output is deleted before the new one is inserted
+            self.assertIn((self.coinbase.txid, index), self.utxos.spent)
+
+    def test_immature_coinbase(self):
+        spend = make_transaction([(self.coinbase.txid, 0)])
+        self.assertIsNone(self.utxos.connect_block(make_block([make_coinbase(), spend]), MATURE - 1))
+        self.assertIsNotNone(self.utxos.connect_block(make_block([make_coinbase(), spend]), MATURE))
+
+    def test_spend_more_than_inputs(self):
+        spend = make_transaction([(self.coinbase.txid, 0)], (20 * COIN, 5 * COIN + 1))
+        self.assertIsNone(self.utxos.connect_block(make_block([make_coinbase(), spend]), MATURE))
+        self.assertIsNotNone(self.utxos.get(self.coinbase.txid, 0))
+
+    def test_coinbase_value(self):
+        # Pays 5 coins of fees, over two transactions of the block
+        spend = make_transaction([(self.coinbase.txid, 0)], (22 * COIN,))
+        child = make_transaction([(spend.txid, 0)], (20 * COIN,))
+        block = make_block([make_coinbase(55 * COIN + 1), spend, child])
+        self.assertIsNone(self.utxos.connect_block(block, MATURE))
+        self.assertIsNotNone(self.utxos.get(self.coinbase.txid, 0))
+        self.assertIsNotNone(self.utxos.connect_block(make_block([make_coinbase(55 * COIN), spend, child]), MATURE))
+
+    def test_subsidy(self):
+        self.assertEqual(UnspentOutputSet.get_subsidy(0), 50 * COIN)
+        self.assertEqual(UnspentOutputSet.get_subsidy(209999), 50 * COIN)
+        self.assertEqual(UnspentOutputSet.get_subsidy(210000), 25 * COIN)
+        self.assertEqual(UnspentOutputSet.get_subsidy(630000), 625000000)
+        self.assertEqual(UnspentOutputSet.get_subsidy(64 * 210000), 0)
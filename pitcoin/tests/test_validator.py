@@ -0,0 +1,54 @@
+from datetime import datetime
+from io import BytesIO
+import unittest
+
+from datatypes import messages, structures
+from script_opcodes import OP_0, OP_HASH160, OP_EQUAL
+from signatures import push_data
+from util.hashing import NULL_HASH, hash160
+from validator import P2SH_EXEMPT_BLOCK, ScriptValidator, is_p2sh_active
+
+# A redeem script which always fails
+REDEEM_SCRIPT = bytes([OP_0])
+P2SH_SCRIPT = bytes([OP_HASH160]) + push_data(hash160(REDEEM_SCRIPT)) + bytes([OP_EQUAL])
+
+def make_transaction(out_hash, signature_script=b"\x01\x01"):
+    transaction = messages.Transaction(
+        version=1,
+        inputs=[structures.Input(previous_output=structures.OutPoint(out_hash=out_hash, index=0),
+            signature_script=signature_script, sequence=0xFFFFFFFF)],
+        outputs=[structures.Output(value=10 ** 8, pubkey_script=b"\x51")],
+        lock_time=0,
+    )
+    return messages.Transaction.from_stream(BytesIO(transaction.raw))
+
+class FakeBlock(object):
+    def __init__(self, timestamp, block_hash=b"\1" * 32):
+        self.timestamp = timestamp
+        self.block_hash = block_hash
+        # Spends a P2SH output with the failing redeem script
+        self.transactions = [make_transaction(NULL_HASH), make_transaction(b"\2" * 32, push_data(REDEEM_SCRIPT))]
+
+    def calculate_hash(self):
+        return self.block_hash
+
+class P2SHActivationTest(unittest.TestCase):
+    def validate(self, block):
+        validator = ScriptValidator(workers=1)
+        return validator.validate([block], lambda out_hash, index: P2SH_SCRIPT)[0]
+
+    def test_before_activation(self):
+        block = FakeBlock(datetime(2012, 3, 31, 23, 59, 59))
+        self.assertFalse(is_p2sh_active(block))
+        self.assertTrue(self.validate(block))
+
+    def test_after_activation(self):
+        block = FakeBlock(datetime(2012, 4, 1))
+        self.assertTrue(is_p2sh_active(block))
+        self.assertFalse(self.validate(block))
+
+    def test_exempt_block(self):
+        # Block 170060, whose timestamp is also checked against the activation time
+        block = FakeBlock(datetime(2012, 4, 1), P2SH_EXEMPT_BLOCK)
+        self.assertFalse(is_p2sh_active(block))
+        self.assertTrue(self.validate(block))
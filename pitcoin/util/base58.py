@@ -1,3 +1,5 @@
+from util.hashing import sha256d
+
 # The Base58 digits
 base58_digits = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
 
@@ -28,3 +30,16 @@ def base58_decode(address):
         digit = base58_digits.index(char)
         address_bignum += digit
     return address_bignum
+
+def base58check_encode(version, payload):
+    """Encode the payload with a version byte and checksum, as used for addresses. Each leading zero byte is encoded
+    as a '1'.
+
+    :param version: The version byte, see datatypes.values.ADDRESS_VERSIONS
+    :param payload: The bytes to encode, e.g. a public key hash
+    :returns: The base58 string
+    """
+    data = bytes([version]) + payload
+    data += sha256d(data)[:4]
+    leading_zeros = len(data) - len(data.lstrip(b'\x00'))
+    return '1' * leading_zeros + base58_encode(int.from_bytes(data, 'big'))
@@ -1,26 +1,86 @@
+import functools
+
+# The target of difficulty 1, see https://en.bitcoin.it/wiki/Difficulty
+DIFFICULTY_1_TARGET = 0x00000000FFFF0000000000000000000000000000000000000000000000000000
+
+@functools.lru_cache(maxsize=4096)
 def bits_to_target(compact):
     """Takes a packed difficulty representation ("bits") and returns the decimal representation of the target hash.
-    See https://en.bitcoin.it/wiki/Difficulty"""
-    hex_value = "{:x}".format(compact)
-    c1, c2 = int(hex_value[:2], 16), int(hex_value[2:], 16)
-    return c2 * 2 ** (8 * (c1 - 3))
+    The sign bit makes the target negative, which no hash can meet. See https://en.bitcoin.it/wiki/Difficulty"""
+    size = compact >> 24
+    word = compact & 0x007FFFFF
+    if size <= 3:
+        target = word >> (8 * (3 - size))
+    else:
+        target = word << (8 * (size - 3))
+    if compact & 0x00800000:
+        return -target
+    return target
 
 def target_to_bits(target):
-    """Takes a target hash decimal and returns the packed compact representation ("bits").
-    See https://en.bitcoin.it/wiki/Difficulty"""
-    def hex_lead(val):
-        h = "{:x}".format(val)
-        if len(h) % 2 == 1:
-            h = '0%s' % h
-        return h
+    """Takes a target hash decimal and returns the packed compact representation ("bits"). Precision beyond the
+    three most significant bytes is truncated. See https://en.bitcoin.it/wiki/Difficulty"""
+    size = (target.bit_length() + 7) // 8
+    if size <= 3:
+        word = target << (8 * (3 - size))
+    else:
+        word = target >> (8 * (size - 3))
+    # The mantissa is signed; don't set the sign bit
+    if word & 0x00800000:
+        word >>= 8
+        size += 1
+    return size << 24 | word
+
+@functools.lru_cache(maxsize=4096)
+def bits_to_work(compact):
+    """Returns the expected number of hashes needed to find a block with the given bits"""
+    target = bits_to_target(compact)
+    if target <= 0:
+        return 0
+    return 2**256 // (target + 1)
+
+@functools.lru_cache(maxsize=4096)
+def bits_to_difficulty(compact):
+    """Returns the difficulty of the given bits, relative to the lowest difficulty"""
+    target = bits_to_target(compact)
+    if target <= 0:
+        return 0.0
+    return DIFFICULTY_1_TARGET / target
+
+#
+# Batch APIs over the bits and timestamps of a whole chain, e.g. chain.index.bits. The bits only change every 2016
+# blocks, so the conversions are cached per distinct value, and a chain of a million blocks takes a single pass.
+#
+
+def get_targets(bits):
+    """Returns the target of each block"""
+    return [bits_to_target(b) for b in bits]
 
-    base256 = "%s%s" % (hex_lead(target / 256), hex_lead(target % 256))
+def get_work(bits):
+    """Returns the work of each block"""
+    return [bits_to_work(b) for b in bits]
 
-    if int(base256[:2], 16) > 0x7f:
-        base256 = "00%s" % base256
+def get_chainwork(bits, initial=0):
+    """Returns the cumulative work of the chain at each block, starting from the given work before the first one"""
+    chainwork = []
+    total = initial
+    for b in bits:
+        total += bits_to_work(b)
+        chainwork.append(total)
+    return chainwork
 
-    length = hex_lead(len(base256) / 2)
-    compact = "%s%s" % (length, base256[:6])
+def get_difficulties(bits):
+    """Returns the difficulty of each block"""
+    return [bits_to_difficulty(b) for b in bits]
 
-    missing = 8 - len(compact)
-    return int('%s%s' % (compact, ('0' * missing)), 16)
+def get_hashrates(bits, timestamps, window=144):
+    """Returns the estimated hash rate (hashes per second) of the network at each block, from the work and time
+    of the last `window` blocks. The first blocks are estimated from the blocks available."""
+    chainwork = get_chainwork(bits)
+    hashrates = []
+    for i in range(len(chainwork)):
+        start = max(i - window, 0)
+        timespan = timestamps[i] - timestamps[start]
+        work = chainwork[i] - chainwork[start]
+        hashrates.append(work / timespan if timespan > 0 else 0.0)
+    return hashrates
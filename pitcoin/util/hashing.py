@@ -0,0 +1,25 @@
+import hashlib
+
+def sha256d(data):
+    """The double SHA-256 hash used for block hashes, transaction ids, checksums and more.
+
+    :param data: Any bytes-like object
+    :returns: The 32-byte digest
+    """
+    return hashlib.sha256(hashlib.sha256(data).digest()).digest()
+
+def hash_to_hex(digest):
+    """Hashes are kept as their raw 32 bytes, but displayed and saved in the db as hex strings in reverse byte
+    order"""
+    return digest[::-1].hex()
+
+def hash160(data):
+    """RIPEMD-160 of SHA-256, used for addresses and in scripts"""
+    return hashlib.new('ripemd160', hashlib.sha256(data).digest()).digest()
+
+def hex_to_hash(value):
+    """Parse a hash from its hex string, see hash_to_hex"""
+    return bytes.fromhex(value)[::-1]
+
+#: The all-zero hash, e.g. the previous output of coinbase inputs
+NULL_HASH = bytes(32)
@@ -0,0 +1,73 @@
+import hashlib
+
+# Merkle trees of transaction hashes, see https://en.bitcoin.it/wiki/Protocol_documentation#Merkle_Trees
+#
+# Each level pairs up the hashes of the level below, duplicating the last one if their number is odd, and hashes each
+# pair with sha256d. The levels are reduced in place in a single list, so a block takes one copy of its hashes.
+
+def hash_pair(left, right):
+    """The sha256d of the concatenated hashes, the parent of two nodes"""
+    sha256 = hashlib.sha256(left)
+    sha256.update(right)
+    return hashlib.sha256(sha256.digest()).digest()
+
+def _pad_level(level, count):
+    """Duplicate the last of the first `count` hashes of the level if their number is odd, and return the new count"""
+    if count & 1:
+        if count == len(level):
+            level.append(level[count - 1])
+        else:
+            level[count] = level[count - 1]
+        count += 1
+    return count
+
+def _reduce_level(level, count):
+    """Replace the first `count` (even) hashes of the level with their parents, and return the number of parents"""
+    sha256 = hashlib.sha256
+    for i in range(0, count, 2):
+        pair = sha256(level[i])
+        pair.update(level[i + 1])
+        level[i >> 1] = sha256(pair.digest()).digest()
+    return count >> 1
+
+def merkle_root(hashes):
+    """Return the merkle root of the given raw 32-byte hashes, e.g. the transaction hashes of a block"""
+    if len(hashes) == 0:
+        raise ValueError("A merkle tree needs at least one hash")
+    level = list(hashes)
+    count = len(level)
+    while count > 1:
+        count = _pad_level(level, count)
+        count = _reduce_level(level, count)
+    return level[0]
+
+def merkle_branch(hashes, index):
+    """Return the merkle branch of the hash at the given index: its sibling at each level of the tree, from the
+    bottom up. Together with the root, it proves that the hash is in the tree, without the other hashes."""
+    if not 0 <= index < len(hashes):
+        raise IndexError("No hash at index %d" % index)
+    level = list(hashes)
+    count = len(level)
+    branch = []
+    while count > 1:
+        count = _pad_level(level, count)
+        branch.append(level[index ^ 1])
+        count = _reduce_level(level, count)
+        index >>= 1
+    return branch
+
+def branch_root(leaf, branch, index):
+    """Return the merkle root given by the hash at the given index and its merkle branch"""
+    digest = leaf
+    for sibling in branch:
+        if index & 1:
+            digest = hash_pair(sibling, digest)
+        else:
+            digest = hash_pair(digest, sibling)
+        index >>= 1
+    return digest
+
+def verify_branch(leaf, branch, index, root):
+    """Verify that the hash at the given index is in the tree with the given root, e.g. that a transaction is in a
+    block, given only its header"""
+    return index >> len(branch) == 0 and branch_root(leaf, branch, index) == root
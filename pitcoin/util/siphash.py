@@ -0,0 +1,98 @@
+# SipHash-2-4, a keyed hash of short inputs, see https://131002.net/siphash/. Used for the short transaction ids of
+# compact blocks (BIP 152).
+
+MASK = 0xFFFFFFFFFFFFFFFF
+
+def siphash(k0, k1, data):
+    """Return the 64-bit SipHash-2-4 of the data, with the key given as two 64-bit integers"""
+    v0 = k0 ^ 0x736F6D6570736575
+    v1 = k1 ^ 0x646F72616E646F6D
+    v2 = k0 ^ 0x6C7967656E657261
+    v3 = k1 ^ 0x7465646279746573
+    tail = len(data) & ~7
+    words = [int.from_bytes(data[i:i + 8], 'little') for i in range(0, tail, 8)]
+    # The last word holds the remaining bytes, and the length in its top byte
+    words.append((len(data) & 0xFF) << 56 | int.from_bytes(data[tail:], 'little'))
+    for m in words:
+        v3 ^= m
+        for i in range(2):
+            v0, v1, v2, v3 = _round(v0, v1, v2, v3)
+        v0 ^= m
+    v2 ^= 0xFF
+    for i in range(4):
+        v0, v1, v2, v3 = _round(v0, v1, v2, v3)
+    return v0 ^ v1 ^ v2 ^ v3
+
+def _round(v0, v1, v2, v3):
+    v0 = (v0 + v1) & MASK
+    v1 = ((v1 << 13) | (v1 >> 51)) & MASK
+    v1 ^= v0
+    v0 = ((v0 << 32) | (v0 >> 32)) & MASK
+    v2 = (v2 + v3) & MASK
+    v3 = ((v3 << 16) | (v3 >> 48)) & MASK
+    v3 ^= v2
+    v0 = (v0 + v3) & MASK
+    v3 = ((v3 << 21) | (v3 >> 43)) & MASK
+    v3 ^= v0
+    v2 = (v2 + v1) & MASK
+    v1 = ((v1 << 17) | (v1 >> 47)) & MASK
+    v1 ^= v2
+    v2 = ((v2 << 32) | (v2 >> 32)) & MASK
+    return v0, v1, v2, v3
+
+# Bits per lane in siphash_hashes: a 64-bit word, and a guard byte taking the carries of additions
+LANE_BITS = 72
+
+def siphash_hashes(k0, k1, digests):
+    """Return siphash() of each of the given 32-byte hashes, e.g. txids, computing all of them at once.
+
+    The hashes are packed side by side into a single big integer for each state word, in lanes of LANE_BITS bits,
+    so each operation of the rounds runs over all of them in C. This is about ten times faster than hashing them one
+    by one.
+    """
+    count = len(digests)
+    if count == 0:
+        return []
+    # The byte strings of the packed words, and 1 at the low bit of each lane
+    guard = b'\x00' * (LANE_BITS // 8 - 8)
+    lanes = int.from_bytes((b'\x01' + b'\x00' * 7 + guard) * count, 'little')
+    word_mask = MASK * lanes
+    # Per-lane masks for the rotations, by the number of bits rotated
+    rotation_masks = {}
+    for bits in (13, 16, 17, 21, 32):
+        rotation_masks[bits] = (((1 << (64 - bits)) - 1) << bits) * lanes, ((1 << bits) - 1) * lanes
+
+    def rotate(v, bits):
+        high, low = rotation_masks[bits]
+        return (v << bits) & high | (v >> (64 - bits)) & low
+
+    def sipround(v0, v1, v2, v3):
+        v0 = (v0 + v1) & word_mask
+        v1 = rotate(v1, 13) ^ v0
+        v0 = rotate(v0, 32)
+        v2 = (v2 + v3) & word_mask
+        v3 = rotate(v3, 16) ^ v2
+        v0 = (v0 + v3) & word_mask
+        v3 = rotate(v3, 21) ^ v0
+        v2 = (v2 + v1) & word_mask
+        v1 = rotate(v1, 17) ^ v2
+        v2 = rotate(v2, 32)
+        return v0, v1, v2, v3
+
+    v0 = (k0 ^ 0x736F6D6570736575) * lanes
+    v1 = (k1 ^ 0x646F72616E646F6D) * lanes
+    v2 = (k0 ^ 0x6C7967656E657261) * lanes
+    v3 = (k1 ^ 0x7465646279746573) * lanes
+    words = [int.from_bytes(b"".join(digest[i:i + 8] + guard for digest in digests), 'little') for i in (0, 8, 16, 24)]
+    words.append((32 << 56) * lanes)
+    for m in words:
+        v3 ^= m
+        v0, v1, v2, v3 = sipround(v0, v1, v2, v3)
+        v0, v1, v2, v3 = sipround(v0, v1, v2, v3)
+        v0 ^= m
+    v2 ^= 0xFF * lanes
+    for i in range(4):
+        v0, v1, v2, v3 = sipround(v0, v1, v2, v3)
+    result = (v0 ^ v1 ^ v2 ^ v3).to_bytes(count * LANE_BITS // 8, 'little')
+    step = LANE_BITS // 8
+    return [int.from_bytes(result[i:i + 8], 'little') for i in range(0, len(result), step)]
@@ -0,0 +1,290 @@
+from collections import OrderedDict, namedtuple
+
+from django.db import connection, transaction
+from django.db.models import Sum
+
+from datatypes.meta import Field, BitcoinSerializable
+from datatypes import fields
+from db.models import UnspentOutput
+from script import extract_addresses
+from util.hashing import hash_to_hex, hex_to_hash
+
+#: An unspent output, as held by the UTXO set
+Coin = namedtuple('Coin', ['value', 'pubkey_script', 'height', 'coinbase'])
+
+class SpentOutput(BitcoinSerializable):
+    """An output spent by a block, as saved in its undo data"""
+    _fields = [
+        Field('out_hash', fields.Hash()),
+        Field('index', fields.UInt32LEField()),
+        Field('value', fields.Int64LEField()),
+        Field('pubkey_script', fields.VariableByteStringField()),
+        # The height of the block which created the output, times two, plus one for coinbase outputs
+        Field('code', fields.UInt32LEField()),
+    ]
+    __slots__ = tuple(field.name for field in _fields)
+
+    def get_coin(self):
+        return Coin(self.value, self.pubkey_script, self.code >> 1, bool(self.code & 1))
+
+class CreatedOutputs(BitcoinSerializable):
+    """The outputs of a transaction of a block, as saved in its undo data"""
+    _fields = [
+        Field('out_hash', fields.Hash()),
+        Field('count', fields.VariableIntegerField()),
+    ]
+    __slots__ = tuple(field.name for field in _fields)
+
+class BlockUndo(BitcoinSerializable):
+    """The changes made to the UTXO set by connecting a block, which is all that's needed to disconnect it again.
+    Only outputs spent from before the block are included; those created and spent within the block cancel out."""
+    _fields = [
+        Field('spent', fields.ListField(SpentOutput), default=list),
+        Field('created', fields.ListField(CreatedOutputs), default=list),
+    ]
+
+class UnspentOutputSet(object):
+    """The set of unspent transaction outputs (UTXOs) of our chain, keyed by outpoint: (out_hash, index).
+
+    Blocks are connected and disconnected in memory. New outputs and spends of saved outputs are tracked as dirty
+    until `flush` writes them all in a single transaction; outputs which are created and spent between two flushes
+    never reach the database. Flush together with the blocks, see db.store.BlockStore, so the saved UTXO set always
+    matches the saved chain.
+
+    Saved outputs are loaded on demand and kept in a bounded LRU cache of `cache_size` entries. `connect_block` loads
+    the spent outputs of a whole block with a few queries, so script validation doesn't need a query per input.
+    """
+
+    CACHE_SIZE = 1000000
+
+    # Flush when this many changes are waiting, to bound the memory used by dirty entries
+    MAX_DIRTY = 500000
+
+    # Outpoints per query when loading or deleting saved outputs
+    QUERY_SIZE = 1000
+
+    # Coinbase outputs can only be spent by blocks this many blocks above them
+    COINBASE_MATURITY = 100
+
+    # The new coins a block may create, in satoshis, halving every HALVING_INTERVAL blocks
+    INITIAL_SUBSIDY = 50 * 10 ** 8
+    HALVING_INTERVAL = 210000
+
+    def __init__(self, cache_size=CACHE_SIZE, max_dirty=MAX_DIRTY, coin="bitcoin"):
+        self.cache_size = cache_size
+        self.max_dirty = max_dirty
+        self.coin = coin
+
+        # Outpoint -> Coin of saved outputs, least recently used first
+        self.cache = OrderedDict()
+
+        # Outpoint -> Coin of outputs created since the last flush
+        self.added = {}
+
+        # Outpoints of saved outputs spent since the last flush
+        self.spent = set()
+
+    def __contains__(self, outpoint):
+        return self.get(*outpoint) is not None
+
+    @property
+    def dirty_count(self):
+        return len(self.added) + len(self.spent)
+
+    def is_full(self):
+        """Whether enough changes are waiting that the set should be flushed"""
+        return self.dirty_count >= self.max_dirty
+
+    def get(self, out_hash, index):
+        """Return the Coin of the given unspent output, or None if it doesn't exist or is spent"""
+        outpoint = (out_hash, index)
+        coin = self.added.get(outpoint)
+        if coin is not None:
+            return coin
+        if outpoint in self.spent:
+            return None
+        if outpoint not in self.cache:
+            self.load([outpoint])
+        coin = self.cache.get(outpoint)
+        if coin is not None:
+            self.cache.move_to_end(outpoint)
+        return coin
+
+    def get_pubkey_script(self, out_hash, index):
+        """Return the pubkey script of the given unspent output, or None. See validator.ScriptValidator."""
+        coin = self.get(out_hash, index)
+        return coin.pubkey_script if coin is not None else None
+
+    def load(self, outpoints):
+        """Load the given saved outputs into the cache, unless they're already known"""
+        hashes = set(out_hash for out_hash, index in outpoints
+            if (out_hash, index) not in self.cache and (out_hash, index) not in self.added)
+        hashes = list(hashes)
+        for i in range(0, len(hashes), self.QUERY_SIZE):
+            # All the unspent outputs of the transactions are loaded; the others tend to be spent soon, too
+            for out_hash, index, value, pubkey_script, height, coinbase in UnspentOutput.objects.filter(
+                    out_hash__in=hashes[i:i + self.QUERY_SIZE]).values_list(
+                    'out_hash', 'index', 'value', 'pubkey_script', 'height', 'coinbase'):
+                outpoint = (hex_to_hash(out_hash), index)
+                if outpoint not in self.spent:
+                    self.cache[outpoint] = Coin(value, bytes(pubkey_script), height, coinbase)
+        self.trim()
+
+    def load_spent(self, blocks):
+        """Load the saved outputs spent by the given blocks, before looking them up one by one. Outputs with the txid
+        of their coinbases are loaded too, as a coinbase may duplicate an earlier one (BIP30)."""
+        self.load([(i.previous_output.out_hash, i.previous_output.index)
+            for block in blocks for t in block.transactions[1:] for i in t.inputs] +
+            [(block.transactions[0].txid, 0) for block in blocks])
+
+    def trim(self):
+        """Evict the least recently used saved outputs from the cache"""
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def add(self, out_hash, index, coin):
+        self.added[(out_hash, index)] = coin
+
+    def spend(self, out_hash, index):
+        """Spend the given output, and return its Coin, or None if it doesn't exist or is already spent"""
+        coin = self.get(out_hash, index)
+        if coin is None:
+            return None
+        outpoint = (out_hash, index)
+        if self.added.pop(outpoint, None) is None:
+            # A saved output
+            self.spent.add(outpoint)
+            self.cache.pop(outpoint, None)
+        return coin
+
+    def connect_block(self, block, height):
+        """Spend the outputs spent by the block, and add its new outputs. If an input spends a missing, already
+        spent or immature coinbase output, a transaction spends more than its inputs, or the coinbase claims more
+        than the subsidy and fees, nothing is changed and None is returned. Otherwise, returns the BlockUndo needed
+        to disconnect the block again."""
+        transactions = list(block.transactions)
+        transaction_hashes = [t.txid for t in transactions]
+
+        # Check all the spends before changing anything, so an invalid block is simply rejected. The first
+        # transaction is the coinbase, which doesn't spend anything.
+        self.load_spent([block])
+        # Outpoint -> Coin of the outputs created by the block
+        created = {}
+        spent = set()
+        fees = 0
+        for transaction_index, (transaction_hash, t) in enumerate(zip(transaction_hashes, transactions)):
+            if transaction_index > 0:
+                input_value = 0
+                for i in t.inputs:
+                    outpoint = (i.previous_output.out_hash, i.previous_output.index)
+                    coin = created.get(outpoint)
+                    if coin is None:
+                        coin = self.get(*outpoint)
+                    if coin is None or outpoint in spent:
+                        return None
+                    if coin.coinbase and height - coin.height < self.COINBASE_MATURITY:
+                        return None
+                    spent.add(outpoint)
+                    input_value += coin.value
+                output_value = sum(output.value for output in t.outputs)
+                if input_value < output_value:
+                    return None
+                fees += input_value - output_value
+            for index, output in enumerate(t.outputs):
+                created[(transaction_hash, index)] = Coin(
+                    output.value, output.pubkey_script, height, transaction_index == 0)
+        if sum(output.value for output in transactions[0].outputs) > self.get_subsidy(height) + fees:
+            return None
+
+        undo = BlockUndo()
+        for transaction_index, (transaction_hash, t) in enumerate(zip(transaction_hashes, transactions)):
+            if transaction_index > 0:
+                for i in t.inputs:
+                    out_hash, index = i.previous_output.out_hash, i.previous_output.index
+                    coin = self.spend(out_hash, index)
+                    if (out_hash, index) not in created:
+                        undo.spent.append(SpentOutput(
+                            out_hash=out_hash,
+                            index=index,
+                            value=coin.value,
+                            pubkey_script=coin.pubkey_script,
+                            code=coin.height << 1 | coin.coinbase,
+                        ))
+            for index in range(len(t.outputs)):
+                if transaction_index == 0 and self.get(transaction_hash, index) is not None:
+                    # A duplicate of an unspent coinbase, before BIP30 was enforced (blocks 91842 and 91880). The
+                    # earlier output is overwritten, and lost even if the block is disconnected again.
+                    self.spend(transaction_hash, index)
+                self.add(transaction_hash, index, created[(transaction_hash, index)])
+            undo.created.append(CreatedOutputs(out_hash=transaction_hash, count=len(t.outputs)))
+        return undo
+
+    @classmethod
+    def get_subsidy(cls, height):
+        """Return the new coins which the block at the given height may create"""
+        halvings = height // cls.HALVING_INTERVAL
+        if halvings >= 64:
+            return 0
+        return cls.INITIAL_SUBSIDY >> halvings
+
+    def disconnect_block(self, undo):
+        """Undo connect_block: remove the outputs created by the block, and restore the outputs it spent"""
+        for created in undo.created:
+            for index in range(created.count):
+                self.spend(created.out_hash, index)
+        for spent in undo.spent:
+            outpoint = (spent.out_hash, spent.index)
+            if outpoint in self.spent:
+                # The output is still saved; forget the spend
+                self.spent.discard(outpoint)
+                self.cache[outpoint] = spent.get_coin()
+            else:
+                self.add(spent.out_hash, spent.index, spent.get_coin())
+
+    def flush(self):
+        """Write all changes to the database, in a single transaction"""
+        if self.dirty_count == 0:
+            return
+        with transaction.atomic():
+            spent = list(self.spent)
+            cursor = connection.cursor()
+            for i in range(0, len(spent), self.QUERY_SIZE):
+                batch = spent[i:i + self.QUERY_SIZE]
+                cursor.execute(
+                    'DELETE FROM %s WHERE (out_hash, "index") IN (VALUES %s)' % (
+                        UnspentOutput._meta.db_table, ", ".join(["(%s, %s)"] * len(batch))),
+                    [value for out_hash, index in batch for value in (hash_to_hex(out_hash), index)])
+            UnspentOutput.objects.bulk_create([
+                UnspentOutput(
+                    out_hash=out_hash,
+                    index=index,
+                    value=coin.value,
+                    pubkey_script=coin.pubkey_script,
+                    height=coin.height,
+                    coinbase=coin.coinbase,
+                    address=self.get_address(coin.pubkey_script),
+                ) for (out_hash, index), coin in self.added.items()
+            ], batch_size=self.QUERY_SIZE)
+
+        # The new outputs are saved now, and stay cached
+        self.cache.update(self.added)
+        self.added = {}
+        self.spent = set()
+        self.trim()
+
+    def get_address(self, pubkey_script):
+        """Return the address paid by the pubkey script, or None if it doesn't pay a single address"""
+        addresses = extract_addresses(pubkey_script, self.coin)
+        return addresses[0] if len(addresses) == 1 else None
+
+    def get_balance(self, address):
+        """Return the total value of the unspent outputs paying the given address, in satoshis. Changes which aren't
+        flushed yet are counted too, without flushing them outside of the block store's transaction."""
+        saved = UnspentOutput.objects.filter(address=address)
+        if len(self.spent) == 0:
+            balance = saved.aggregate(balance=Sum('value'))['balance'] or 0
+        else:
+            balance = sum(value for out_hash, index, value in saved.values_list('out_hash', 'index', 'value')
+                if (hex_to_hash(out_hash), index) not in self.spent)
+        return balance + sum(coin.value for coin in self.added.values()
+            if self.get_address(coin.pubkey_script) == address)
@@ -1,72 +1,124 @@
-from datatypes import values
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+import calendar
+import os
+
+from config import logger
+from datatypes import messages, values
+from datatypes.fields import LazyList
 from util import compact
-from db.models import Block
+from util.hashing import hash_to_hex, hex_to_hash
+from util.merkle import merkle_root
+import chain
+import signatures
 
 max_target = compact.bits_to_target(values.HIGHEST_TARGET_BITS)
 target_timespan = 60 * 60 * 24 * 7 * 2 # We want 2016 blocks to take 2 weeks.
 retarget_interval = 2016 # Blocks
 
+# The P2SH rules (BIP 16) apply to the blocks from this time on, except to a block which spent a P2SH output with an
+# invalid redeem script before most of the network enforced them
+P2SH_ACTIVATION_TIME = 1333238400
+P2SH_EXEMPT_BLOCK = hex_to_hash("00000000000002dc756eebf4f49723ed8d30cc28a5f108eb94b1ba88ac4f9c22") # Block 170060
+
 def validate_block(block, prev_block):
     """Validate a new block"""
+    return validate_header(block, prev_block) and validate_transactions(block)
+
+def validate_header(block, prev_block, tree=None):
+    """Validate a new block header, which only requires the 80 header bytes: that it links to the previous block
+    and has enough proof of work. The chain index must be loaded. The previous block may be on another branch, whose
+    headers are then looked up in the given chain.BlockTree, see get_ancestor."""
     # Calculate the current target
-    target = get_target(block, prev_block)
+    target = get_target(block, prev_block, tree)
 
     if block.prev_hash != prev_block.calculate_hash():
-        # TODO: Proper logging
-        print("Rejecting block %s: The previous block hash (%s) differs from our latest block hash (%s)" %
-            (block, block.prev_hash(), prev_block.calculate_hash()))
+        logger.info("Rejecting block %s: The previous block hash (%s) differs from our latest block hash (%s)" %
+            (block, hash_to_hex(block.prev_hash), hash_to_hex(prev_block.calculate_hash())))
         return False
 
     if not block.validate_proof_of_work(target):
-        # TODO proper logging
-        print("Block #%s invalid: (%s)" % (prev_block.height + 1, target))
+        logger.warning("Block #%s invalid: The hash doesn't meet the target (%x)" % (prev_block.height + 1, target))
         return False
 
     return True
 
-def get_target(block, prev_block):
+def validate_transactions(block):
+    """Validate that the transactions of a block are the ones committed to by its header's merkle root. Their scripts
+    and spends are checked by ScriptValidator and utxo.UnspentOutputSet."""
+    if len(block.transactions) == 0:
+        logger.warning("Block %s invalid: No transactions" % hash_to_hex(block.calculate_hash()))
+        return False
+
+    transaction_hashes = get_transaction_hashes(block)
+    if merkle_root(transaction_hashes) != block.merkle_root:
+        logger.warning("Block %s invalid: The merkle root doesn't match the transactions" %
+            hash_to_hex(block.calculate_hash()))
+        return False
+
+    # Duplicating the last transactions of a tree with an odd level gives the same merkle root (CVE-2012-2459), so
+    # a valid block could be mutated into an invalid one with the same hash. A valid block never repeats a
+    # transaction, since the second copy would spend the same outputs again.
+    if len(set(transaction_hashes)) != len(transaction_hashes):
+        logger.warning("Block %s invalid: Duplicate transactions" % hash_to_hex(block.calculate_hash()))
+        return False
+
+    return True
+
+def get_ancestor(prev_block, height, tree=None):
+    """Return the bits and unix timestamp of the block at the given height on the branch of `prev_block`. Once the
+    branch joins our chain, they're read from the chain index; the headers of other branches are walked back through
+    the BlockTree, or their `prev_block` without a tree."""
+    header = prev_block
+    while not chain.index.contains(header):
+        if header.height == height:
+            return header.bits, calendar.timegm(header.timestamp.utctimetuple())
+        parent = tree.get(header.prev_hash) if tree is not None else None
+        header = parent if parent is not None else header.prev_block
+    return chain.index.bits[height], chain.index.timestamps[height]
+
+def get_target(block, prev_block, tree=None):
     from testnet import testnet
 
     current_height = prev_block.height + 1
     target = compact.bits_to_target(prev_block.bits)
 
-    # If testnet, don't use 20-minute-rule targets; iterate backwards to last proper target
+    # If testnet, don't use 20-minute-rule targets; go back to last proper target
     if testnet:
-        height = current_height - 1
-        while height > 0 and height % retarget_interval != 0:
-            height -= 1
-        target = compact.bits_to_target(Block.objects.get(height=height).bits)
+        height = prev_block.height - prev_block.height % retarget_interval
+        target = compact.bits_to_target(get_ancestor(prev_block, height, tree)[0])
 
     if current_height % retarget_interval == 0:
-        target = retarget(target, prev_block)
+        target = retarget(target, prev_block, tree)
 
     # 20 minute rule for testnet
     if testnet:
-        if current_height % retarget_interval != 0 and (block.timestamp - prev_block.timestamp).seconds > 1200:
+        if current_height % retarget_interval != 0 and (block.timestamp - prev_block.timestamp).total_seconds() > 1200:
             target = max_target
 
     return target
 
-def retarget(target, prev_block):
+def retarget(target, prev_block, tree=None):
     """
     Every *retarget_interval* blocks, recalculate the target based on the wanted timespan.
     For all other blocks, the target remains equal to the previous target.
     """
     current_height = prev_block.height + 1
     retarget_height = 0 if current_height < retarget_interval else current_height - retarget_interval
-    last_retargeted_block = Block.objects.get(height=retarget_height)
 
-    timespan = (prev_block.timestamp - last_retargeted_block.timestamp).seconds
+    # The previous block may be on another branch than the chain index
+    timespan = calendar.timegm(prev_block.timestamp.utctimetuple()) - \
+        get_ancestor(prev_block, retarget_height, tree)[1]
 
     # Limit adjustment step
     if timespan > target_timespan * 4:
         timespan = target_timespan * 4
-    elif timespan < target_timespan / 4:
-        timespan = target_timespan / 4
+    elif timespan < target_timespan // 4:
+        timespan = target_timespan // 4
 
     # Adjust the target
     target *= timespan
-    target /= target_timespan
+    target //= target_timespan
 
     # Round the target with the packed representation
     target = compact.bits_to_target(compact.target_to_bits(target))
@@ -76,3 +128,135 @@ def retarget(target, prev_block):
         target = max_target
 
     return target
+
+def is_p2sh_active(block):
+    """Whether the P2SH rules apply to the scripts of the block"""
+    return calendar.timegm(block.timestamp.utctimetuple()) >= P2SH_ACTIVATION_TIME and \
+        block.calculate_hash() != P2SH_EXEMPT_BLOCK
+
+def get_raw_transactions(block):
+    """Return the serialized transactions of the block"""
+    if isinstance(block.transactions, LazyList):
+        return [block.transactions.get_raw(i) for i in range(len(block.transactions))]
+    return [bytes(transaction.raw) for transaction in block.transactions]
+
+def get_transaction_hashes(block):
+    """Return the hashes of the transactions of the block. They're cached by the transactions, so each is only
+    hashed once while a block is validated and connected."""
+    return [transaction.txid for transaction in block.transactions]
+
+def verify_scripts(batch):
+    """Verify the input scripts of serialized transactions. This runs in the worker processes of ScriptValidator.
+
+    :param batch: A list of (block index, serialized transaction, the pubkey scripts spent by its inputs, whether the
+                  P2SH rules apply)
+    :returns: The indexes of the blocks with an invalid transaction
+    """
+    failed = set()
+    for block_index, raw_transaction, pubkey_scripts, p2sh in batch:
+        if block_index in failed:
+            continue
+        transaction = messages.Transaction.from_stream(BytesIO(raw_transaction))
+        for input_index, pubkey_script in enumerate(pubkey_scripts):
+            if not signatures.verify_input(transaction, input_index, pubkey_script, p2sh=p2sh):
+                failed.add(block_index)
+                break
+    return sorted(failed)
+
+class CachedSignatures(object):
+    """A signature backend which accepts no signatures itself, so only those in the signature cache pass. See
+    ScriptValidator."""
+    name = "cached"
+
+    def verify(self, pubkey, signature, digest):
+        return False
+
+class ScriptValidator(object):
+    """Verifies the input scripts of blocks across a pool of worker processes.
+
+    Scripts are CPU bound pure Python, so they're run in other processes to get around the GIL. The serialized
+    transactions are sent to the workers in batches of about `batch_size` inputs, along with the pubkey scripts they
+    spend, and only the indexes of the rejected blocks come back. During the initial sync, pass the blocks of a whole
+    download window at once, to keep all the workers busy.
+
+    With a single worker, the scripts are verified in this process. Otherwise, transactions whose signatures are all
+    in this process' signature cache, as they were verified when they entered the mempool, aren't sent to the workers.
+    """
+
+    BATCH_SIZE = 500
+
+    def __init__(self, workers=None, batch_size=BATCH_SIZE):
+        self.workers = workers if workers is not None else os.cpu_count()
+        self.batch_size = batch_size
+        self.pool = ProcessPoolExecutor(self.workers) if self.workers > 1 else None
+        self.cached = CachedSignatures()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def is_cached(self, transaction, pubkey_scripts, p2sh=True):
+        """Whether the scripts of the transaction pass with only the signatures in this process' signature cache,
+        which the workers don't share"""
+        if len(signatures.cache) == 0:
+            # Nothing to find while syncing, before the mempool fills up
+            return False
+        return all(signatures.verify_input(transaction, input_index, pubkey_script, self.cached, p2sh=p2sh)
+            for input_index, pubkey_script in enumerate(pubkey_scripts))
+
+    def validate(self, blocks, get_pubkey_script):
+        """Verify the scripts of consecutive blocks, and return whether each of them is valid.
+
+        :param get_pubkey_script: Called with the hash and index of a spent output which wasn't created by the given
+                                  blocks. Returns its pubkey script, or None if there's no such unspent output.
+        """
+        valid = [True] * len(blocks)
+        # Outpoint -> pubkey script of the outputs created by the given blocks
+        created = {}
+        batches = []
+        batch = []
+        input_count = 0
+        for block_index, block in enumerate(blocks):
+            raw_transactions = get_raw_transactions(block)
+            p2sh = is_p2sh_active(block)
+            for transaction_index, transaction in enumerate(block.transactions):
+                raw_transaction = raw_transactions[transaction_index]
+                if transaction_index > 0:
+                    # The coinbase has no scripts to verify
+                    pubkey_scripts = []
+                    for input in transaction.inputs:
+                        outpoint = (input.previous_output.out_hash, input.previous_output.index)
+                        pubkey_script = created.pop(outpoint, None)
+                        if pubkey_script is None:
+                            pubkey_script = get_pubkey_script(*outpoint)
+                        if pubkey_script is None:
+                            break
+                        pubkey_scripts.append(pubkey_script)
+                    if len(pubkey_scripts) < len(transaction.inputs):
+                        # Spends a missing output
+                        valid[block_index] = False
+                        break
+
+                    if self.pool is None or not self.is_cached(transaction, pubkey_scripts, p2sh):
+                        batch.append((block_index, raw_transaction, pubkey_scripts, p2sh))
+                        input_count += len(pubkey_scripts)
+                        if input_count >= self.batch_size:
+                            batches.append(batch)
+                            batch = []
+                            input_count = 0
+
+                transaction_hash = transaction.txid
+                for output_index, output in enumerate(transaction.outputs):
+                    created[(transaction_hash, output_index)] = output.pubkey_script
+        if len(batch) > 0:
+            batches.append(batch)
+
+        if self.pool is None:
+            results = map(verify_scripts, batches)
+        else:
+            results = self.pool.map(verify_scripts, batches)
+        for failed in results:
+            for block_index in failed:
+                valid[block_index] = False
+        return valid